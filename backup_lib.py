@@ -1,16 +1,39 @@
 import ovirtsdk4 as sdk
 from ovirtsdk4 import types
 import time
-import requests
 import os
-from math import floor, log10
+from math import floor
 from datetime import datetime
-import sys
 import pickle
 import subprocess
 import json
-import logging
 import glob
+from concurrent.futures import ThreadPoolExecutor
+import scheduler
+from scheduler import current_job, check_cancelled
+from savior_logging import (
+    main_logger,
+    current_context,
+    start_log_context,
+    log_context,
+)
+from engine_api import EngineApi, API_CONCURRENCY, API_CACHE_TTL
+from delta import CompareSink, BLOCK_SIZE, block_ranges
+from qcow2 import Qcow2Writer, CLUSTER_SIZE
+from readahead import ReadAhead, read_ahead_size
+from savior_common import ENCRYPTED_SUFFIX, rate_str, size_str
+from tee import REPLICA_BUFFER, open_sink
+from throttle import Throttle, DISK
+from transfer import (
+    get_client,
+    TransferClient,
+    POOL_SIZE,
+    PARALLEL_REQUESTS,
+    RANGE_SIZE,
+    IO_WORKERS,
+    PROBE_SIZE,
+    TransferStatusError,
+)
 
 URL = "https://ovirtengine.example.com/ovirt-engine/api"
 USERNAME = "admin@internal"
@@ -22,6 +45,12 @@ SAVE_DIRECTORY = DOWNLOAD_DIRECTORY
 CHUNK_SIZE = 1024 * 1024 * 10
 REPORT_EVERY = 1e9
 STORAGE_DOMAIN = "mystorage"
+DISK_POLL_INTERVAL = 5
+DISK_TIMEOUT = 3600
+SNAPSHOT_POLL_INTERVAL = 3
+UPLOAD_WORKERS = 4
+OUTPUT_FORMAT = "raw"
+TRANSFER_PATH = "auto"
 
 NEW_DISK_NAME = "vm_disk"
 NEW_DESCRIPTION = "A new VM added by the backup script"
@@ -31,66 +60,45 @@ NEW_BOOTABLE = True
 NEW_STORAGE_DOMAIN_NAME = "mystorage"
 RECOVERY_CLUSTER = "mycluser"
 RECOVERY_TEMPLATE = "Blank"
-VM_LOGGER_FILE = "savior.log"
-GLOBAL_LOGGER_FILE = "global_savior.log"
 
 
-def logger():
-    logger = logging.getLogger("savior")
+def in_job_context(func):
+    # pool threads do not inherit the log context and scheduler job of the submitting thread
+    values = current_context()
+    job = current_job()
 
-    output_file_handler = logging.FileHandler(VM_LOGGER_FILE, mode="w")
-    global_file_handler = logging.FileHandler(GLOBAL_LOGGER_FILE)
-    stdout_handler = logging.StreamHandler(sys.stdout)
-    logger.addHandler(output_file_handler)
-    logger.addHandler(global_file_handler)
-    logger.addHandler(stdout_handler)
-    logger.setLevel(logging.DEBUG)
+    def run(*args, **kwargs):
+        start_log_context(**values)
+        scheduler.current.job = job
+        try:
+            return func(*args, **kwargs)
+        finally:
+            start_log_context()
+            scheduler.current.job = None
 
-    formatter_file = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-    formatter_stdout = logging.Formatter("%(message)s")
-
-    stdout_handler.setFormatter(formatter_stdout)
-    output_file_handler.setFormatter(formatter_file)
-    global_file_handler.setFormatter(formatter_file)
-    stdout_handler.setLevel(logging.DEBUG)
-    output_file_handler.setLevel(logging.DEBUG)
-    global_file_handler.setLevel(logging.DEBUG)
-    return logger
-
-
-main_logger = logger()
-
-
-def rate_str(rate):
-    if log10(rate) < 3:
-        return "%3.1f b/s" % rate
-    elif log10(rate) < 6:
-        return "%3.1f Kb/s" % (rate / 1e3)
-    elif log10(rate) < 9:
-        return "%3.1f Mb/s" % (rate / 1e6)
-    else:
-        return "%3.2f Gb/s" % (rate / 1e9)
-
-
-def size_str(s):
-    if log10(s) < 3:
-        return "%3.0fB" % s
-    elif log10(s) < 6:
-        return "%3.1fKB" % (s / 1e3)
-    elif log10(s) < 9:
-        return "%3.1fMB" % (s / 1e6)
-    else:
-        return "%3.1fGB" % (s / 1e9)
+    return run
 
 
 class transfer_bar:
-    def __init__(self, expected_size, report_every=REPORT_EVERY, size_of_bar=20):
+    def __init__(
+        self, expected_size, report_every=REPORT_EVERY, size_of_bar=20, job=None, context=None
+    ):
         self.t0 = datetime.now()
         self.expected_size = expected_size
         self.previous = 0
         self.size_of_bar = size_of_bar
         self.report_every = report_every
         self.last_report = 0
+        self.job = job
+        # progress is logged from the transfer loop thread, the context of the job is kept here
+        self.context = context or {}
+
+    def count(self, counter):
+        # feeds the live throughput of the scheduler job that owns this transfer
+        if self.job is not None:
+            self.job.add_bytes(counter - self.previous)
+            self.job.check_cancelled()
+        self.previous = counter
 
     def bar(self, counter):
         percentage = counter / self.expected_size
@@ -130,84 +138,180 @@ class transfer_bar:
         )
 
     def show_progress(self, counter):
+        self.count(counter)
         if counter >= self.last_report + self.report_every:
             msg = self.progress(counter)
             self.last_report = counter
-            main_logger.debug(msg)
+            main_logger.debug(msg, extra=self.extra(counter, progress=True))
 
     def show_final_progress(self, counter):
+        self.count(counter)
         msg = self.progress(counter)
         self.last_report = counter
-        main_logger.debug(msg)
-
-
-def download_url(url, file_name, ca_file=CA_FILE, chunk_size=CHUNK_SIZE):
-    index = 0
-    r = requests.get(url, verify=ca_file, stream=True)
-    total_length = int(r.headers.get("content-length"))
-    t = transfer_bar(total_length)
-    tmp_file_name = file_name + ".tmp"
-    with open(tmp_file_name, "wb") as h:
-        for ch in r.iter_content(chunk_size=chunk_size):
-            if ch:
-                h.write(ch)
-                index += len(ch)
-                t.show_progress(index)
-    t.show_final_progress(index)
-
-    if os.path.isfile(file_name):
-        os.remove(file_name)
-    os.rename(tmp_file_name, file_name)
-
-
-def upload_url(url, filename, ca_file=CA_FILE, chunk_size=CHUNK_SIZE):
-    headers = {}
-    index = 0
-    offset = 0
-    # content_name = str(filename)
-    content_path = os.path.abspath(filename)
-    content_size = os.stat(content_path).st_size
-    t = transfer_bar(content_size)
-
-    with open(filename, "rb") as h:
-        chunk = h.read(chunk_size)
-
-        while chunk:
-            offset = index + len(chunk)
-            headers["Content-Type"] = "application/octet-stream"
-            headers["Content-length"] = str(content_size)
-            headers["Content-Range"] = "bytes %s-%s/%s" % (
-                index,
-                offset - 1,
-                content_size,
-            )
+        main_logger.debug(msg, extra=self.extra(counter))
+
+    def extra(self, counter, **kwargs):
+        extra = dict(self.context, bytes=counter, total=self.expected_size, **kwargs)
+        return extra
+
+
+def download_url(
+    url,
+    file_name,
+    ca_file=CA_FILE,
+    chunk_size=CHUNK_SIZE,
+    client=None,
+    replicas=None,
+    replica_buffer=REPLICA_BUFFER,
+    sink=None,
+):
+    if client is None:
+        client = get_client(ca_file)
+    job = current_job()
+    context = current_context()
+    results = client.run(
+        client.download(
+            url,
+            file_name,
+            chunk_size=chunk_size,
+            bar_factory=lambda size: transfer_bar(size, job=job, context=context),
+            replicas=replicas,
+            replica_buffer=replica_buffer,
+            sink=sink,
+        )
+    )
+    if job is not None and "zero_clusters" in results[0]:
+        job.add_zero_bytes(results[0]["zero_clusters"] * CLUSTER_SIZE)
+    if replicas:
+        for result in results:
+            if result["completed"]:
+                main_logger.info(
+                    "Wrote %s at %s, max lag %s"
+                    % (
+                        result["path"],
+                        rate_str(8 * result["throughput"]),
+                        size_str(result["max_lag"]),
+                    )
+                )
+            else:
+                main_logger.error("Replica %s failed: %s" % (result["path"], result["error"]))
+    return results
+
+
+def upload_url(url, filename, ca_file=CA_FILE, chunk_size=CHUNK_SIZE, client=None):
+    if client is None:
+        client = get_client(ca_file)
+    job = current_job()
+    context = current_context()
+    return client.run(
+        client.upload(
+            url,
+            filename,
+            chunk_size=chunk_size,
+            bar_factory=lambda size: transfer_bar(size, job=job, context=context),
+        )
+    )
 
-            index = offset
-            # r = requests.put(url, data=chunk, headers=headers, verify=ca_file, stream=True)
-            chunk = h.read(chunk_size)
-            t.show_progress(offset)
 
-    t.show_final_progress(offset)
+def compare_url(
+    url, image, ca_file=CA_FILE, chunk_size=CHUNK_SIZE, client=None, block_size=BLOCK_SIZE
+):
+    if client is None:
+        client = get_client(ca_file)
+    job = current_job()
+    context = current_context()
+    results = client.run(
+        client.download(
+            url,
+            image.filename,
+            chunk_size=chunk_size,
+            bar_factory=lambda size: transfer_bar(size, job=job, context=context),
+            sink=CompareSink(image, block_size=block_size),
+        )
+    )
+    return results[0]
+
+
+def write_blocks_url(url, image, ranges, size, ca_file=CA_FILE, client=None):
+    if client is None:
+        client = get_client(ca_file)
+    job = current_job()
+    context = current_context()
+    return client.run(
+        client.write_blocks(
+            url,
+            image.read,
+            ranges,
+            size,
+            bar_factory=lambda size: transfer_bar(size, job=job, context=context),
+            zeroed=job.add_zero_bytes if job else None,
+        )
+    )
 
 
-def copy_file(source_file, dest_file, chunk_size=CHUNK_SIZE):
+def transfer_urls(transfer, path=TRANSFER_PATH):
+    # (path, url) candidates of an image transfer, the host serving the disk comes first
+    urls = []
+    if path in ("auto", "direct") and transfer.transfer_url:
+        urls.append(("direct", transfer.transfer_url))
+    if path in ("auto", "proxy") and transfer.proxy_url:
+        urls.append(("proxy", transfer.proxy_url))
+    return urls
+
+
+def copy_file(
+    source_file,
+    dest_file,
+    chunk_size=CHUNK_SIZE,
+    throttle=None,
+    read_ahead="auto",
+    encryption=None,
+):
     # content_path = os.path.abspath(source_file)
     content_size = os.stat(source_file).st_size
     t = transfer_bar(content_size)
 
-    source_f = open(source_file, "rb")
+    # the next chunks are read from the backup (often on NFS) while one is written, an
+    # encrypted backup is decrypted by the reading threads
+    window = read_ahead_size(source_file, read_ahead)
+    if encryption is not None:
+        source_f = encryption.reader(source_file, read_ahead=window)
+    else:
+        source_f = ReadAhead(source_file, chunk_size, window=window)
     dest_f = open(dest_file, "wb")
     bytes_read = 0
 
-    chunk = source_f.read(chunk_size)
-    while chunk:
-        dest_f.write(chunk)
-        bytes_read += len(chunk)
-        t.show_progress(bytes_read)
-        chunk = source_f.read(chunk_size)
-
-    source_f.close()
-    dest_f.close()
+    try:
+        for chunk in source_f:
+            if throttle is not None:
+                throttle.wait(DISK, len(chunk))
+            dest_f.write(chunk)
+            bytes_read += len(chunk)
+            t.show_progress(bytes_read)
+    finally:
+        source_f.close()
+        dest_f.close()
+
+
+def copy_backup_files(
+    source_directory, dest_directory, throttle=None, read_ahead="auto", encryption=None
+):
+    # every file of a VM backup, <image>.enc files are written back as <image> in plaintext
+    for name in sorted(os.listdir(source_directory)):
+        source_file = os.path.join(source_directory, name)
+        if not os.path.isfile(source_file):
+            continue
+        dest_file = os.path.join(dest_directory, name)
+        decrypt = None
+        if name.endswith(ENCRYPTED_SUFFIX):
+            if encryption is None:
+                raise ValueError("%s is encrypted and no encryption key is set" % source_file)
+            dest_file = dest_file[: -len(ENCRYPTED_SUFFIX)]
+            decrypt = encryption
+        main_logger.info("Transfering %s to %s" % (source_file, dest_file))
+        copy_file(
+            source_file, dest_file, throttle=throttle, read_ahead=read_ahead, encryption=decrypt
+        )
 
 
 class Disk:
@@ -280,29 +384,101 @@ class Disk:
     def upload(self, filename):
         # content_path = os.path.abspath(filename)
         # size = os.stat(content_path).st_size
-        transfers_service = self.transfers_service
-        transfer = transfers_service.add(
+        transfer, transfer_service = self.oh.start_transfer(
             types.ImageTransfer(
                 disk=types.Disk(id=self.id()),
                 direction=types.ImageTransferDirection.UPLOAD,
             )
         )
 
-        transfer_service = transfers_service.image_transfer_service(transfer.id)
-        while transfer.phase == types.ImageTransferPhase.INITIALIZING:
-            time.sleep(3)
-            transfer = transfer_service.get()
-
         #        client.upload(filename, transfer.transfer_url, self.ca_file)
-        upload_url(
-            transfer.transfer_url,
-            filename,
-            ca_file=self.ca_file,
-            chunk_size=self.chunk_size,
-        )
+        with log_context(disk=self.id()):
+            self.oh.run_transfer(
+                transfer,
+                lambda url: upload_url(
+                    url,
+                    filename,
+                    ca_file=self.ca_file,
+                    chunk_size=self.chunk_size,
+                    client=self.oh.transfer_client,
+                ),
+            )
 
         transfer_service.finalize()
 
+    def transfer(self, direction, action):
+        # runs action(transfer_url) on a transfer of the guest data of the whole disk
+        transfer, transfer_service = self.oh.start_transfer(
+            types.ImageTransfer(
+                disk=types.Disk(id=self.id()),
+                direction=direction,
+                format=types.DiskFormat.RAW,
+            )
+        )
+
+        try:
+            return self.oh.run_transfer(transfer, action)
+        finally:
+            transfer_service.finalize()
+
+    def delta_restore(self, image, block_size=BLOCK_SIZE):
+        # reads the disk, compares it with the backup and writes back only the blocks that differ
+        if self.provisioned_size() < image.size:
+            raise ValueError(
+                "Disk %s (%s) is smaller than its backup %s"
+                % (self.name(), size_str(self.provisioned_size()), size_str(image.size))
+            )
+        if self.provisioned_size() > image.size:
+            main_logger.warning(
+                "Disk %s is larger than its backup, the last %s are left as they are"
+                % (self.name(), size_str(self.provisioned_size() - image.size))
+            )
+
+        with log_context(disk=self.id()):
+            main_logger.info("Comparing disk %s with %s" % (self.name(), image.filename))
+            result = self.transfer(
+                types.ImageTransferDirection.DOWNLOAD,
+                lambda url: compare_url(
+                    url,
+                    image,
+                    ca_file=self.ca_file,
+                    chunk_size=self.chunk_size,
+                    client=self.oh.transfer_client,
+                    block_size=block_size,
+                ),
+            )
+            ranges = block_ranges(result["changed"], block_size, image.size)
+            changed = sum([x[1] for x in ranges])
+            main_logger.info(
+                "%d of %d blocks of disk %s differ (%s)"
+                % (len(result["changed"]), result["compared"], self.name(), size_str(changed))
+            )
+            if ranges:
+                self.transfer(
+                    types.ImageTransferDirection.UPLOAD,
+                    lambda url: write_blocks_url(
+                        url,
+                        image,
+                        ranges,
+                        self.provisioned_size(),
+                        ca_file=self.ca_file,
+                        client=self.oh.transfer_client,
+                    ),
+                )
+        return changed
+
+    def upload_image(self, filename):
+        # backups stored as qcow2 go back to raw disks as plain data
+        if self.format() != types.DiskFormat.RAW or qemu_info(filename)["format"] == "raw":
+            return self.upload(filename)
+        raw_filename = filename + ".raw"
+        main_logger.info("Converting %s to raw before uploading" % filename)
+        qemu_convert(filename, raw_filename, "raw")
+        try:
+            self.upload(raw_filename)
+        finally:
+            os.remove(raw_filename)
+
 
 class SnapshotDisk(Disk):
     def __init__(
@@ -322,56 +498,96 @@ class SnapshotDisk(Disk):
     def __str__(self):
         return "Snapshot disk %s with id: %s" % (self.name(), self.image_id())
 
-    def download(self, download_dir=DOWNLOAD_DIRECTORY):
-        transfer = self.transfers_service.add(
+    def download(
+        self,
+        download_dir=DOWNLOAD_DIRECTORY,
+        replica_dirs=None,
+        replica_buffer=REPLICA_BUFFER,
+        sink_factory=None,
+        output_format=OUTPUT_FORMAT,
+        compress=False,
+        encryption=None,
+    ):
+        transfer, transfer_service = self.oh.start_transfer(
             types.ImageTransfer(
                 snapshot=types.DiskSnapshot(id=self.image_id()),
                 direction=types.ImageTransferDirection.DOWNLOAD,
             )
         )
 
-        transfer_service = self.transfers_service.image_transfer_service(transfer.id)
-        while transfer.phase == types.ImageTransferPhase.INITIALIZING:
-            time.sleep(3)
-            transfer = transfer_service.get()
-
         # Download virtual disk to qcow2 image:
         file_name = os.path.join(download_dir, self.image_id())
-        download_url(
-            transfer.transfer_url,
-            file_name,
-            ca_file=self.ca_file,
-            chunk_size=self.chunk_size,
-        )
+        replicas = [os.path.join(x, self.image_id()) for x in replica_dirs or []]
+
+        def download(url):
+            # a new sink for every url tried, a failed attempt leaves nothing behind
+            sink = sink_factory(self.image_id()) if sink_factory else None
+            if sink is None and output_format == "qcow2" and self.format() == types.DiskFormat.RAW:
+                # raw layers are converted while they arrive, qcow2 layers are kept as sent
+                sink = open_sink(
+                    file_name,
+                    replicas=replicas,
+                    buffer_size=replica_buffer,
+                    sink_class=lambda x: Qcow2Writer(x, compress=compress),
+                )
+            elif sink is None and encryption is not None:
+                sink = open_sink(
+                    file_name,
+                    replicas=replicas,
+                    buffer_size=replica_buffer,
+                    sink_class=encryption.sink,
+                )
+            return download_url(
+                url,
+                file_name,
+                ca_file=self.ca_file,
+                chunk_size=self.chunk_size,
+                client=self.oh.transfer_client,
+                replicas=replicas,
+                replica_buffer=replica_buffer,
+                sink=sink,
+            )
+
+        with log_context(disk=self.image_id()):
+            results = self.oh.run_transfer(transfer, download)
+            if "stored_bytes" in results[0]:
+                main_logger.info(
+                    "Stored %s as qcow2 in %s, %d zero and %d compressed clusters"
+                    % (
+                        size_str(results[0]["bytes"]),
+                        size_str(results[0]["stored_bytes"]),
+                        results[0]["zero_clusters"],
+                        results[0]["compressed_clusters"],
+                    )
+                )
 
         transfer_service.finalize()
 
     def upload(self, filename):
         # content_path = os.path.abspath(filename)
         # size = os.stat(content_path).st_size
-        transfers_service = self.transfers_service
-        transfer = transfers_service.add(
+        transfer, transfer_service = self.oh.start_transfer(
             types.ImageTransfer(
                 snapshot=types.DiskSnapshot(id=self.image_id()),
                 direction=types.ImageTransferDirection.UPLOAD,
             )
         )
 
-        transfer_service = transfers_service.image_transfer_service(transfer.id)
-        while transfer.phase == types.ImageTransferPhase.INITIALIZING:
-            time.sleep(3)
-            transfer = transfer_service.get()
-
-        upload_url(
-            transfer.transfer_url,
-            filename,
-            ca_file=self.ca_file,
-            chunk_size=self.chunk_size,
-        )
+        with log_context(disk=self.id()):
+            self.oh.run_transfer(
+                transfer,
+                lambda url: upload_url(
+                    url,
+                    filename,
+                    ca_file=self.ca_file,
+                    chunk_size=self.chunk_size,
+                    client=self.oh.transfer_client,
+                ),
+            )
         transfer_service.finalize()
 
     def status(self):
-        disk_info = self.disk_service.get()
+        disk_info = self.disk_service.get(fresh=True)
         return disk_info.status
 
 
@@ -404,10 +620,27 @@ class Snapshot:
 
         return all_disks
 
-    def download_disks(self, download_dir=DOWNLOAD_DIRECTORY):
+    def download_disks(
+        self,
+        download_dir=DOWNLOAD_DIRECTORY,
+        replica_dirs=None,
+        replica_buffer=REPLICA_BUFFER,
+        sink_factory=None,
+        output_format=OUTPUT_FORMAT,
+        compress=False,
+        encryption=None,
+    ):
         for disk in self.all_disks():
             main_logger.info("Downloading disk %s with image id %s" % (disk.id(), disk.image_id()))
-            disk.download(download_dir=download_dir)
+            disk.download(
+                download_dir=download_dir,
+                replica_dirs=replica_dirs,
+                replica_buffer=replica_buffer,
+                sink_factory=sink_factory,
+                output_format=output_format,
+                compress=compress,
+                encryption=encryption,
+            )
 
     def date(self):
         return self.snapshot_info.date
@@ -438,6 +671,8 @@ class VM:
         self.oh = oh
         self.snapshots_service = vm_service.snapshots_service()
         self.disks_service = vm_service.disk_attachments_service()
+        self.submitted_at = {}
+        self.provisioning_times = {}
 
     def all_snapshots(self, omit_active=True):
         snapshots = self.snapshots_service.list(all_content=True)
@@ -464,14 +699,36 @@ class VM:
     def __repr__(self):
         return self.__str__()
 
-    def download_snapshot_disks(self, snapshot_name, download_dir=DOWNLOAD_DIRECTORY):
+    def download_snapshot_disks(
+        self,
+        snapshot_name,
+        download_dir=DOWNLOAD_DIRECTORY,
+        replica_dirs=None,
+        replica_buffer=REPLICA_BUFFER,
+        sink_factory=None,
+        output_format=OUTPUT_FORMAT,
+        compress=False,
+        encryption=None,
+    ):
         main_logger.info("Downloading vm disks for selected snapshot for vm %s..." % self.name())
         for snap in self.all_snapshots():
             if snap.description() == snapshot_name:
                 main_logger.info(
                     "-snapshot description %s, with id: %s" % (snap.description(), snap.id())
                 )
-                snap.download_disks(download_dir=download_dir)
+                snap.download_disks(
+                    download_dir=download_dir,
+                    replica_dirs=replica_dirs,
+                    replica_buffer=replica_buffer,
+                    sink_factory=sink_factory,
+                    output_format=output_format,
+                    compress=compress,
+                    encryption=encryption,
+                )
+
+        if output_format == "qcow2" and sink_factory is None:
+            for directory in [download_dir] + list(replica_dirs or []):
+                fix_backing_formats(directory)
 
     def add_disk(
         self,
@@ -485,6 +742,33 @@ class VM:
         provisioned_size=None,
         id=None,
     ):
+        disk_service = self.submit_disk(
+            disk_name=disk_name,
+            description=description,
+            format=format,
+            sparse=sparse,
+            bootable=bootable,
+            domain_name=domain_name,
+            initial_size=initial_size,
+            provisioned_size=provisioned_size,
+            id=id,
+        )
+        for disk in self.wait_for_disks([disk_service]):
+            return disk
+
+    def submit_disk(
+        self,
+        disk_name=NEW_DISK_NAME,
+        description=NEW_DESCRIPTION,
+        format=NEW_FORMAT,
+        sparse=NEW_SPARSE,
+        bootable=NEW_BOOTABLE,
+        domain_name=NEW_STORAGE_DOMAIN_NAME,
+        initial_size=None,
+        provisioned_size=None,
+        id=None,
+    ):
+        # Only asks the engine for the disk, use wait_for_disks to wait for provisioning
         disk_info = types.Disk(
             name=disk_name,
             description=description,
@@ -506,14 +790,56 @@ class VM:
         )
 
         disk_service = self.oh.disks_service.disk_service(disk_attachment.id)
-        while True:
-            time.sleep(5)
-            disk1 = disk_service.get()
-            if disk1.status == types.DiskStatus.OK:
-                break
+        self.submitted_at[disk_attachment.id] = time.monotonic()
+        return disk_service
 
-        disk_info = disk_service.get()
-        return Disk(disk_info, disk_service, self.oh)
+    def wait_for_disks(
+        self, disk_services, poll_interval=DISK_POLL_INTERVAL, timeout=DISK_TIMEOUT, check=None
+    ):
+        # Yields every disk as soon as it turns OK, in the order they become ready. check is
+        # called on every poll, e.g. to stop on the failure of the uploads already started.
+        pending = list(disk_services)
+        deadline = time.monotonic() + timeout
+        while pending:
+            time.sleep(poll_interval)
+            check_cancelled()
+            if check:
+                check()
+            if time.monotonic() > deadline:
+                raise ValueError(
+                    "%d disk(s) still not provisioned after %d s" % (len(pending), timeout)
+                )
+            still_pending = []
+            for disk_service in pending:
+                disk_info = disk_service.get(fresh=True)
+                if disk_info.status == types.DiskStatus.ILLEGAL:
+                    raise ValueError(
+                        "Disk %s (%s) turned ILLEGAL while it was provisioned"
+                        % (disk_info.name, disk_info.id)
+                    )
+                if disk_info.status != types.DiskStatus.OK:
+                    still_pending.append(disk_service)
+                    continue
+
+                started = self.submitted_at.pop(disk_info.id, None)
+                if started is not None:
+                    latency = time.monotonic() - started
+                    self.provisioning_times[disk_info.id] = latency
+                    main_logger.info(
+                        "Disk %s (%s) provisioned in %.1f s"
+                        % (disk_info.name, disk_info.id, latency)
+                    )
+                yield Disk(disk_info, disk_service, self.oh)
+            pending = still_pending
+
+    def disk_sizes(self):
+        # actual size of the disks of the VM per storage domain id
+        sizes = {}
+        for disk_attachment in self.disks_service.list():
+            disk_info = self.oh.disks_service.disk_service(disk_attachment.disk.id).get()
+            domain = disk_info.storage_domains[0].id if disk_info.storage_domains else None
+            sizes[domain] = sizes.get(domain, 0) + (disk_info.actual_size or 0)
+        return sizes
 
     def settings(self):
         vm_info = self.vm_info
@@ -558,6 +884,10 @@ class VM:
             pickle.dump(vm_info, f)
 
     def add_snapshot(self, description="", disk_attachments=[]):
+        snapshot_service = self.submit_snapshot(description, disk_attachments)
+        self.wait_for_snapshot(snapshot_service)
+
+    def submit_snapshot(self, description="", disk_attachments=[]):
         if len(disk_attachments) == 0:
             snapshot = self.snapshots_service.add(
                 types.Snapshot(description=description, persist_memorystate=False)
@@ -570,14 +900,21 @@ class VM:
                     persist_memorystate=False,
                 ),
             )
+        return self.snapshots_service.snapshot_service(snapshot.id)
 
-        # Waiting for Snapshot creation to finish
-        snapshot_service = self.snapshots_service.snapshot_service(snapshot.id)
+    def wait_for_snapshot(
+        self, snapshot_service, poll_interval=SNAPSHOT_POLL_INTERVAL, timeout=None
+    ):
+        # Waiting for Snapshot creation to finish, False when timeout expires first
+        deadline = time.monotonic() + timeout if timeout is not None else None
         while True:
-            time.sleep(3)
-            snapshot = snapshot_service.get()
+            time.sleep(poll_interval)
+            check_cancelled()
+            snapshot = snapshot_service.get(fresh=True)
             if snapshot.snapshot_status == types.SnapshotStatus.OK:
-                break
+                return True
+            if deadline is not None and time.monotonic() > deadline:
+                return False
 
     def get_snapshot_by_description(self, description):
         snapshots = self.snapshots_service.list()
@@ -587,7 +924,7 @@ class VM:
                 return Snapshot(snapshot_info, snapshot_service, self.oh)
 
     def status(self):
-        return self.vm_service.get().status
+        return self.vm_service.get(fresh=True).status
 
     def remove_snapshot(self, description):
         snap = self.get_snapshot_by_description(description)
@@ -602,7 +939,12 @@ class VM:
             time.sleep(3)
 
     def add_base_disk(self, base_disk, storage_domain=STORAGE_DOMAIN):
-        new_disk = self.add_disk(
+        disk_service = self.submit_base_disk(base_disk, storage_domain=storage_domain)
+        for disk in self.wait_for_disks([disk_service]):
+            return disk
+
+    def submit_base_disk(self, base_disk, storage_domain=STORAGE_DOMAIN):
+        disk_service = self.submit_disk(
             disk_name=base_disk["name"],
             description=base_disk["description"],
             format=base_disk["format"],
@@ -612,7 +954,7 @@ class VM:
             domain_name=storage_domain,
             bootable=False,
         )
-        return new_disk
+        return disk_service
 
     def generic_disk_attachment(self, new_disk):
         return types.DiskAttachment(disk=types.Disk(id=new_disk.id()))
@@ -663,9 +1005,15 @@ class VM:
                         # this is not a base disk.
                         non_base_disks.append(disk_info)
 
-            # We need to attach every base disk to the current VM state
+            # We need to attach every base disk to the current VM state. All of them are
+            # submitted at once so that they are provisioned in parallel by the engine.
+            pending = {}
             for base_disk in base_disks:
-                new_disk = self.add_base_disk(base_disk, storage_domain=storage_domain)
+                disk_service = self.submit_base_disk(base_disk, storage_domain=storage_domain)
+                pending[disk_service] = base_disk
+
+            for new_disk in self.wait_for_disks(pending.keys()):
+                base_disk = pending[new_disk.disk_service]
                 self.disk_mappings[base_disk["id"]] = new_disk.id()
                 main_logger.debug(
                     "Included base image with id: %s as a new disk with id %s (image id:%s) in"
@@ -717,12 +1065,24 @@ def qemu_rebase(filename, new_base, format):
     return s
 
 
+def qemu_convert(filename, output, format):
+    s = subprocess.check_output(["qemu-img", "convert", "-O", format, filename, output])
+    return s
+
+
+def qemu_create_overlay(filename, backing, backing_format):
+    s = subprocess.check_output(
+        ["qemu-img", "create", "-f", "qcow2", "-b", backing, "-F", backing_format, filename]
+    )
+    return s
+
+
 def qemu_commit(filename):
     s = subprocess.check_output(["qemu-img", "commit", filename])
     return s
 
 
-def qemu_info_dir(directory, filenames="*"):
+def qemu_info_dir(directory, filenames="*", encryption=None):
     q = {}
     if filenames == "*":
         path = os.path.join(directory, "*")
@@ -730,14 +1090,29 @@ def qemu_info_dir(directory, filenames="*"):
 
     for filename in filenames:
         key = os.path.basename(filename)
-        if "." not in key:
+        if key.endswith(ENCRYPTED_SUFFIX) and encryption is not None:
+            q[key[: -len(ENCRYPTED_SUFFIX)]] = encryption.image_info(filename)
+        elif "." not in key:
             q[key] = qemu_info(filename)
 
     return q
 
 
-def qemu_chains(directory, filenames="*"):
+def fix_backing_formats(directory, filenames="*"):
+    # layers on top of a base converted to qcow2 still declare a raw backing file
     disks = qemu_info_dir(directory, filenames=filenames)
+    for disk_name, d in disks.items():
+        backing = d.get("backing-filename")
+        if backing not in disks:
+            continue
+        backing_format = disks[backing]["format"]
+        if d.get("backing-filename-format") != backing_format:
+            main_logger.debug("Rebasing %s on %s (%s)" % (disk_name, backing, backing_format))
+            qemu_rebase(os.path.join(directory, disk_name), backing, backing_format)
+
+
+def qemu_chains(directory, filenames="*", encryption=None):
+    disks = qemu_info_dir(directory, filenames=filenames, encryption=encryption)
 
     # build chain
     depths = {}
@@ -804,17 +1179,147 @@ class OvirtHandler:
         ca_file=CA_FILE,
         download_dir=DOWNLOAD_DIRECTORY,
         chunk_size=CHUNK_SIZE,
+        pool_size=POOL_SIZE,
+        parallel_requests=PARALLEL_REQUESTS,
+        range_size=RANGE_SIZE,
+        io_workers=IO_WORKERS,
+        throttle=None,
+        transfer_path=TRANSFER_PATH,
+        transfer_host=None,
+        probe_size=PROBE_SIZE,
+        connection=None,
+        api_concurrency=API_CONCURRENCY,
+        api_cache_ttl=API_CACHE_TTL,
+        read_ahead="auto",
     ):
-        self.connection = sdk.Connection(
-            url=url, username=username, ca_file=ca_file, password=password
-        )
+        # a connection given by the caller (e.g. the simulator) replaces the SDK one
+        if connection is None:
+            connection = sdk.Connection(
+                url=url, username=username, ca_file=ca_file, password=password
+            )
+        self.connection = connection
+        self.ca_file = ca_file
+        self.throttle = throttle or Throttle()
 
-        self.system_service = self.connection.system_service()
-        self.dmeineisks_service = self.system_service.disks_service()
+        # every service is reached through the api wrapper, which limits and caches the requests
+        self.api = EngineApi(
+            concurrency=api_concurrency, cache_ttl=api_cache_ttl, throttle=self.throttle
+        )
+        self.system_service = self.api.service(self.connection.system_service())
+        self.disks_service = self.system_service.disks_service()
         self.vms_service = self.system_service.vms_service()
         self.transfers_service = self.system_service.image_transfers_service()
         self.storage_domains_service = self.system_service.storage_domains_service()
-        self.ca_file = ca_file
+        self.transfer_path = transfer_path
+        self.transfer_host = transfer_host
+        self.probe_size = probe_size
+        self.read_ahead = read_ahead
+        self.host_ids = {}
+
+        # one transfer client per handler: all disks, chunks and retries share its
+        # keep-alive connections and TLS sessions
+        self.transfer_client = TransferClient(
+            ca_file=ca_file,
+            pool_size=pool_size,
+            parallel_requests=parallel_requests,
+            range_size=range_size,
+            io_workers=io_workers,
+            throttle=self.throttle,
+            read_ahead=read_ahead,
+        )
+
+    def close(self):
+        stats = self.transfer_client.statistics()
+        main_logger.debug(
+            "Transfer client used %d connection(s) to %d host(s), %d TLS session(s) resumed"
+            % (stats["connections"], stats["hosts"], stats["tls_resumed"])
+        )
+        stats = self.api.statistics()
+        main_logger.debug(
+            "Engine API: %d call(s), %d read(s) from cache, %d coalesced"
+            % (
+                sum(stats["calls"].values()),
+                sum(stats["cached"].values()),
+                sum(stats["coalesced"].values()),
+            ),
+            extra={"api_calls": stats["calls"]},
+        )
+        for operation, count in sorted(stats["calls"].items(), key=lambda x: -x[1]):
+            main_logger.debug(
+                "    %-24s %d call(s), %d cached, %d coalesced"
+                % (
+                    operation,
+                    count,
+                    stats["cached"].get(operation, 0),
+                    stats["coalesced"].get(operation, 0),
+                )
+            )
+        self.transfer_client.close()
+        self.connection.close()
+
+    def host_id(self, name):
+        if name not in self.host_ids:
+            hosts = self.system_service.hosts_service().list(search="name=%s" % name)
+            if not hosts:
+                raise ValueError("Host %s not found" % name)
+            self.host_ids[name] = hosts[0].id
+        return self.host_ids[name]
+
+    def start_transfer(self, image_transfer):
+        # without transfer_host the engine picks any active host of the data center
+        if self.transfer_host:
+            image_transfer.host = types.Host(id=self.host_id(self.transfer_host))
+        transfer = self.transfers_service.add(image_transfer)
+        transfer_service = self.transfers_service.image_transfer_service(transfer.id)
+        while transfer.phase == types.ImageTransferPhase.INITIALIZING:
+            time.sleep(3)
+            transfer = transfer_service.get(fresh=True)
+        return transfer, transfer_service
+
+    def run_transfer(self, transfer, action):
+        # runs action(url) through the fastest reachable url of the transfer, the next one is
+        # used when the connection fails or the server answers with an error status
+        candidates = transfer_urls(transfer, self.transfer_path)
+        if not candidates:
+            raise ValueError("Transfer %s has no %s url" % (transfer.id, self.transfer_path))
+        client = self.transfer_client
+        if len(candidates) > 1:
+            probes = client.run(client.rank([x[1] for x in candidates], self.probe_size))
+            ranked = [x["url"] for x in probes]
+            for probe in probes:
+                main_logger.debug(
+                    "Probed %s: %.1f ms%s"
+                    % (
+                        probe["url"],
+                        probe["latency"] * 1000,
+                        ", " + rate_str(8 * probe["throughput"]) if probe["throughput"] else "",
+                    )
+                )
+            # unreachable urls are still tried last
+            candidates.sort(key=lambda x: ranked.index(x[1]) if x[1] in ranked else len(ranked))
+
+        for i, (path, url) in enumerate(candidates):
+            t0 = time.monotonic()
+            client.transferred.pop(url, None)
+            try:
+                result = action(url)
+            except (OSError, EOFError, TransferStatusError) as e:
+                if i == len(candidates) - 1:
+                    raise
+                main_logger.warning(
+                    "Transfer through the %s url failed (%s), falling back to the %s url"
+                    % (path, e, candidates[i + 1][0])
+                )
+                continue
+            duration = time.monotonic() - t0
+            moved = client.transferred.pop(url, 0)
+            rate = moved / duration if duration else 0
+            main_logger.info(
+                "Transferred %s through the %s url at %s"
+                % (size_str(moved), path, rate_str(8 * rate)),
+                extra={"transfer_path": path, "rate": rate},
+            )
+            return result
 
     def terminate_with_error(self, msg, exc=None):
         main_logger.error(msg + ". Terminating.")
@@ -844,6 +1349,10 @@ class OvirtHandler:
         else:
             return vms[0]
 
+    def get_disk(self, disk_id):
+        disk_service = self.disks_service.disk_service(disk_id)
+        return Disk(disk_service.get(), disk_service, self)
+
     def vm_settings_from_file(self, vm_name, save_dir=SAVE_DIRECTORY):
         full_filename = os.path.join(save_dir, vm_name)
         with open(full_filename + ".pickle", "rb") as f:
@@ -864,15 +1373,7 @@ class OvirtHandler:
 
         return VM(vm_info, vm_service, self.connection)
 
-    def add_vm_from_settings(
-        self,
-        settings,
-        storage_domain=STORAGE_DOMAIN,
-        template=RECOVERY_TEMPLATE,
-        cluster_name=RECOVERY_CLUSTER,
-        directory=DOWNLOAD_DIRECTORY,
-        commit=True,
-    ):
+    def create_vm(self, settings, template=RECOVERY_TEMPLATE, cluster_name=RECOVERY_CLUSTER):
         # Create empty vm
         vm_info = self.vms_service.add(
             vm=types.Vm(
@@ -884,17 +1385,55 @@ class OvirtHandler:
         )
 
         vm_service = self.vms_service.vm_service(vm_info.id)
-        vm = VM(vm_info, vm_service, self)
+        return VM(vm_info, vm_service, self)
+
+    def add_vm_from_settings(
+        self,
+        settings,
+        storage_domain=STORAGE_DOMAIN,
+        template=RECOVERY_TEMPLATE,
+        cluster_name=RECOVERY_CLUSTER,
+        directory=DOWNLOAD_DIRECTORY,
+        commit=True,
+        upload_workers=UPLOAD_WORKERS,
+        disk_timeout=DISK_TIMEOUT,
+    ):
+        vm = self.create_vm(settings, template=template, cluster_name=cluster_name)
 
         main_logger.info("Attempting chain commit")
         chains = commit_chains(directory=directory)
+
+        # Submit every disk at once and start uploading each one as soon as it is provisioned
+        pending = {}
         for base_image_id in chains:
-            filename = os.path.join(directory, base_image_id)
-            # disk_info = qemu_info(filename)
             base_disk = settings["disk_info"][base_image_id]
-            new_disk = vm.add_base_disk(base_disk, storage_domain=storage_domain)
-            main_logger.info("Uploading %s" % filename)
-            new_disk.upload(filename)
+            disk_service = vm.submit_base_disk(base_disk, storage_domain=storage_domain)
+            pending[disk_service] = os.path.join(directory, base_image_id)
+
+        uploads = []
+
+        def check_uploads():
+            # a failed upload stops the restore without waiting for the other disks
+            for upload in uploads:
+                if upload.done():
+                    upload.result()
+
+        with ThreadPoolExecutor(max_workers=upload_workers) as executor:
+            try:
+                for new_disk in vm.wait_for_disks(
+                    pending.keys(), timeout=disk_timeout, check=check_uploads
+                ):
+                    filename = pending[new_disk.disk_service]
+                    main_logger.info("Uploading %s" % filename)
+                    uploads.append(executor.submit(in_job_context(new_disk.upload_image), filename))
+
+                for upload in uploads:
+                    upload.result()
+            except Exception:
+                # the uploads not started yet are dropped, the running ones end with the job
+                for upload in uploads:
+                    upload.cancel()
+                raise
 
         return vm
 
@@ -0,0 +1,262 @@
+import argparse
+import configparser
+import json
+import os
+import pickle
+import sys
+
+from history import History, HISTORY_FILE
+from qcow2 import HEADER as QCOW2_HEADER, QCOW2_MAGIC
+from savior_common import ENCRYPTED_SUFFIX, size_str, time_str
+
+# Offline, read-only answers about the backups from working_directory and the history file.
+# Nothing here connects to the engine or imports the SDK, so that monitoring can poll often.
+
+CATALOG_COMMANDS = ["list", "show", "status"]
+SKIPPED_SUFFIXES = [".pickle", ".tmp", ".prof", ".txt", ".log"]
+
+
+def read_params(setup_file):
+    config = configparser.ConfigParser(interpolation=None)
+    if not config.read(setup_file):
+        raise ValueError("Setup file %s not found" % setup_file)
+    params = {}
+    for section in config.sections():
+        params.update(config[section].items())
+    return params
+
+
+def catalog_vms(working_directory):
+    # every VM with a backup in working_directory
+    return sorted(
+        [
+            x
+            for x in os.listdir(working_directory)
+            if os.path.isfile(os.path.join(working_directory, x, x + ".pickle"))
+        ]
+    )
+
+
+class SdkUnpickler(pickle.Unpickler):
+    # the settings hold enums of ovirtsdk4 (disk format, status...), they are read back as their
+    # values without importing the SDK
+    def find_class(self, module, name):
+        if module.startswith("ovirtsdk4"):
+            return lambda *args: args[0] if args else None
+        return super().find_class(module, name)
+
+
+def read_settings(filename):
+    with open(filename, "rb") as f:
+        return SdkUnpickler(f).load()
+
+
+def image_info(filename, encryption=None):
+    # format, virtual size and backing file from the image header, like qemu-img info
+    stat = os.stat(filename)
+    info = {
+        "filename": os.path.basename(filename),
+        "format": "raw",
+        "virtual_size": stat.st_size,
+        "disk_size": stat.st_blocks * 512,
+        "backing": None,
+        "encrypted": filename.endswith(ENCRYPTED_SUFFIX),
+    }
+    if info["encrypted"]:
+        # the encryption module (and cryptography) only when there are encrypted images
+        from encryption import HEADER, MAGIC
+
+        with open(filename, "rb") as f:
+            fields = HEADER.unpack(f.read(HEADER.size).ljust(HEADER.size, b"\0"))
+        info["virtual_size"] = fields[3] if fields[0] == MAGIC else None
+        info["format"] = "encrypted"
+        if encryption is not None:
+            decrypted = encryption.image_info(filename)
+            info["format"] = decrypted["format"]
+            info["virtual_size"] = decrypted["virtual-size"]
+            info["backing"] = decrypted.get("backing-filename")
+        return info
+
+    with open(filename, "rb") as f:
+        header = f.read(4096)
+    if header[:4] == QCOW2_MAGIC:
+        fields = QCOW2_HEADER.unpack_from(header.ljust(QCOW2_HEADER.size, b"\0"))
+        backing_offset, backing_size = fields[2], fields[3]
+        info["format"] = "qcow2"
+        info["virtual_size"] = fields[5]
+        if backing_offset:
+            with open(filename, "rb") as f:
+                f.seek(backing_offset)
+                info["backing"] = f.read(backing_size).decode("utf8")
+    return info
+
+
+def image_chains(images):
+    # base image id -> the images of its chain, base first
+    children = {}
+    for image in images.values():
+        if image["backing"]:
+            children.setdefault(os.path.basename(image["backing"]), []).append(image["image_id"])
+    chains = {}
+    for image_id, image in images.items():
+        if image["backing"] and os.path.basename(image["backing"]) in images:
+            continue
+        chain = [image_id]
+        while children.get(chain[-1]):
+            chain.append(children[chain[-1]][0])
+        chains[image_id] = chain
+    return chains
+
+
+def vm_backup(working_directory, vm_name, encryption=None):
+    directory = os.path.join(working_directory, vm_name)
+    settings_file = os.path.join(directory, vm_name + ".pickle")
+    if not os.path.isfile(settings_file):
+        raise ValueError("No backup of VM %s in %s" % (vm_name, working_directory))
+    settings = read_settings(settings_file)
+    images = {}
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path) or os.path.splitext(name)[1] in SKIPPED_SUFFIXES:
+            continue
+        info = image_info(path, encryption=encryption)
+        info["image_id"] = name[: -len(ENCRYPTED_SUFFIX)] if info["encrypted"] else name
+        disk = settings.get("disk_info", {}).get(info["image_id"], {})
+        info["disk_name"] = disk.get("name")
+        images[info["image_id"]] = info
+    return {
+        "vm": vm_name,
+        "directory": directory,
+        "time": os.path.getmtime(settings_file),
+        "snapshots": [x["description"] for x in settings.get("snapshot_sequence", [])],
+        "images": images,
+        "chains": image_chains(images),
+        "size": sum([x["disk_size"] for x in images.values()]),
+    }
+
+
+def last_runs(params, vm_names=None):
+    runs = History(params.get("history_file", HISTORY_FILE)).last_runs()
+    if vm_names:
+        runs = dict([(k, v) for k, v in runs.items() if k[0] in vm_names])
+    return [runs[x] for x in sorted(runs)]
+
+
+def print_list(backups, runs):
+    last = dict([(x["vm"], x) for x in runs if x["mode"] == "backup"])
+    print("%-32s %7s %12s %-17s %-8s" % ("vm", "images", "size", "saved", "backup"))
+    for backup in backups:
+        run = last.get(backup["vm"])
+        print(
+            "%-32s %7d %12s %-17s %-8s"
+            % (
+                backup["vm"],
+                len(backup["images"]),
+                size_str(backup["size"]),
+                time_str(backup["time"]),
+                ("ok" if run["success"] else "failed") if run else "-",
+            )
+        )
+
+
+def print_show(backup):
+    print("VM %s in %s, saved %s" % (backup["vm"], backup["directory"], time_str(backup["time"])))
+    for base, chain in sorted(backup["chains"].items()):
+        base_info = backup["images"][base]
+        print("  disk %s" % (base_info["disk_name"] or base))
+        for image_id in chain:
+            image = backup["images"][image_id]
+            print(
+                "    %-40s %-9s %12s on disk, %s virtual"
+                % (
+                    image["filename"],
+                    image["format"],
+                    size_str(image["disk_size"]),
+                    size_str(image["virtual_size"]) if image["virtual_size"] is not None else "-",
+                )
+            )
+    print("  total %s" % size_str(backup["size"]))
+
+
+def print_status(runs):
+    print(
+        "%-32s %-10s %-8s %-17s %9s %12s" % ("vm", "mode", "state", "finished", "duration", "size")
+    )
+    for run in runs:
+        print(
+            "%-32s %-10s %-8s %-17s %8.0fs %12s"
+            % (
+                run["vm"],
+                run["mode"],
+                "ok" if run["success"] else "failed",
+                time_str(run["time"]),
+                run["duration"] or 0,
+                size_str(run["actual_size"]) if run.get("actual_size") else "-",
+            )
+        )
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Offline view of the backups, without any connection to the engine."
+    )
+    parser.add_argument(
+        "command",
+        choices=CATALOG_COMMANDS,
+        help="list the backed up VMs, show the images and chains of the backups or the status"
+        " of the last runs.",
+    )
+    parser.add_argument(
+        "-s", "--setup_file", metavar="setupfile", required=True, help="setup file."
+    )
+    parser.add_argument("--vm_name", metavar="vmname", help="only this VM.")
+    parser.add_argument("--json", action="store_true", help="JSON output.")
+    return vars(parser.parse_args())
+
+
+def main():
+    v = parse_arguments()
+    params = read_params(v["setup_file"])
+    if v["vm_name"]:
+        vm_names = [v["vm_name"]]
+    elif v["command"] == "status":
+        vm_names = None
+    elif params.get("s3_bucket"):
+        raise ValueError("The backups are stored in S3, not in working_directory")
+    else:
+        vm_names = catalog_vms(params["working_directory"])
+
+    if v["command"] == "status":
+        runs = last_runs(params, vm_names)
+        if v["json"]:
+            print(json.dumps(runs, indent=1))
+        else:
+            print_status(runs)
+    elif v["command"] == "list":
+        backups = [vm_backup(params["working_directory"], x) for x in vm_names]
+        runs = last_runs(params, vm_names)
+        if v["json"]:
+            print(json.dumps(backups, indent=1))
+        else:
+            print_list(backups, runs)
+    else:
+        # the chains of encrypted images are read with the key (and the encryption module)
+        encryption = None
+        if params.get("encryption"):
+            from encryption import encryption_from_params
+
+            encryption = encryption_from_params(params)
+        backups = [vm_backup(params["working_directory"], x, encryption) for x in vm_names]
+        if v["json"]:
+            print(json.dumps(backups, indent=1))
+        else:
+            for backup in backups:
+                print_show(backup)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except (ValueError, OSError) as exc:
+        print("Error: %s" % exc, file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,249 @@
+import configparser
+import http.client
+import json
+import os
+import signal
+import socket
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+
+from digest import digest_from_params
+from history import History, HISTORY_FILE, job_size, window_deadline
+from tiering import mover_from_params
+from savior_logging import main_logger, close_job_log
+from scheduler import Job, Scheduler, MAX_JOBS
+
+DAEMON_SOCKET = "/tmp/ovirtsavior.sock"
+SPOOL_INTERVAL = 5
+JOB_MODES = ["backup", "backuptemp", "restore", "rollback"]
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ControlHandler(BaseHTTPRequestHandler):
+    # GET /jobs, GET /jobs/<id>, POST /jobs {"mode": ..., "setup_file": ..., "vm_name": ...}
+
+    def address_string(self):
+        return "local"
+
+    def log_message(self, format, *args):
+        main_logger.debug("Control API: " + format % args)
+
+    def reply(self, code, content):
+        body = json.dumps(content, indent=1).encode("utf8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        scheduler = self.server.savior_daemon.scheduler
+        parts = [x for x in self.path.split("/") if x]
+        if parts == ["jobs"]:
+            self.reply(200, scheduler.status())
+        elif len(parts) == 2 and parts[0] == "jobs" and scheduler.get(parts[1]):
+            self.reply(200, scheduler.get(parts[1]).information())
+        else:
+            self.reply(404, {"error": "Not found"})
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            self.reply(404, {"error": "Not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            job = self.server.savior_daemon.submit(request)
+        except ValueError as exc:
+            self.reply(400, {"error": str(exc)})
+            return
+        self.reply(201, job.information())
+
+
+class SaviorDaemon:
+    def __init__(self, params, connect, job_factory):
+        self.params = params
+        self.connect = connect
+        self.job_factory = job_factory
+        self.socket_path = params.get("socket", DAEMON_SOCKET)
+        self.spool_directory = params.get("spool_directory")
+        self.spool_interval = int(params.get("spool_interval", SPOOL_INTERVAL))
+        self.scheduler = Scheduler(
+            self.run_job, max_jobs=int(params.get("max_jobs", MAX_JOBS)), logger=main_logger
+        )
+        self.history = History(params.get("history_file", HISTORY_FILE))
+        self.stopped = threading.Event()
+        self.server = None
+        self.oh = None
+        self.mover = None
+        self.digest = digest_from_params(params)
+
+    def submit(self, request):
+        if not isinstance(request, dict):
+            raise ValueError("A job request must be a JSON object")
+        mode = request.get("mode")
+        setup_file = request.get("setup_file")
+        if mode not in JOB_MODES:
+            raise ValueError("Unknown mode %s, expected one of %s" % (mode, ", ".join(JOB_MODES)))
+        if not setup_file or not os.path.isfile(setup_file):
+            raise ValueError("Setup file %s can not be found" % setup_file)
+        vm_name = request.get("vm_name") or job_vm_name(setup_file)
+        job = Job(
+            mode,
+            os.path.abspath(setup_file),
+            vm_name=vm_name,
+            estimate=self.estimate(mode, vm_name),
+            deadline=request.get("deadline") or window_deadline(self.params.get("backup_window")),
+        )
+        return self.scheduler.submit(job)
+
+    def estimate(self, mode, vm_name):
+        # predicted duration from the history of the VM and the current size of its disks
+        try:
+            vm = self.oh.get_vm_by_name(vm_name) if self.oh and vm_name else None
+            actual_size, storage_domain = job_size(vm.disk_sizes() if vm else {})
+            return self.history.predict(vm_name, mode, actual_size, storage_domain)
+        except Exception as exc:
+            main_logger.warning("Could not predict the duration of %s: %s" % (vm_name, exc))
+            return None
+
+    def run_job(self, job):
+        savior_job = None
+        error = None
+        try:
+            savior_job = self.job_factory(job.mode, job.setup_file, oh=self.oh, vm_name=job.vm_name)
+            savior_job.execute()
+            savior_job.status = "SUCCESS!"
+        except Exception as exc:
+            if savior_job:
+                savior_job.status = "ERROR!"
+            error = str(exc)
+            raise
+        finally:
+            # the S3 store of the job has its own transfer loop and connections
+            if savior_job:
+                try:
+                    savior_job.close()
+                except Exception as exc:
+                    main_logger.warning("Could not close job %s: %s" % (job.id, exc))
+            if self.digest:
+                log_file = savior_job.log_file if savior_job else None
+                profile = (
+                    savior_job.profiler.summary() if savior_job and savior_job.profiler else None
+                )
+                self.digest.add(job, log_file, error, profile)
+            elif savior_job:
+                savior_job.send_mail()
+            if savior_job:
+                close_job_log(savior_job.log_file)
+
+    def scan_spool(self):
+        for name in sorted(os.listdir(self.spool_directory)):
+            if not name.endswith(".job"):
+                continue
+            filename = os.path.join(self.spool_directory, name)
+            try:
+                with open(filename, "r") as f:
+                    request = json.load(f)
+                self.submit(request)
+            except ValueError as exc:
+                main_logger.error("Rejected spooled job %s: %s" % (filename, exc))
+            os.remove(filename)
+
+    def serve(self):
+        main_logger.info("...Savior daemon starting...")
+        self.oh = self.connect(self.params)
+        self.scheduler.start()
+        # older restore points move to the capacity tier while no job runs
+        self.mover = mover_from_params(
+            self.params, throttle=self.oh.throttle, busy=lambda: bool(self.scheduler.active_vms)
+        )
+        if self.mover:
+            self.mover.start()
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.server = UnixHTTPServer(self.socket_path, ControlHandler)
+        self.server.savior_daemon = self
+        os.chmod(self.socket_path, 0o600)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        main_logger.info("Accepting jobs on %s" % self.socket_path)
+
+        signal.signal(signal.SIGTERM, lambda *_: self.stopped.set())
+        signal.signal(signal.SIGINT, lambda *_: self.stopped.set())
+
+        while not self.stopped.is_set():
+            if self.spool_directory:
+                self.scan_spool()
+            # one mail for the jobs of a run, once they are all done
+            if self.digest and self.scheduler.idle():
+                self.digest.flush()
+            self.stopped.wait(self.spool_interval)
+
+        self.shutdown()
+
+    def shutdown(self):
+        main_logger.info("Savior daemon stopping, waiting for running jobs...")
+        self.server.shutdown()
+        self.server.server_close()
+        os.remove(self.socket_path)
+        self.scheduler.stop(wait=True)
+        if self.mover:
+            self.mover.stop()
+        if self.digest:
+            self.digest.close()
+        self.oh.close()
+        main_logger.info("Savior daemon stopped.")
+
+
+def job_vm_name(setup_file):
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(setup_file)
+    if config.has_option("VM", "vm_name"):
+        return config.get("VM", "vm_name")
+    return None
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=30):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def daemon_request(socket_path, method, path, content=None):
+    connection = UnixHTTPConnection(socket_path)
+    body = None if content is None else json.dumps(content)
+    headers = {"Content-Type": "application/json"} if body else {}
+    connection.request(method, path, body=body, headers=headers)
+    response = connection.getresponse()
+    reply = json.loads(response.read())
+    connection.close()
+    if response.status >= 400:
+        raise ValueError(reply.get("error", "Daemon replied with status %d" % response.status))
+    return reply
+
+
+def submit_job(mode, setup_file, vm_name=None, socket_path=DAEMON_SOCKET, spool_directory=None):
+    request = {"mode": mode, "setup_file": os.path.abspath(setup_file), "vm_name": vm_name}
+    if os.path.exists(socket_path):
+        return daemon_request(socket_path, "POST", "/jobs", request)
+    if spool_directory is None:
+        raise ValueError("No daemon socket found at %s and no spool directory set" % socket_path)
+
+    # the daemon picks up only complete *.job files
+    name = "%d-%s" % (time.time() * 1e6, os.getpid())
+    tmp_filename = os.path.join(spool_directory, name + ".tmp")
+    with open(tmp_filename, "w") as f:
+        json.dump(request, f)
+    os.rename(tmp_filename, os.path.join(spool_directory, name + ".job"))
+    return request
@@ -0,0 +1,100 @@
+import hashlib
+import threading
+import time
+
+BLOCK_SIZE = 1024 * 1024
+MAX_WRITE_SIZE = 1024 * 1024 * 16
+
+
+def block_digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class CompareSink:
+    # download sink comparing the current disk contents with a backup image block by block,
+    # only the offsets of the blocks that differ are kept
+
+    def __init__(self, image, block_size=BLOCK_SIZE):
+        self.image = image
+        self.file_name = image.filename
+        self.block_size = block_size
+        self.total = image.size
+        self.blocks = {}
+        self.filled = {}
+        self.changed = []
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.compared = 0
+        self.t0 = None
+        self.error = None
+
+    def open(self):
+        self.t0 = time.monotonic()
+
+    def truncate(self, size):
+        # a disk larger than the backup keeps its extra bytes untouched
+        self.total = min(size, self.image.size)
+
+    def block_length(self, index):
+        return min(self.block_size, self.total - index * self.block_size)
+
+    def write(self, data, offset):
+        view = memoryview(data)[: max(0, self.total - offset)]
+        while view:
+            index = offset // self.block_size
+            position = offset % self.block_size
+            length = min(len(view), self.block_size - position)
+            with self.lock:
+                if index not in self.blocks:
+                    self.blocks[index] = bytearray(self.block_length(index))
+                    self.filled[index] = 0
+                self.blocks[index][position : position + length] = view[:length]
+                self.filled[index] += length
+                complete = self.filled[index] >= self.block_length(index)
+                block = self.blocks.pop(index) if complete else None
+            if complete:
+                self.compare(index, block)
+            view = view[length:]
+            offset += length
+        with self.lock:
+            self.bytes += len(data)
+
+    def compare(self, index, remote):
+        offset = index * self.block_size
+        local = self.image.read(offset, len(remote))
+        with self.lock:
+            self.compared += 1
+            if block_digest(local) != block_digest(remote):
+                self.changed.append(offset)
+
+    def close(self, success=True):
+        if success and self.blocks:
+            self.error = "%d block(s) of %s were not received" % (len(self.blocks), self.file_name)
+
+    def results(self):
+        duration = time.monotonic() - self.t0 if self.t0 else 0
+        return [
+            {
+                "path": self.file_name,
+                "completed": self.error is None,
+                "bytes": self.bytes,
+                "throughput": self.bytes / duration if duration else 0,
+                "max_lag": 0,
+                "error": self.error,
+                "compared": self.compared,
+                "changed": sorted(self.changed),
+            }
+        ]
+
+
+def block_ranges(offsets, block_size, size, max_size=MAX_WRITE_SIZE):
+    # merges adjacent changed blocks into (offset, length) writes of at most max_size bytes
+    ranges = []
+    for offset in sorted(offsets):
+        length = min(block_size, size - offset)
+        if ranges and ranges[-1][0] + ranges[-1][1] == offset:
+            if ranges[-1][1] + length <= max_size:
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + length)
+                continue
+        ranges.append((offset, length))
+    return ranges
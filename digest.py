@@ -0,0 +1,241 @@
+import gzip
+import threading
+import time
+from collections import deque
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from mailer import Mailer
+from savior_common import size_str, time_str
+from savior_logging import main_logger, flush_logs
+
+MAIL_MODES = ["job", "digest"]
+DIGEST_SUBJECT = "[OLVM_BACKUP_KSAT] Digest of %d job(s) on %s: %d failed"
+DIGEST_WAIT = 60
+DIGEST_SLOWEST = 5
+EXCERPT_LINES = 40
+EXCERPT_WIDTH = 500
+EXCERPT_LEVELS = [" - WARNING - ", " - ERROR - ", " - CRITICAL - "]
+
+
+def log_excerpt(log_file, lines=EXCERPT_LINES, tail=False):
+    # the last warnings and errors of a job log and, with tail, its last lines. The log is read
+    # line by line, only the excerpt is kept.
+    problems = deque(maxlen=lines)
+    last = deque(maxlen=lines if tail else 0)
+    with open(log_file, "r", errors="replace") as f:
+        for number, line in enumerate(f):
+            line = line.rstrip("\n")[:EXCERPT_WIDTH]
+            if any([x in line for x in EXCERPT_LEVELS]):
+                problems.append((number, line))
+            last.append((number, line))
+    excerpt = []
+    previous = None
+    for number, line in sorted(dict(list(problems) + list(last)).items()):
+        if previous is not None and number != previous + 1:
+            excerpt.append("[...]")
+        excerpt.append(line)
+        previous = number
+    return "\n".join(excerpt)
+
+
+class Digest:
+    # Collects the jobs of a run and sends them as one mail instead of one mail per job: a table
+    # of every job with the failed and slowest ones marked, and a gzip attachment with excerpts
+    # of their logs. The mail goes out once no job has finished for wait seconds, the SMTP
+    # session of the mailer is kept for the next runs.
+
+    def __init__(
+        self,
+        mailer,
+        recipient,
+        wait=DIGEST_WAIT,
+        slowest=DIGEST_SLOWEST,
+        excerpt_lines=EXCERPT_LINES,
+    ):
+        self.mailer = mailer
+        self.recipient = recipient
+        self.wait = wait
+        self.slowest = slowest
+        self.excerpt_lines = excerpt_lines
+        self.entries = []
+        self.last = None
+        self.lock = threading.Lock()
+
+    def add(self, job, log_file=None, error=None, profile=None):
+        entry = {
+            "vm": job.vm_name or job.setup_file,
+            "mode": job.mode,
+            "id": job.id,
+            "failed": error is not None,
+            "error": error,
+            "started": job.started,
+            "duration": job.duration(),
+            "bytes": job.bytes,
+            "throughput": job.throughput(),
+            "zero_bytes": job.zero_bytes,
+            "excerpt": "",
+            "profile": profile,
+        }
+        if log_file:
+            # the excerpt must contain every record of the job queued so far
+            flush_logs()
+            try:
+                entry["excerpt"] = log_excerpt(
+                    log_file, lines=self.excerpt_lines, tail=entry["failed"]
+                )
+            except OSError as exc:
+                entry["excerpt"] = "Log %s not readable: %s" % (log_file, exc)
+        with self.lock:
+            self.entries.append(entry)
+            self.last = time.monotonic()
+
+    def due(self):
+        with self.lock:
+            return bool(self.entries) and time.monotonic() - self.last >= self.wait
+
+    def flush(self, force=False):
+        # sends the digest of the jobs collected so far, they are kept when the mail fails
+        if not (force or self.due()):
+            return False
+        with self.lock:
+            entries = self.entries
+            self.entries = []
+        if not entries:
+            return False
+        main_logger.info("Sending the digest of %d job(s)" % len(entries))
+        try:
+            self.mailer.send(self.recipient, self.message(entries))
+        except Exception as exc:
+            main_logger.error("Could not send the digest: %s" % exc, exc_info=exc)
+            with self.lock:
+                self.entries = entries + self.entries
+            return False
+        return True
+
+    def close(self):
+        self.flush(force=True)
+        self.mailer.close()
+
+    def message(self, entries):
+        failed = [x for x in entries if x["failed"]]
+        message = MIMEMultipart()
+        message["From"] = self.mailer.sender
+        message["To"] = self.recipient
+        message["Subject"] = DIGEST_SUBJECT % (
+            len(entries),
+            time.strftime("%m-%d-%Y|%H:%M:%S"),
+            len(failed),
+        )
+        excerpts = self.excerpts(entries)
+        message.attach(MIMEText(self.body(entries, attached=bool(excerpts)), "plain"))
+        if excerpts:
+            part = MIMEApplication(gzip.compress(excerpts.encode("utf8")), "gzip")
+            part.add_header(
+                "Content-Disposition",
+                "attachment",
+                filename="digest_%s.log.gz" % time.strftime("%Y%m%dT%H%M%S"),
+            )
+            message.attach(part)
+        return message
+
+    def body(self, entries, attached=False):
+        failed = [x for x in entries if x["failed"]]
+        slowest = sorted(entries, key=lambda x: x["duration"], reverse=True)[: self.slowest]
+        slowest_ids = [x["id"] for x in slowest]
+        started = min([x["started"] or time.time() for x in entries])
+        duration = time.time() - started
+        transferred = sum([x["bytes"] for x in entries])
+        lines = [
+            "%d job(s) since %s, %d failed, %s transferred, %.1f MB/s overall"
+            % (
+                len(entries),
+                time_str(started),
+                len(failed),
+                size_str(transferred),
+                transferred / duration / 1e6 if duration > 0 else 0,
+            ),
+            "",
+            "  %-32s %-10s %-6s %9s %12s %8s %12s"
+            % ("vm", "mode", "state", "duration", "bytes", "MB/s", "zeros"),
+        ]
+        for entry in sorted(entries, key=lambda x: (x["vm"], x["started"] or 0)):
+            mark = "!" if entry["failed"] else ("*" if entry["id"] in slowest_ids else " ")
+            lines.append(
+                "%s %-32s %-10s %-6s %8.0fs %12s %8.1f %12s"
+                % (
+                    mark,
+                    entry["vm"],
+                    entry["mode"],
+                    "failed" if entry["failed"] else "ok",
+                    entry["duration"],
+                    size_str(entry["bytes"]),
+                    entry["throughput"] / 1e6,
+                    size_str(entry["zero_bytes"]),
+                )
+            )
+        lines.append("")
+        lines.append("! failed, * one of the %d slowest jobs" % self.slowest)
+        if failed:
+            lines.append("")
+            lines.append("Failed jobs:")
+            for entry in failed:
+                lines.append(
+                    "  %s (%s, job %s): %s"
+                    % (entry["vm"], entry["mode"], entry["id"], entry["error"])
+                )
+        lines.append("")
+        lines.append("Slowest jobs:")
+        for entry in slowest:
+            lines.append(
+                "  %s (%s): %.0f s, %.1f MB/s"
+                % (entry["vm"], entry["mode"], entry["duration"], entry["throughput"] / 1e6)
+            )
+        if attached:
+            lines.append("")
+            lines.append(
+                "The warnings and errors of the jobs, the end of the logs of the failed ones and"
+                " the profile summaries of the profiled ones are attached."
+            )
+        return "\n".join(lines)
+
+    def excerpts(self, entries):
+        sections = []
+        for entry in sorted(entries, key=lambda x: not x["failed"]):
+            if not entry["excerpt"] and not entry["profile"]:
+                continue
+            section = "==== %s %s, job %s: %s ====" % (
+                entry["vm"],
+                entry["mode"],
+                entry["id"],
+                "failed" if entry["failed"] else "ok",
+            )
+            if entry["excerpt"]:
+                section += "\n" + entry["excerpt"]
+            # the summary of a job run with --profile or profile : yes
+            if entry["profile"]:
+                section += "\n\nProfile:\n" + entry["profile"]
+            sections.append(section)
+        return "\n\n".join(sections)
+
+
+def digest_from_params(params):
+    mode = params.get("mail_mode", "job")
+    if mode not in MAIL_MODES:
+        raise ValueError("Unknown mail_mode %s, expected one of %s" % (mode, ", ".join(MAIL_MODES)))
+    if mode != "digest":
+        return None
+    mailer = Mailer(
+        params["smtp_server"],
+        params["smtp_port"],
+        params["smtp_sender"],
+        params["smtp_password"],
+    )
+    return Digest(
+        mailer,
+        params["smtp_recipient"],
+        wait=float(params.get("digest_wait", DIGEST_WAIT)),
+        slowest=int(params.get("digest_slowest", DIGEST_SLOWEST)),
+        excerpt_lines=int(params.get("digest_excerpt_lines", EXCERPT_LINES)),
+    )
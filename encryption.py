@@ -0,0 +1,252 @@
+import hashlib
+import os
+import shlex
+import struct
+import subprocess
+import threading
+import time
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+except ImportError:
+    AESGCM = ChaCha20Poly1305 = InvalidTag = None
+
+from qcow2 import HEADER as QCOW2_HEADER, QCOW2_MAGIC
+from readahead import ReadAhead, READ_AHEAD
+from savior_common import ENCRYPTED_SUFFIX
+
+ENCRYPTION_BLOCK = 1024 * 1024
+MIN_BLOCK = 1024 * 64
+TAG_SIZE = 16
+MAGIC = b"SAVIOR\x00\x01"
+CIPHERS = {"aes-256-gcm": 1, "chacha20-poly1305": 2}
+# magic, cipher, block size, plaintext size, key id, salt
+HEADER = struct.Struct(">8sBxxxIQ8s8s")
+
+
+def cipher_class(name):
+    if AESGCM is None:
+        raise ValueError("Encryption needs the cryptography package")
+    return {"aes-256-gcm": AESGCM, "chacha20-poly1305": ChaCha20Poly1305}[name]
+
+
+def read_key(key_file=None, key_command=None):
+    # 32 raw bytes or 64 hex digits, from a file or from the output of a command (e.g. the
+    # client of a key management service)
+    if key_command:
+        data = subprocess.check_output(shlex.split(key_command))
+    else:
+        with open(key_file, "rb") as f:
+            data = f.read()
+    if len(data) != 32:
+        try:
+            data = bytes.fromhex(data.decode("ascii").strip())
+        except ValueError:
+            data = b""
+    if len(data) != 32:
+        raise ValueError("The encryption key must be 32 bytes or 64 hex digits")
+    return data
+
+
+class Encryption:
+    # Images are stored as <name>.enc: a header followed by blocks of block_size bytes, each one
+    # encrypted and authenticated on its own so that blocks can be written in any order and in
+    # parallel. The nonce is a random salt of the file followed by the block index, the header
+    # (which holds the plaintext size) is authenticated with every block.
+
+    def __init__(self, key, cipher="aes-256-gcm", block_size=ENCRYPTION_BLOCK):
+        if cipher not in CIPHERS:
+            raise ValueError("encryption must be one of %s" % ", ".join(CIPHERS))
+        if block_size < MIN_BLOCK:
+            raise ValueError("encryption_block_size must be at least %d" % MIN_BLOCK)
+        self.cipher = cipher
+        self.aead = cipher_class(cipher)(key)
+        self.key_id = hashlib.sha256(key).digest()[:8]
+        self.block_size = block_size
+
+    def sink(self, file_name):
+        return EncryptedSink(file_name, self)
+
+    def header(self, size, salt):
+        return HEADER.pack(MAGIC, CIPHERS[self.cipher], self.block_size, size, self.key_id, salt)
+
+    def read_header(self, fd, filename):
+        # the fields and the bytes of the header as stored, the blocks authenticate these bytes
+        # whatever encryption_block_size is set now
+        header = os.pread(fd, HEADER.size, 0).ljust(HEADER.size, b"\0")
+        magic, cipher, block_size, size, key_id, salt = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError("%s is not an encrypted backup" % filename)
+        if cipher != CIPHERS[self.cipher] or key_id != self.key_id:
+            raise ValueError("%s was encrypted with another cipher or key" % filename)
+        if block_size < MIN_BLOCK:
+            raise ValueError("%s has an invalid block size %d" % (filename, block_size))
+        return block_size, size, salt, header
+
+    def decrypt_block(self, header, salt, index, data, filename):
+        try:
+            return self.aead.decrypt(salt + struct.pack(">I", index), data, header)
+        except InvalidTag:
+            raise ValueError("Block %d of %s is corrupted" % (index, filename))
+
+    def reader(self, filename, read_ahead=READ_AHEAD):
+        # the plaintext blocks in order, read ahead and decrypted by the threads of the reader
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            block_size, size, salt, header = self.read_header(fd, filename)
+            stored = os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+        record = block_size + TAG_SIZE
+        if stored != HEADER.size + size + -(-size // block_size) * TAG_SIZE:
+            raise ValueError("%s is truncated" % filename)
+
+        def decrypt(offset, data):
+            index = (offset - HEADER.size) // record
+            return self.decrypt_block(header, salt, index, data, filename)
+
+        return ReadAhead(
+            filename,
+            record,
+            window=max(read_ahead, record),
+            start=HEADER.size,
+            transform=decrypt,
+        )
+
+    def image_info(self, filename):
+        # what qemu-img info tells about the image, read from its first block
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            size = self.read_header(fd, filename)[1]
+        finally:
+            os.close(fd)
+        with self.reader(filename, read_ahead=0) as reader:
+            _, data = reader.read()
+        info = {"filename": filename, "format": "raw", "virtual-size": size}
+        if data[:4] == QCOW2_MAGIC:
+            info["format"] = "qcow2"
+            fields = QCOW2_HEADER.unpack_from(data.ljust(QCOW2_HEADER.size, b"\0"))
+            info["virtual-size"] = fields[5]
+            backing_offset, backing_size = fields[2], fields[3]
+            if backing_offset:
+                name = data[backing_offset : backing_offset + backing_size].decode("utf8")
+                info["backing-filename"] = name
+        return info
+
+
+class EncryptedSink:
+    # download sink writing <file_name>.enc, blocks are encrypted as soon as they are complete
+    # by whichever I/O thread completes them
+
+    def __init__(self, file_name, encryption):
+        self.plain_file_name = file_name
+        self.file_name = file_name + ENCRYPTED_SUFFIX
+        self.tmp_file_name = self.file_name + ".tmp"
+        self.encryption = encryption
+        self.block_size = encryption.block_size
+        self.salt = os.urandom(8)
+        self.header = None
+        self.total = None
+        self.partial = {}
+        self.lock = threading.Lock()
+        self.fd = None
+        self.bytes = 0
+        self.t0 = None
+        self.error = None
+
+    def open(self):
+        self.t0 = time.monotonic()
+        self.fd = os.open(self.tmp_file_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+
+    def truncate(self, size):
+        self.total = size
+        self.header = self.encryption.header(size, self.salt)
+        os.pwrite(self.fd, self.header, 0)
+        blocks = -(-size // self.block_size)
+        os.ftruncate(self.fd, HEADER.size + size + blocks * TAG_SIZE)
+
+    def block_length(self, index):
+        return min(self.block_size, self.total - index * self.block_size)
+
+    def write(self, data, offset):
+        if self.header is None:
+            raise ValueError("Encrypted downloads need the size of the image")
+        view = memoryview(data)
+        while view:
+            index = offset // self.block_size
+            position = offset % self.block_size
+            length = min(len(view), self.block_size - position)
+            if position == 0 and length == self.block_length(index):
+                self.store(index, view[:length])
+            else:
+                with self.lock:
+                    if index not in self.partial:
+                        self.partial[index] = [bytearray(self.block_length(index)), 0]
+                    block = self.partial[index]
+                    block[0][position : position + length] = view[:length]
+                    block[1] += length
+                    complete = block[1] >= len(block[0])
+                    if complete:
+                        del self.partial[index]
+                if complete:
+                    self.store(index, block[0])
+            view = view[length:]
+            offset += length
+        with self.lock:
+            self.bytes += len(data)
+
+    def store(self, index, data):
+        nonce = self.salt + struct.pack(">I", index)
+        encrypted = self.encryption.aead.encrypt(nonce, bytes(data), self.header)
+        os.pwrite(self.fd, encrypted, HEADER.size + index * (self.block_size + TAG_SIZE))
+
+    def close(self, success=True):
+        if self.fd is None:
+            return
+        os.close(self.fd)
+        self.fd = None
+        if self.partial and self.error is None:
+            self.error = "%d block(s) of %s were never completed" % (
+                len(self.partial),
+                self.file_name,
+            )
+        if success and self.error is None:
+            # the plaintext of an older backup must not stay next to the encrypted one
+            for name in [self.file_name, self.plain_file_name]:
+                if os.path.isfile(name):
+                    os.remove(name)
+            os.rename(self.tmp_file_name, self.file_name)
+
+    def results(self):
+        return [self.result()]
+
+    def result(self):
+        duration = time.monotonic() - self.t0 if self.t0 else 0
+        return {
+            "path": self.file_name,
+            "completed": self.error is None,
+            "bytes": self.bytes,
+            "throughput": self.bytes / duration if duration else 0,
+            "max_lag": 0,
+            "error": self.error,
+        }
+
+
+def encryption_cipher(params):
+    cipher = params.get("encryption", "no").strip().lower()
+    return None if cipher in ["", "no", "off", "false"] else cipher
+
+
+def encryption_from_params(params):
+    cipher = encryption_cipher(params)
+    if cipher is None:
+        return None
+    if not params.get("encryption_key_file") and not params.get("encryption_key_command"):
+        raise ValueError("encryption needs encryption_key_file or encryption_key_command")
+    key = read_key(params.get("encryption_key_file"), params.get("encryption_key_command"))
+    return Encryption(
+        key,
+        cipher=cipher,
+        block_size=int(params.get("encryption_block_size", ENCRYPTION_BLOCK)),
+    )
@@ -0,0 +1,150 @@
+import threading
+import time
+from collections import Counter
+
+from throttle import Throttle, API
+
+API_CONCURRENCY = 4
+API_CACHE_TTL = 1
+CACHE_ENTRIES = 1000
+READ_CALLS = ["get", "list"]
+
+
+class PendingCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.stale = False
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def overlaps(read_path, write_path):
+    # a write may change its own object, the objects below it and the collections above it,
+    # e.g. adding a snapshot changes the snapshots of the VM, the VM and the list of VMs
+    read_path, write_path = read_path[:2], write_path[:2]
+    return read_path == write_path[: len(read_path)] or write_path == read_path[: len(write_path)]
+
+
+class EngineApi:
+    # every engine request of a handler goes through here: at most concurrency requests at a time
+    # and the api budget of the throttle per second. Identical reads in flight are sent once and
+    # their result is kept for cache_ttl seconds, until a write on an overlapping path.
+
+    def __init__(self, concurrency=API_CONCURRENCY, cache_ttl=API_CACHE_TTL, throttle=None):
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.cache_ttl = cache_ttl
+        self.throttle = throttle or Throttle()
+        self.lock = threading.Lock()
+        self.cache = {}
+        self.in_flight = {}
+        self.calls = Counter()
+        self.cached = Counter()
+        self.coalesced = Counter()
+
+    def service(self, service):
+        return ServiceProxy(self, service)
+
+    def request(self, operation, method, args, kwargs):
+        with self.slots:
+            self.throttle.wait(API, 1)
+            with self.lock:
+                self.calls[operation] += 1
+            return method(*args, **kwargs)
+
+    def call(self, operation, key, method, args, kwargs, fresh=False):
+        # fresh reads (status polls) are always sent, they neither use nor fill the cache
+        if fresh:
+            return self.request(operation, method, args, kwargs)
+        if key[1] not in READ_CALLS:
+            try:
+                return self.request(operation, method, args, kwargs)
+            finally:
+                self.invalidate(key[0])
+
+        owner = False
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry and entry[0] > time.monotonic():
+                self.cached[operation] += 1
+                return entry[1]
+            pending = self.in_flight.get(key)
+            if pending is not None:
+                self.coalesced[operation] += 1
+            else:
+                pending = self.in_flight[key] = PendingCall()
+                owner = True
+        if not owner:
+            return pending.wait()
+
+        try:
+            pending.result = self.request(operation, method, args, kwargs)
+            return pending.result
+        except Exception as exc:
+            pending.error = exc
+            raise
+        finally:
+            with self.lock:
+                if self.in_flight.get(key) is pending:
+                    del self.in_flight[key]
+                # a read that overlapped a write may have seen the old state, it is not kept
+                if pending.error is None and not pending.stale and self.cache_ttl:
+                    self.store(key, pending.result)
+            pending.done.set()
+
+    def store(self, key, result):
+        now = time.monotonic()
+        if len(self.cache) >= CACHE_ENTRIES:
+            self.cache = dict([(k, v) for k, v in self.cache.items() if v[0] > now])
+        self.cache[key] = (now + self.cache_ttl, result)
+
+    def invalidate(self, path):
+        with self.lock:
+            for key in [x for x in self.cache if overlaps(x[0], path)]:
+                del self.cache[key]
+            for key in [x for x in self.in_flight if overlaps(x[0], path)]:
+                self.in_flight.pop(key).stale = True
+
+    def statistics(self):
+        with self.lock:
+            return {
+                "calls": dict(self.calls),
+                "cached": dict(self.cached),
+                "coalesced": dict(self.coalesced),
+            }
+
+
+class ServiceProxy:
+    # stands for an SDK service. Locators (vm_service(id), snapshots_service()...) only extend
+    # the path, every other method is a request sent through the EngineApi. fresh=True sends
+    # a read past the cache, e.g. get(fresh=True) when polling a status.
+
+    def __init__(self, api, service, path=()):
+        self._api = api
+        self._service = service
+        self._path = path
+
+    def __getattr__(self, name):
+        attribute = getattr(self._service, name)
+        if not callable(attribute):
+            return attribute
+        if name.endswith("_service"):
+
+            def locate(*args):
+                step = (name[: -len("_service")],) + args
+                return ServiceProxy(self._api, attribute(*args), self._path + (step,))
+
+            return locate
+
+        operation = "%s.%s" % (self._path[-1][0] if self._path else "system", name)
+
+        def call(*args, fresh=False, **kwargs):
+            key = (self._path, name, repr(args), repr(sorted(kwargs.items())))
+            return self._api.call(operation, key, attribute, args, kwargs, fresh=fresh)
+
+        return call
@@ -0,0 +1,56 @@
+import fcntl
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+FREEZE_TIMEOUT = 60
+FREEZE_POLL_INTERVAL = 0.2
+FREEZE_SPACING = 10
+
+gates = {}
+gates_lock = threading.Lock()
+
+
+class FreezeGate:
+    # only one guest is frozen at a time and consecutive freezes start at least spacing seconds
+    # apart, so that snapshots of a whole fleet do not hit the storage together. With a
+    # lock_file the gate is shared by every process using the same file.
+
+    def __init__(self, spacing=FREEZE_SPACING, lock_file=None):
+        self.spacing = spacing
+        self.lock_file = lock_file
+        self.lock = threading.Lock()
+        self.last = 0
+
+    @contextmanager
+    def slot(self):
+        with self.lock:
+            fd = None
+            last = self.last
+            if self.lock_file:
+                fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                last = float(os.read(fd, 64) or 0)
+            try:
+                delay = last + self.spacing - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                # the spacing counts from the start of the freeze
+                self.last = time.time()
+                yield
+            finally:
+                if fd is not None:
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    os.ftruncate(fd, 0)
+                    os.write(fd, b"%f" % self.last)
+                    os.close(fd)
+
+
+def freeze_gate(spacing=FREEZE_SPACING, lock_file=None):
+    # jobs of the same process share one gate per lock file
+    with gates_lock:
+        if lock_file not in gates:
+            gates[lock_file] = FreezeGate(spacing=spacing, lock_file=lock_file)
+        gates[lock_file].spacing = spacing
+        return gates[lock_file]
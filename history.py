@@ -0,0 +1,140 @@
+import fcntl
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from throttle import parse_minutes
+
+HISTORY_FILE = "savior_history.jsonl"
+HISTORY_RUNS = 10
+DEFAULT_THROUGHPUT = 50e6
+
+history_lock = threading.Lock()
+
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
+class History:
+    # one JSON line per finished job. The effective throughput of a run is the actual size of
+    # the disks divided by the whole job duration, so it includes snapshots, polling and
+    # every other overhead of the job.
+
+    def __init__(self, filename=HISTORY_FILE, runs=HISTORY_RUNS):
+        self.filename = filename
+        self.runs = runs
+
+    def record(
+        self,
+        vm_name,
+        mode,
+        duration,
+        actual_size=None,
+        storage_domain=None,
+        bytes=None,
+        success=True,
+    ):
+        entry = {
+            "time": time.time(),
+            "vm": vm_name,
+            "mode": mode,
+            "storage_domain": storage_domain,
+            "actual_size": actual_size,
+            "bytes": bytes,
+            "duration": duration,
+            "throughput": actual_size / duration if actual_size and duration else None,
+            "success": success,
+        }
+        with history_lock:
+            with open(self.filename, "a") as f:
+                # appends of concurrent processes must not interleave
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.write(json.dumps(entry) + "\n")
+        return entry
+
+    def entries(self, **match):
+        if not os.path.isfile(self.filename):
+            return []
+        entries = []
+        with open(self.filename) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if not entry.get("success"):
+                    continue
+                if all([entry.get(k) == v for k, v in match.items()]):
+                    entries.append(entry)
+        return entries[-self.runs :]
+
+    def last_runs(self):
+        # the last run of every VM and mode, failed runs included
+        runs = {}
+        if not os.path.isfile(self.filename):
+            return runs
+        with open(self.filename) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                runs[(entry.get("vm"), entry.get("mode"))] = entry
+        return runs
+
+    def throughput(self, vm_name, mode, storage_domain=None):
+        # the runs of the VM first, then of its storage domain, then of every job of the mode
+        for match in [
+            {"vm": vm_name, "mode": mode},
+            {"storage_domain": storage_domain, "mode": mode} if storage_domain else None,
+            {"mode": mode},
+        ]:
+            if match is None:
+                continue
+            values = [x["throughput"] for x in self.entries(**match) if x.get("throughput")]
+            if values:
+                return median(values)
+        return None
+
+    def predict(self, vm_name, mode, actual_size=None, storage_domain=None):
+        if actual_size:
+            throughput = self.throughput(vm_name, mode, storage_domain) or DEFAULT_THROUGHPUT
+            return actual_size / throughput
+        durations = [x["duration"] for x in self.entries(vm=vm_name, mode=mode)]
+        return median(durations) or 0
+
+    def statistics(self, vm_name, mode):
+        entries = self.entries(vm=vm_name, mode=mode)
+        return {
+            "runs": len(entries),
+            "duration": median([x["duration"] for x in entries]),
+            "throughput": median([x["throughput"] for x in entries if x.get("throughput")]),
+        }
+
+
+def window_deadline(window, now=None):
+    # end of a "22:00-06:00" backup window as a timestamp, the next one when already past
+    if not window:
+        return None
+    now = now or datetime.now()
+    end = parse_minutes(window.split("-")[-1].strip())
+    deadline = now.replace(hour=end // 60, minute=end % 60, second=0, microsecond=0)
+    if deadline <= now:
+        deadline += timedelta(days=1)
+    return deadline.timestamp()
+
+
+def job_size(sizes):
+    # total actual size of a VM and the storage domain holding most of it
+    if not sizes:
+        return None, None
+    return sum(sizes.values()), max(sizes, key=sizes.get)
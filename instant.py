@@ -0,0 +1,160 @@
+import os
+import signal
+import socket
+import subprocess
+import time
+
+from backup_lib import qemu_chains, qemu_info, qemu_create_overlay
+from savior_logging import main_logger
+
+NBD_STARTUP_TIMEOUT = 30
+NBD_SHARED_CLIENTS = 8
+NBD_POLL_INTERVAL = 1
+
+
+class NbdExport:
+    # one qemu-nbd process per disk chain. The backup files are only read, every write of the
+    # clients lands in a local qcow2 overlay on top of the last layer of the chain.
+
+    def __init__(self, image_id, top_file, run_directory, host=None, port=None, copy_on_read=False):
+        self.image_id = image_id
+        self.top_file = os.path.abspath(top_file)
+        self.overlay = os.path.join(run_directory, "%s.overlay.qcow2" % image_id)
+        self.log_file = os.path.join(run_directory, "%s.nbd.log" % image_id)
+        self.socket = None if port else os.path.join(run_directory, "%s.sock" % image_id)
+        self.host = host or "localhost"
+        self.port = port
+        self.copy_on_read = copy_on_read
+        self.process = None
+
+    def url(self):
+        if self.port:
+            return "nbd://%s:%d/%s" % (self.host, self.port, self.image_id)
+        return "nbd+unix:///%s?socket=%s" % (self.image_id, self.socket)
+
+    def command(self):
+        command = [
+            "qemu-nbd",
+            "--persistent",
+            "--shared=%d" % NBD_SHARED_CLIENTS,
+            "--export-name=%s" % self.image_id,
+            # the page cache keeps hot blocks of the repository in memory
+            "--cache=writeback",
+            "--discard=unmap",
+            "--detect-zeroes=unmap",
+        ]
+        if self.port:
+            command += ["--bind=%s" % self.host, "--port=%d" % self.port]
+        else:
+            command += ["--socket=%s" % self.socket]
+        if self.copy_on_read:
+            # blocks read from the repository are also kept in the local overlay
+            command += [
+                "--image-opts",
+                "driver=copy-on-read,file.driver=qcow2,file.file.driver=file,"
+                "file.file.filename=%s" % self.overlay.replace(",", ",,"),
+            ]
+        else:
+            command += ["--format=qcow2", self.overlay]
+        return command
+
+    def start(self):
+        # a new overlay every time, writes of a previous export are discarded
+        if os.path.exists(self.overlay):
+            os.remove(self.overlay)
+        if self.socket and os.path.exists(self.socket):
+            os.remove(self.socket)
+        backing_format = qemu_info(self.top_file)["format"]
+        qemu_create_overlay(self.overlay, self.top_file, backing_format)
+
+        with open(self.log_file, "w") as log:
+            self.process = subprocess.Popen(
+                self.command(), stdout=subprocess.DEVNULL, stderr=log, start_new_session=True
+            )
+        self.wait_ready()
+
+    def ready(self):
+        if self.socket:
+            return os.path.exists(self.socket)
+        try:
+            with socket.create_connection((self.host, self.port), timeout=1):
+                return True
+        except OSError:
+            return False
+
+    def wait_ready(self):
+        deadline = time.monotonic() + NBD_STARTUP_TIMEOUT
+        while not self.ready():
+            if self.process.poll() is not None:
+                with open(self.log_file) as log:
+                    error = log.read().strip()
+                raise ValueError("qemu-nbd for %s failed: %s" % (self.image_id, error))
+            if time.monotonic() > deadline:
+                self.stop()
+                raise ValueError("qemu-nbd for %s did not start" % self.image_id)
+            time.sleep(0.1)
+
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def stop(self):
+        if not self.running():
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=NBD_STARTUP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+class InstantExport:
+    # exports every disk chain of a backup directory, so that a VM can be inspected or booted
+    # straight from the repository while a full restore may run in the meantime
+
+    def __init__(self, directory, run_directory, host=None, port=None, copy_on_read=False):
+        self.directory = directory
+        self.run_directory = run_directory
+        self.host = host
+        self.port = port
+        self.copy_on_read = copy_on_read
+        self.exports = []
+
+    def start(self):
+        chains = qemu_chains(self.directory)
+        if not chains:
+            raise ValueError("No disk images found in %s" % self.directory)
+        try:
+            for i, (image_id, chain) in enumerate(sorted(chains.items())):
+                export = NbdExport(
+                    image_id,
+                    os.path.join(self.directory, chain[-1]),
+                    self.run_directory,
+                    host=self.host,
+                    port=self.port + i if self.port else None,
+                    copy_on_read=self.copy_on_read,
+                )
+                main_logger.debug("Starting %s" % " ".join(export.command()))
+                export.start()
+                self.exports.append(export)
+        except Exception:
+            self.stop()
+            raise
+        return self.exports
+
+    def wait(self):
+        # serves until interrupted or until one of the qemu-nbd processes dies
+        previous = signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            while all([x.running() for x in self.exports]):
+                time.sleep(NBD_POLL_INTERVAL)
+            stopped = [x.image_id for x in self.exports if not x.running()]
+            raise ValueError("qemu-nbd stopped for %s" % ", ".join(stopped))
+        except KeyboardInterrupt:
+            main_logger.info("Instant restore interrupted, stopping the exports")
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+
+    def stop(self):
+        for export in self.exports:
+            export.stop()
@@ -0,0 +1,325 @@
+import argparse
+import configparser
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+
+from ovirtsavior import SaviorJob, connect_handler, config_params
+from recovery import BulkRestore
+from savior_logging import main_logger, setup_logging, close_job_log
+from scheduler import Job, Scheduler, SUCCESS, FAILED
+from simulator import (
+    Simulator,
+    SIM_VMS,
+    SIM_SEED,
+    SIM_SPARSITY,
+    SIM_STORAGE_DOMAINS,
+    API_LATENCY,
+    SNAPSHOT_DELAY,
+    TRANSFER_DELAY,
+    DISK_DELAY,
+)
+from throttle import parse_rate
+
+LOAD_MODES = ["backuptemp", "backup", "restore", "recover"]
+DEFAULT_MODES = ["backuptemp", "backup", "restore"]
+LOAD_JOBS = 4
+LOAD_TIERS = 3
+RESTORED_SUFFIX = "-restored"
+RECOVERED_SUFFIX = "-recovered"
+PHASE_POLL_INTERVAL = 0.5
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Runs fleet backups and restores against a simulated engine and imageio."
+    )
+    parser.add_argument(
+        "-s",
+        "--setup_file",
+        metavar="setupfile",
+        help="setup file whose transfer, throttle and other options are used by the jobs.",
+    )
+    parser.add_argument(
+        "--modes",
+        default=",".join(DEFAULT_MODES),
+        help="comma separated phases among %s, each one runs a job per VM (default"
+        " %%(default)s)." % ", ".join(LOAD_MODES),
+    )
+    parser.add_argument("--vms", type=int, default=SIM_VMS, help="number of simulated VMs.")
+    parser.add_argument("--disks", default="1-3", help="range of disks per VM.")
+    parser.add_argument("--disk_size", default="64M-1G", help="range of the disk sizes.")
+    parser.add_argument(
+        "--sparsity", type=float, default=SIM_SPARSITY, help="mean fraction of unallocated data."
+    )
+    parser.add_argument("--storage_domains", type=int, default=SIM_STORAGE_DOMAINS)
+    parser.add_argument("--max_jobs", type=int, default=LOAD_JOBS, help="jobs run in parallel.")
+    parser.add_argument("--seed", type=int, default=SIM_SEED)
+    parser.add_argument("--api_latency", type=float, default=API_LATENCY)
+    parser.add_argument("--snapshot_delay", type=float, default=SNAPSHOT_DELAY)
+    parser.add_argument("--transfer_delay", type=float, default=TRANSFER_DELAY)
+    parser.add_argument("--disk_delay", type=float, default=DISK_DELAY)
+    parser.add_argument("--api_failures", type=float, default=0, help="failing API calls.")
+    parser.add_argument("--snapshot_failures", type=float, default=0, help="failing snapshots.")
+    parser.add_argument(
+        "--transfer_failures", type=float, default=0, help="transfers failing half way."
+    )
+    parser.add_argument(
+        "--request_failures", type=float, default=0, help="dropped imageio requests."
+    )
+    parser.add_argument(
+        "--directory",
+        help="backup and restore directory, a temporary one is used and removed by default.",
+    )
+    parser.add_argument("--log_directory", help="enables the logs of the jobs.")
+    parser.add_argument("--report", help="also writes the report as JSON to this file.")
+    return vars(parser.parse_args())
+
+
+def parse_range(value, parse=int):
+    # "1-3" or "64M-1G", a single value is a fixed size
+    low, _, high = value.partition("-")
+    return parse(low), parse(high or low)
+
+
+def write_setup_file(directory, simulator, base_file=None):
+    # every job reads the same setup file, vm_name is given per job
+    config = configparser.ConfigParser(interpolation=None)
+    if base_file:
+        config.read(base_file)
+    defaults = {
+        "TRANSFER": {"chunk_size": "1048576"},
+        "SNAPSHOT": {"backup_snapshot_description": "loadtest"},
+    }
+    values = {
+        "CONNECTION": {
+            "ovirt_url": simulator.engine.base_url,
+            "username": "simulator",
+            "password": "simulator",
+            "ca_file": "",
+        },
+        "DIRECTORIES": {
+            "working_directory": os.path.join(directory, "backups"),
+            "local_directory": os.path.join(directory, "restore"),
+            "history_file": os.path.join(directory, "savior_history.jsonl"),
+        },
+        "VM": {"vm_name": "simulated"},
+        "MAIL": {},
+        "SSH": {"ssh_ip": "", "ssh_username": "", "ssh_password": ""},
+        "RESTORATION": {
+            "storage_domain": simulator.engine.storage_domains[0].name,
+            "cluster_name": "Default",
+            "template": "Blank",
+            "new_vm_name": "simulated",
+        },
+    }
+    for options, overwrite in [(defaults, False), (values, True)]:
+        for section, section_options in options.items():
+            if not config.has_section(section):
+                config.add_section(section)
+            for key, value in section_options.items():
+                if overwrite or not config.has_option(section, key):
+                    config.set(section, key, value)
+    for option in ["working_directory", "local_directory"]:
+        os.makedirs(config.get("DIRECTORIES", option), exist_ok=True)
+
+    setup_file = os.path.join(directory, "loadtest.ini")
+    with open(setup_file, "w") as f:
+        config.write(f)
+    return setup_file, config_params(config)
+
+
+def usage():
+    # cpu seconds and peak resident memory of the process, simulator included
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss * 1024
+
+
+def run_recovery(oh, params, directory, vm_names, max_jobs):
+    # one bulk restore of the whole fleet, the VMs spread over the tiers
+    restore_list = os.path.join(directory, "restore.list")
+    with open(restore_list, "w") as f:
+        for i, vm_name in enumerate(vm_names):
+            f.write("%s %d %s\n" % (vm_name, i % LOAD_TIERS, vm_name + RECOVERED_SUFFIX))
+    restore = BulkRestore(dict(params, restore_list=restore_list, restore_jobs=max_jobs), oh)
+    report = restore.run()
+    return [x.job for x in restore.vms], report["time_to_full_recovery"]
+
+
+def run_phase(oh, mode, setup_file, vm_names, max_jobs):
+    def run_job(job):
+        savior_job = SaviorJob(job.mode, job.setup_file, oh=oh, vm_name=job.vm_name)
+        if mode == "restore":
+            savior_job.params["new_vm_name"] = job.vm_name + RESTORED_SUFFIX
+        try:
+            savior_job.execute()
+        finally:
+            savior_job.close()
+            close_job_log(savior_job.log_file)
+
+    scheduler = Scheduler(run_job, max_jobs=max_jobs)
+    scheduler.start()
+    jobs = [scheduler.submit(Job(mode, setup_file, vm_name=x)) for x in vm_names]
+    while any([x.state not in (SUCCESS, FAILED) for x in jobs]):
+        time.sleep(PHASE_POLL_INTERVAL)
+    scheduler.stop()
+    return jobs
+
+
+def phase_report(mode, jobs, duration, cpu, peak_memory, calls, imageio, cached, coalesced):
+    failed = [x for x in jobs if x.state == FAILED]
+    transferred = sum([x.bytes for x in jobs])
+    return {
+        "mode": mode,
+        "jobs": len(jobs),
+        "failed": len(failed),
+        "errors": {x.vm_name: x.error for x in failed},
+        "duration": duration,
+        "bytes": transferred,
+        "throughput": transferred / duration if duration else 0,
+        "job_duration_max": max([x.duration() for x in jobs] or [0]),
+        "cpu": cpu,
+        "peak_memory": peak_memory,
+        "api_calls": dict(calls),
+        "api_calls_total": sum(calls.values()),
+        "api_cached": dict(cached),
+        "api_cached_total": sum(cached.values()),
+        "api_coalesced": dict(coalesced),
+        "api_coalesced_total": sum(coalesced.values()),
+        "imageio": dict(imageio),
+    }
+
+
+def print_report(report):
+    fleet = report["fleet"]
+    print(
+        "Fleet: %d VMs, %d disks, %.1f GB provisioned, %.1f GB allocated"
+        % (
+            fleet["vms"],
+            fleet["disks"],
+            fleet["provisioned_size"] / 1e9,
+            fleet["actual_size"] / 1e9,
+        )
+    )
+    for phase in report["phases"]:
+        print(
+            "%-10s %4d jobs, %3d failed, %8.1f s, %8.1f MB/s, %6d API calls (%d cached,"
+            " %d coalesced), %7.1f s cpu, peak memory %.0f MB"
+            % (
+                phase["mode"],
+                phase["jobs"],
+                phase["failed"],
+                phase["duration"],
+                phase["throughput"] / 1e6,
+                phase["api_calls_total"],
+                phase["api_cached_total"],
+                phase["api_coalesced_total"],
+                phase["cpu"],
+                phase["peak_memory"] / 1e6,
+            )
+        )
+        for name, count in sorted(phase["api_calls"].items(), key=lambda x: -x[1]):
+            print(
+                "    %-24s %d, %d cached, %d coalesced"
+                % (
+                    name,
+                    count,
+                    phase["api_cached"].get(name, 0),
+                    phase["api_coalesced"].get(name, 0),
+                )
+            )
+        if phase.get("time_to_full_recovery") is not None:
+            print("    full recovery in %.1f s" % phase["time_to_full_recovery"])
+        for vm_name, error in sorted(phase["errors"].items()):
+            print("    failed %s: %s" % (vm_name, error))
+    print("Total %.1f s, %.1f s cpu" % (report["duration"], report["cpu"]))
+
+
+def run_loadtest(v):
+    for mode in v["modes"].split(","):
+        if mode not in LOAD_MODES:
+            raise ValueError("Unknown mode %s, expected one of %s" % (mode, ", ".join(LOAD_MODES)))
+    simulator = Simulator(
+        vms=v["vms"],
+        disks=parse_range(v["disks"]),
+        disk_size=parse_range(v["disk_size"], lambda x: int(parse_rate(x))),
+        sparsity=v["sparsity"],
+        storage_domains=v["storage_domains"],
+        seed=v["seed"],
+        api_latency=v["api_latency"],
+        snapshot_delay=v["snapshot_delay"],
+        transfer_delay=v["transfer_delay"],
+        disk_delay=v["disk_delay"],
+        api_failures=v["api_failures"],
+        snapshot_failures=v["snapshot_failures"],
+        transfer_failures=v["transfer_failures"],
+        request_failures=v["request_failures"],
+    ).start()
+    directory = v["directory"] or tempfile.mkdtemp(prefix="savior-loadtest-")
+    vm_names = sorted([x.name for x in simulator.engine.vms.values()])
+    report = {"fleet": simulator.engine.fleet_size(), "phases": []}
+
+    oh = None
+    started = time.monotonic()
+    cpu_started = usage()[0]
+    try:
+        setup_file, params = write_setup_file(directory, simulator, v["setup_file"])
+        oh = connect_handler(params, connection=simulator.connection())
+        for mode in v["modes"].split(","):
+            main_logger.info("Load test: %s of %d VMs" % (mode, len(vm_names)))
+            phase_started = time.monotonic()
+            cpu = usage()[0]
+            calls = Counter(simulator.engine.calls)
+            imageio = Counter(simulator.server.counters)
+            cached = Counter(oh.api.cached)
+            coalesced = Counter(oh.api.coalesced)
+            recovery = None
+            if mode == "recover":
+                jobs, recovery = run_recovery(oh, params, directory, vm_names, v["max_jobs"])
+            else:
+                jobs = run_phase(oh, mode, setup_file, vm_names, v["max_jobs"])
+            phase = phase_report(
+                mode,
+                jobs,
+                time.monotonic() - phase_started,
+                usage()[0] - cpu,
+                usage()[1],
+                simulator.engine.calls - calls,
+                simulator.server.counters - imageio,
+                oh.api.cached - cached,
+                oh.api.coalesced - coalesced,
+            )
+            if mode == "recover":
+                phase["time_to_full_recovery"] = recovery
+            report["phases"].append(phase)
+    finally:
+        if oh is not None:
+            oh.close()
+        simulator.stop()
+        if not v["directory"]:
+            shutil.rmtree(directory, ignore_errors=True)
+    report["duration"] = time.monotonic() - started
+    report["cpu"] = usage()[0] - cpu_started
+    report["peak_memory"] = usage()[1]
+    return report
+
+
+if __name__ == "__main__":
+    v = parse_arguments()
+    if v["log_directory"]:
+        setup_logging(log_directory=v["log_directory"])
+    try:
+        report = run_loadtest(v)
+    except Exception as exc:
+        main_logger.error(exc, exc_info=exc)
+        sys.exit(1)
+    print_report(report)
+    if v["report"]:
+        with open(v["report"], "w") as f:
+            json.dump(report, f, indent=1)
+    sys.exit(1 if any([x["failed"] for x in report["phases"]]) else 0)
@@ -13,7 +13,8 @@ def send_mail(sender = None,
              server = None,
              password = None,
              attachmentFile = None,
-             replaceWith = None):
+             replaceWith = None,
+             appendix = None):
 
     message = MIMEMultipart()
     message['From'] = sender
@@ -28,6 +29,10 @@ def send_mail(sender = None,
 
     message['Subject'] = subject
 
+    # e.g. the profile summary of the job, after the body of the template
+    if appendix:
+        mail_content += "\n\n" + appendix
+
 
     message.attach(MIMEText(mail_content, 'plain'))
     if attachmentFile:
@@ -50,9 +55,55 @@ def send_mail(sender = None,
 
         message.attach(part)
 
-    text = message.as_string()
-    s = smtplib.SMTP(server, port)
-    s.starttls()
-    s.login(sender, password)
-    s.sendmail(sender, to, text)
-    s.quit()
+    mailer = Mailer(server, port, sender, password)
+    try:
+        mailer.send(to, message)
+    finally:
+        mailer.close()
+
+
+class Mailer:
+    # one SMTP session for several mails, opened with the first one
+    def __init__(self, server, port, sender, password):
+        self.server = server
+        self.port = port
+        self.sender = sender
+        self.password = password
+        self.smtp = None
+
+    def connect(self):
+        # the session is kept only once it is authenticated
+        smtp = smtplib.SMTP(self.server, self.port)
+        try:
+            smtp.starttls()
+            smtp.login(self.sender, self.password)
+        except Exception:
+            smtp.close()
+            raise
+        self.smtp = smtp
+
+    def send(self, to, message):
+        text = message.as_string()
+        # the server may have dropped the session while it was idle, it is opened again once
+        for attempt in range(2):
+            if self.smtp is None:
+                self.connect()
+            try:
+                self.smtp.sendmail(self.sender, to, text)
+                return
+            except smtplib.SMTPServerDisconnected:
+                self.smtp = None
+                if attempt == 1:
+                    raise
+            except (smtplib.SMTPException, OSError):
+                # the next mail starts over with a new session
+                self.close()
+                raise
+
+    def close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.smtp = None
@@ -0,0 +1,301 @@
+import errno
+import fcntl
+import os
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from catalog import catalog_vms
+from delta import block_digest, BLOCK_SIZE
+from readahead import ReadAhead, read_ahead_size, mount_of
+from savior_logging import main_logger
+from throttle import Throttle, DISK
+
+SYNC_WORKERS = 4
+MANIFEST_DIRECTORY = ".blocks"
+MANIFEST_MAGIC = b"SAVSYNC1"
+# magic, block size, source size and mtime, destination size and mtime
+MANIFEST_HEADER = struct.Struct(">8sIQqQq")
+DIGEST_SIZE = 16
+STAGED_SUFFIX = ".sync"
+CLONE_CHUNK = 1024 * 1024 * 64
+# ioctl sharing the extents of a file, on XFS, btrfs and other reflink file systems
+FICLONE = 0x40049409
+
+
+def read_manifest(filename):
+    # block size, source and destination stats and the digest of every block, None when missing
+    try:
+        with open(filename, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    if len(data) < MANIFEST_HEADER.size or data[:8] != MANIFEST_MAGIC:
+        return None
+    fields = MANIFEST_HEADER.unpack_from(data)
+    body = data[MANIFEST_HEADER.size :]
+    digests = [body[x : x + DIGEST_SIZE] for x in range(0, len(body), DIGEST_SIZE)]
+    return {
+        "block_size": fields[1],
+        "source": (fields[2], fields[3]),
+        "destination": (fields[4], fields[5]),
+        "digests": digests,
+    }
+
+
+def write_manifest(filename, block_size, source, destination, digests):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    header = MANIFEST_HEADER.pack(MANIFEST_MAGIC, block_size, *(source + destination))
+    with open(filename + STAGED_SUFFIX, "wb") as f:
+        f.write(header + b"".join(digests))
+    os.rename(filename + STAGED_SUFFIX, filename)
+
+
+def file_stat(filename):
+    stat = os.stat(filename)
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def server_side_copy(path):
+    # copy_file_range is done by the server only on NFS 4.2, elsewhere the kernel reads and
+    # writes the whole data itself
+    fstype, options = mount_of(path)
+    options = options.split(",")
+    return fstype == "nfs4" and ("vers=4.2" in options or "minorversion=2" in options)
+
+
+def clone_file(source, dest, size):
+    # the bytes copied through this host, none when the extents are shared (reflink) or NFS 4.2
+    # copies on the server. Anywhere else (e.g. an rclone mount) the previous copy is sent again.
+    with open(source, "rb") as src, open(dest, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return 0
+        except OSError:
+            pass
+        offset = 0
+        try:
+            while offset < size:
+                chunk = os.copy_file_range(
+                    src.fileno(), dst.fileno(), min(CLONE_CHUNK, size - offset), offset, offset
+                )
+                if not chunk:
+                    break
+                offset += chunk
+        except (AttributeError, OSError) as exc:
+            if isinstance(exc, OSError) and exc.errno not in [
+                errno.EXDEV,
+                errno.ENOSYS,
+                errno.EINVAL,
+                errno.EOPNOTSUPP,
+            ]:
+                raise
+        copied = 0 if server_side_copy(dest) else offset
+        while offset < size:
+            data = os.pread(src.fileno(), CLONE_CHUNK, offset)
+            if not data:
+                break
+            os.pwrite(dst.fileno(), data, offset)
+            offset += len(data)
+            copied += len(data)
+        return copied
+
+
+class OffsiteSync:
+    # Keeps a second copy of the backup repository up to date. The digest of every block of the
+    # destination files is kept in <destination>/.blocks, a changed file is read once and only
+    # the blocks whose digest changed are written. Each file is staged next to its destination
+    # as a clone of the previous copy, patched and renamed over it once every file of the VM
+    # is ready, the VM information last.
+
+    def __init__(
+        self,
+        source,
+        destination,
+        block_size=BLOCK_SIZE,
+        workers=SYNC_WORKERS,
+        throttle=None,
+        read_ahead="auto",
+    ):
+        self.source = source
+        self.destination = destination
+        self.block_size = block_size
+        self.workers = workers
+        self.throttle = throttle or Throttle()
+        self.read_ahead = read_ahead
+        self.results = []
+        self.failed = {}
+
+    def manifest_file(self, vm_name, name):
+        return os.path.join(self.destination, MANIFEST_DIRECTORY, vm_name, name)
+
+    def run(self, vm_names=None):
+        vm_names = vm_names or catalog_vms(self.source)
+        main_logger.info(
+            "Synchronizing %d VM(s) from %s to %s" % (len(vm_names), self.source, self.destination)
+        )
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            staged = {}
+            for vm_name in vm_names:
+                directory = os.path.join(self.source, vm_name)
+                names = sorted(
+                    [x for x in os.listdir(directory) if os.path.isfile(os.path.join(directory, x))]
+                )
+                staged[vm_name] = [executor.submit(self.stage, vm_name, x) for x in names]
+            # the VMs are committed in order while the files of the next ones are staged
+            for vm_name in vm_names:
+                results = []
+                try:
+                    results = [x.result() for x in staged[vm_name]]
+                    self.commit(vm_name, results)
+                    self.results.extend(results)
+                except Exception as exc:
+                    main_logger.error("Sync of %s failed: %s" % (vm_name, exc), exc_info=exc)
+                    self.failed[vm_name] = str(exc)
+                    self.discard(staged[vm_name])
+        return self.report(time.monotonic() - started)
+
+    def stage(self, vm_name, name):
+        source_file = os.path.join(self.source, vm_name, name)
+        dest_file = os.path.join(self.destination, vm_name, name)
+        source_stat = file_stat(source_file)
+        result = {
+            "vm": vm_name,
+            "name": name,
+            "size": source_stat[0],
+            "sent": 0,
+            "copied": 0,
+            "source": source_stat,
+            "staged": None,
+            "digests": None,
+        }
+
+        # digests of the destination from the manifest when it still describes the file
+        old = []
+        manifest = read_manifest(self.manifest_file(vm_name, name))
+        dest_stat = file_stat(dest_file) if os.path.isfile(dest_file) else None
+        if manifest and manifest["block_size"] == self.block_size:
+            if manifest["destination"] == dest_stat:
+                if manifest["source"] == source_stat:
+                    return result
+                old = manifest["digests"]
+        if dest_stat and not old:
+            main_logger.info("Reading the digests of %s" % dest_file)
+            with ReadAhead(dest_file, self.block_size) as reader:
+                old = [block_digest(x) for x in reader]
+
+        os.makedirs(os.path.dirname(dest_file), exist_ok=True)
+        staged = dest_file + STAGED_SUFFIX
+        if dest_stat:
+            result["copied"] = clone_file(dest_file, staged, min(dest_stat[0], source_stat[0]))
+        else:
+            open(staged, "wb").close()
+        result["staged"] = staged
+        digests = []
+        try:
+            with open(staged, "r+b") as f:
+                f.truncate(source_stat[0])
+                window = read_ahead_size(source_file, self.read_ahead)
+                with ReadAhead(source_file, self.block_size, window=window) as reader:
+                    for data in reader:
+                        self.throttle.wait(DISK, len(data))
+                        digest = block_digest(data)
+                        index = len(digests)
+                        if index >= len(old) or old[index] != digest:
+                            os.pwrite(f.fileno(), data, index * self.block_size)
+                            result["sent"] += len(data)
+                        digests.append(digest)
+                os.fsync(f.fileno())
+        except Exception:
+            os.remove(staged)
+            raise
+        result["digests"] = digests
+        main_logger.info(
+            "Staged %s, %d of %d bytes sent" % (dest_file, result["sent"], result["size"])
+        )
+        return result
+
+    def discard(self, futures):
+        # the staged files of a failed VM, the destination keeps its previous copy
+        for future in futures:
+            if future.exception() is None and future.result()["staged"]:
+                if os.path.isfile(future.result()["staged"]):
+                    os.remove(future.result()["staged"])
+
+    def commit(self, vm_name, results):
+        # the VM information goes last, a VM is never described by a newer pickle than its disks
+        directory = os.path.join(self.destination, vm_name)
+        for result in sorted(results, key=lambda x: x["name"].endswith(".pickle")):
+            if not result["staged"]:
+                continue
+            dest_file = os.path.join(directory, result["name"])
+            os.rename(result["staged"], dest_file)
+            write_manifest(
+                self.manifest_file(vm_name, result["name"]),
+                self.block_size,
+                result["source"],
+                file_stat(dest_file),
+                result["digests"],
+            )
+        # images of older chains that are no longer in the source
+        names = [x["name"] for x in results]
+        for name in os.listdir(directory):
+            if name not in names and not name.endswith(STAGED_SUFFIX):
+                os.remove(os.path.join(directory, name))
+                manifest = self.manifest_file(vm_name, name)
+                if os.path.isfile(manifest):
+                    os.remove(manifest)
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def report(self, duration):
+        size = sum([x["size"] for x in self.results])
+        sent = sum([x["sent"] for x in self.results])
+        # the clones that were not made on the server count as sent too
+        copied = sum([x["copied"] for x in self.results])
+        report = {
+            "files": len(self.results),
+            "changed_files": len([x for x in self.results if x["staged"]]),
+            "bytes": size,
+            "sent": sent,
+            "copied": copied,
+            # blocks sent over a full local copy are counted twice
+            "skipped_ratio": min(1, max(0, 1 - (sent + copied) / size)) if size else 1,
+            "duration": duration,
+            "throughput": size / duration if duration else 0,
+            "send_rate": sent / duration if duration else 0,
+            "failed": self.failed,
+        }
+        main_logger.info(
+            "Sync of %d file(s): %d of %d bytes sent, %d copied (%.1f%% skipped)"
+            " in %.1f s, %.1f MB/s"
+            % (
+                report["files"],
+                sent,
+                size,
+                copied,
+                report["skipped_ratio"] * 100,
+                duration,
+                report["throughput"] / 1e6,
+            )
+        )
+        return report
+
+
+def sync_from_params(params, throttle=None):
+    if not params.get("offsite_directory"):
+        raise ValueError("Did not find any value for parameter offsite_directory")
+    if params.get("s3_bucket"):
+        raise ValueError("Offsite sync copies working_directory, not S3")
+    return OffsiteSync(
+        params["working_directory"],
+        params["offsite_directory"],
+        block_size=int(params.get("sync_block_size", BLOCK_SIZE)),
+        workers=int(params.get("sync_workers", SYNC_WORKERS)),
+        throttle=throttle,
+        read_ahead=params.get("read_ahead", "auto"),
+    )
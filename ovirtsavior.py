@@ -3,11 +3,51 @@ from paramiko import SSHClient
 from paramiko.client import AutoAddPolicy
 from paramiko.ssh_exception import NoValidConnectionsError
 import configparser
-from backup_lib import OvirtHandler, copy_file, main_logger, VM_LOGGER_FILE
+from ovirtsdk4 import types
+from backup_lib import (
+    OvirtHandler,
+    copy_backup_files,
+    qemu_chains,
+    size_str,
+    UPLOAD_WORKERS,
+    DISK_TIMEOUT,
+    OUTPUT_FORMAT,
+    TRANSFER_PATH,
+)
+from engine_api import API_CONCURRENCY, API_CACHE_TTL
+from delta import BLOCK_SIZE
+from encryption import encryption_cipher, encryption_from_params
+from profiling import profile_phase, profiler_from_params
+from qcow2 import open_image
+from savior_common import config_flag
+from savior_logging import (
+    main_logger,
+    setup_logging,
+    start_log_context,
+    set_log_context,
+    job_log_file,
+    flush_logs,
+    LOG_DIRECTORY,
+)
+from scheduler import current_job, Job, plan, MAX_JOBS
+from s3 import store_from_params
+from tee import REPLICA_BUFFER
+from throttle import throttle_from_params, parse_rate, set_shared_rates, NETWORK, DISK, API
+from transfer import POOL_SIZE, PARALLEL_REQUESTS, RANGE_SIZE, IO_WORKERS, PROBE_SIZE
 import sys
 import os
+import json
+import time
 from datetime import datetime
 from mailer import send_mail
+from instant import InstantExport
+from freeze import freeze_gate, FREEZE_TIMEOUT, FREEZE_SPACING, FREEZE_POLL_INTERVAL
+from daemon import SaviorDaemon, DAEMON_SOCKET, submit_job, daemon_request, job_vm_name
+from history import History, HISTORY_FILE, job_size, window_deadline
+from workqueue import JobQueue, Worker, QUEUE_FILE
+from recovery import BulkRestore, print_recovery_report
+from offsite import sync_from_params
+from tiering import mover_from_params, open_restore_point, rotate, tiering_enabled
 
 REQUIRED_SECTIONS = ["CONNECTION", "DIRECTORIES", "TRANSFER", "VM", "MAIL"]
 BACKUP_SECTIONS = ["SNAPSHOT", "SSH"]
@@ -25,9 +65,24 @@ REQUIRED_PARAMS = [
 RESTORE_PARAMS = ["storage_domain", "cluster_name", "template", "new_vm_name"]
 BACKUP_PARAMS = ["backup_snapshot_description"]
 COPY_TO_LOCAL_PARAMS = ["local_directory"]
-GLOBAL_LOGGER_FILE = "global_savior.log"
 MAIL_SUBJECT = "[OLVM_BACKUP_KSAT] {{mode}} of {{vm_name}} on {{date}}: {{status}}"
 MAIL_TEMPLATE = "mailbody.txt"
+DAEMON_MODES = [
+    "daemon",
+    "submit",
+    "jobs",
+    "throttle",
+    "plan",
+    "worker",
+    "enqueue",
+    "queue",
+    "recover",
+    "sync",
+    "move",
+]
+HISTORY_MODES = ["backup", "backuptemp", "restore", "rollback"]
+OUTPUT_FORMATS = ["raw", "qcow2"]
+TRANSFER_PATHS = ["auto", "direct", "proxy"]
 
 
 def get_config(setup_file):
@@ -44,21 +99,309 @@ def parse_arguments():
         "mode",
         metavar="mode",
         type=str,
-        help="backup or restore: specifies backup or restore mode.",
+        help="backup, backuptemp, restore, rollback or instant to run a job directly. daemon"
+        " starts the backup daemon, submit hands a job to a running daemon and jobs shows the"
+        " daemon job status. throttle changes the transfer rates of all running jobs. plan"
+        " prints the predicted run of the jobs of the given setup files. worker runs a node"
+        " taking jobs from the shared job queue, enqueue adds the jobs of the given setup files"
+        " to it and queue shows the queued jobs and the workers. recover restores many VMs at"
+        " once. sync copies the changed blocks of the backups to offsite_directory. move"
+        " moves the older restore points to capacity_directory.",
+    )
+    parser.add_argument(
+        "setup_files",
+        metavar="setupfiles",
+        nargs="*",
+        help="plan and enqueue: setup files of the jobs.",
     )
     parser.add_argument(
         "-s",
         "--setup_file",
         metavar="setupfile",
         help="setup file containing all the paremeters.",
-        required=True,
+    )
+    parser.add_argument(
+        "--submit_mode",
+        metavar="submitmode",
+        default="backup",
+        help="mode of the jobs of submit, plan and enqueue (default backup).",
+    )
+    parser.add_argument(
+        "--vm_name",
+        metavar="vmname",
+        help="overrides vm_name of the setup file.",
+    )
+    parser.add_argument(
+        "--network_rate",
+        metavar="networkrate",
+        help="throttle: network budget in bytes/s (e.g. 50M), 0 for unlimited.",
+    )
+    parser.add_argument(
+        "--disk_rate",
+        metavar="diskrate",
+        help="throttle: disk budget in bytes/s (e.g. 100M), 0 for unlimited.",
+    )
+    parser.add_argument(
+        "--api_rate",
+        metavar="apirate",
+        help="throttle: engine API calls per second, 0 for unlimited.",
+    )
+    parser.add_argument(
+        "--log_directory",
+        metavar="logdirectory",
+        default=LOG_DIRECTORY,
+        help="directory of the log files (default current directory).",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="profiles the phases of the job, as with profile : yes in the setup file.",
+    )
+    parser.add_argument(
+        "--socket",
+        metavar="socket",
+        help="control socket of the daemon (default %s)." % DAEMON_SOCKET,
     )
 
     args = parser.parse_args()
     var_args = vars(args)
+    if var_args["mode"] != "jobs" and not var_args["setup_file"]:
+        parser.error("the following arguments are required: -s/--setup_file")
     return var_args
 
 
+def split_list(value):
+    # comma or newline separated values of the setup file
+    if not value:
+        return []
+    return [x.strip() for x in value.replace(",", "\n").splitlines() if x.strip()]
+
+
+def config_params(config):
+    params = {}
+    for section in config.sections():
+        for key, value in config[section].items():
+            params[key] = value
+    return params
+
+
+def connect_handler(params, working_directory=None, connection=None):
+    main_logger.info("Connecting to Ovirt API...")
+    try:
+        oh = OvirtHandler(
+            url=params["ovirt_url"],
+            username=params["username"],
+            password=params["password"],
+            ca_file=params["ca_file"],
+            download_dir=working_directory,
+            chunk_size=params["chunk_size"],
+            pool_size=int(params.get("pool_size", POOL_SIZE)),
+            parallel_requests=int(params.get("parallel_requests", PARALLEL_REQUESTS)),
+            range_size=int(params.get("range_size", RANGE_SIZE)),
+            io_workers=int(params.get("io_workers", IO_WORKERS)),
+            throttle=throttle_from_params(params),
+            transfer_path=params.get("transfer_path", TRANSFER_PATH),
+            transfer_host=params.get("transfer_host"),
+            probe_size=int(params.get("probe_size", PROBE_SIZE)),
+            connection=connection,
+            api_concurrency=int(params.get("api_concurrency", API_CONCURRENCY)),
+            api_cache_ttl=float(params.get("api_cache_ttl", API_CACHE_TTL)),
+            read_ahead=params.get("read_ahead", "auto"),
+        )
+        oh.connection.authenticate()
+        main_logger.info("Successfully opened a session with the Ovirt API.")
+        return oh
+
+    except Exception as _:
+        msg = "An error occured contacting the Ovirt API"
+        raise ValueError(msg)
+
+
+def run_daemon_command(v):
+    params = config_params(get_config(v["setup_file"])) if v["setup_file"] else {}
+    socket_path = v["socket"] or params.get("socket", DAEMON_SOCKET)
+
+    if v["mode"] == "daemon":
+        params["socket"] = socket_path
+        SaviorDaemon(params, connect=connect_handler, job_factory=SaviorJob).serve()
+    elif v["mode"] == "submit":
+        job = submit_job(
+            v["submit_mode"],
+            v["setup_file"],
+            vm_name=v["vm_name"],
+            socket_path=socket_path,
+            spool_directory=params.get("spool_directory"),
+        )
+        print(json.dumps(job, indent=1))
+    elif v["mode"] == "jobs":
+        print(json.dumps(daemon_request(socket_path, "GET", "/jobs"), indent=1))
+    elif v["mode"] == "throttle":
+        # without any rate the configured rates and time-of-day profiles apply again
+        if "throttle_file" not in params:
+            raise ValueError("No throttle_file in the setup file, rates can not be shared")
+        rates = {}
+        if v["network_rate"] is not None:
+            rates[NETWORK] = parse_rate(v["network_rate"])
+        if v["disk_rate"] is not None:
+            rates[DISK] = parse_rate(v["disk_rate"])
+        if v["api_rate"] is not None:
+            rates[API] = parse_rate(v["api_rate"])
+        set_shared_rates(params["throttle_file"], rates)
+        main_logger.info("Shared transfer rates set to %s" % (rates or "configured values"))
+    elif v["mode"] == "plan":
+        print_plan(params, v["setup_files"], v["submit_mode"])
+    elif v["mode"] == "worker":
+        Worker(
+            params,
+            connect=connect_handler,
+            job_factory=SaviorJob,
+            domains=split_list(params.get("worker_domains")),
+        ).serve()
+    elif v["mode"] == "enqueue":
+        enqueue_jobs(params, v["setup_files"], v["submit_mode"])
+    elif v["mode"] == "queue":
+        queue = JobQueue(params.get("queue_file", QUEUE_FILE))
+        print(json.dumps({"jobs": queue.jobs(), "workers": queue.workers()}, indent=1))
+    elif v["mode"] == "recover":
+        recover(params)
+    elif v["mode"] == "sync":
+        sync(params, v["vm_name"])
+    elif v["mode"] == "move":
+        move(params)
+
+
+def recover(params):
+    oh = connect_handler(params)
+    try:
+        report = BulkRestore(params, oh).run()
+    finally:
+        oh.close()
+    print_recovery_report(report)
+    if params.get("recovery_report"):
+        with open(params["recovery_report"], "w") as f:
+            json.dump(report, f, indent=1)
+    if report["failed"]:
+        raise ValueError("%d VM(s) could not be restored" % report["failed"])
+
+
+def sync(params, vm_name=None):
+    report = sync_from_params(params, throttle=throttle_from_params(params)).run(
+        [vm_name] if vm_name else None
+    )
+    print(
+        "%d file(s), %d changed: %s of %s sent, %s copied, %.1f%% skipped, %.1f s, %.1f MB/s"
+        % (
+            report["files"],
+            report["changed_files"],
+            size_str(report["sent"]),
+            size_str(report["bytes"]),
+            size_str(report["copied"]),
+            report["skipped_ratio"] * 100,
+            report["duration"],
+            report["throughput"] / 1e6,
+        )
+    )
+    if params.get("sync_report"):
+        with open(params["sync_report"], "w") as f:
+            json.dump(report, f, indent=1)
+    if report["failed"]:
+        raise ValueError("%d VM(s) could not be synchronized" % len(report["failed"]))
+
+
+def move(params):
+    mover = mover_from_params(params, throttle=throttle_from_params(params))
+    if mover is None:
+        raise ValueError("Did not find any value for parameter capacity_directory")
+    report = mover.run_once()
+    print("%d restore point(s) moved, %s copied" % (report["moved"], size_str(report["bytes"])))
+    if report["failed"]:
+        raise ValueError("%d restore point(s) could not be moved" % len(report["failed"]))
+
+
+def size_jobs(params, setup_files, mode, history, deadline=None):
+    # jobs of the setup files with their predicted duration and the current size of their VM
+    oh = connect_handler(params)
+    jobs = []
+    try:
+        for setup_file in setup_files:
+            vm_name = job_vm_name(setup_file)
+            vm = oh.get_vm_by_name(vm_name) if vm_name else None
+            actual_size, storage_domain = job_size(vm.disk_sizes() if vm else {})
+            estimate = history.predict(vm_name, mode, actual_size, storage_domain)
+            job = Job(
+                mode,
+                os.path.abspath(setup_file),
+                vm_name=vm_name,
+                estimate=estimate,
+                deadline=deadline,
+            )
+            jobs.append((job, actual_size, storage_domain))
+    finally:
+        oh.close()
+    return jobs
+
+
+def enqueue_jobs(params, setup_files, mode):
+    # the setup files must be found at the same path on every worker node
+    if not setup_files:
+        raise ValueError("enqueue needs the setup files of the jobs")
+    history = History(params.get("history_file", HISTORY_FILE))
+    deadline = window_deadline(params.get("backup_window"))
+    queue = JobQueue(params.get("queue_file", QUEUE_FILE))
+    for job, actual_size, storage_domain in size_jobs(params, setup_files, mode, history, deadline):
+        job_id = queue.submit(
+            job.mode,
+            job.setup_file,
+            vm_name=job.vm_name,
+            storage_domain=storage_domain,
+            size=actual_size,
+            estimate=job.estimate,
+            deadline=job.deadline,
+        )
+        main_logger.info("Queued %s job %s for %s" % (mode, job_id, job.vm_name))
+
+
+def print_plan(params, setup_files, mode):
+    # dry run: predicts the jobs from their history and the current disk sizes, nothing is
+    # transferred
+    if not setup_files:
+        raise ValueError("plan needs the setup files of the jobs")
+    history = History(params.get("history_file", HISTORY_FILE))
+    deadline = window_deadline(params.get("backup_window"))
+    jobs = []
+    sizes = {}
+    for job, actual_size, _ in size_jobs(params, setup_files, mode, history, deadline):
+        sizes[job.id] = actual_size
+        jobs.append(job)
+
+    max_jobs = int(params.get("max_jobs", MAX_JOBS))
+    planned = plan(jobs, max_jobs=max_jobs)
+    print("%s plan of %d job(s) on %d slot(s)" % (mode.title(), len(jobs), max_jobs))
+    print("%-8s %-8s %10s %10s %5s  %s" % ("start", "end", "duration", "size", "runs", "vm"))
+    for job, start, end in planned:
+        runs = history.statistics(job.vm_name, mode)["runs"]
+        print(
+            "%-8s %-8s %9.0fs %10s %5d  %s"
+            % (
+                datetime.fromtimestamp(start).strftime("%H:%M"),
+                datetime.fromtimestamp(end).strftime("%H:%M"),
+                end - start,
+                size_str(sizes[job.id]) if sizes[job.id] else "-",
+                runs,
+                job.vm_name,
+            )
+        )
+    finish = max([x[2] for x in planned])
+    print("Predicted finish at %s" % datetime.fromtimestamp(finish).strftime("%Y-%m-%d %H:%M"))
+    if deadline:
+        late = [x[0].vm_name for x in planned if x[2] > deadline]
+        window_end = datetime.fromtimestamp(deadline).strftime("%Y-%m-%d %H:%M")
+        if late:
+            print("Backup window ends at %s, late: %s" % (window_end, ", ".join(late)))
+        else:
+            print("Inside the backup window ending at %s" % window_end)
+
+
 def check_directory(directory, create=True):
     if not os.path.isdir(directory):
         if create:
@@ -71,24 +414,55 @@ def check_directory(directory, create=True):
 
 
 class SaviorJob:
-    def __init__(self, mode, setup_file):
+    def __init__(self, mode, setup_file, oh=None, vm_name=None, profile=False):
+        job = current_job()
+        self.log_file = job_log_file(job.id if job else None)
+        start_log_context(job=job.id if job else None, log_file=self.log_file)
         main_logger.info("...Savior job initializing...")
         self.config = get_config(setup_file)
         self.mode = mode
         self.status = "UNKNOWN"
         self.successfully_connected = False
+        self.client = None
 
         self.check_sections()
         self.get_config_params()
+        if vm_name:
+            self.params["vm_name"] = vm_name
+        if profile:
+            self.params["profile"] = "yes"
         self.vm_name = self.params["vm_name"]
+        set_log_context(vm=self.vm_name)
         self.working_directory = os.path.join(self.params["working_directory"], self.vm_name)
         if "local_directory" in self.params:
             self.local_directory = os.path.join(self.params["local_directory"], self.vm_name)
+        self.replica_directories = [
+            os.path.join(x, self.vm_name)
+            for x in split_list(self.params.get("replica_directories"))
+        ]
         self.check_params()
         self.check_directories()
-        self.connect_to_api()
+        # a handler passed in (daemon mode) is shared with other jobs and never closed here
+        self.owns_handler = oh is None
+        if oh is None:
+            self.connect_to_api()
+        else:
+            self.oh = oh
+        self.store = store_from_params(self.params, throttle=self.oh.throttle)
+        self.encryption = encryption_from_params(self.params)
+        self.profiler = profiler_from_params(self.params, self.log_file)
 
     def execute(self):
+        started = time.time()
+        success = False
+        try:
+            self.run_mode()
+            success = True
+        finally:
+            if self.mode in HISTORY_MODES:
+                self.record_history(time.time() - started, success)
+
+    def run_mode(self):
         # mode backuptemp -> just do snapshot without downloading disk
         if self.mode == "backuptemp":
             # self.snapshot_name = self.params['backup_snapshot_description'] + datetime.now().strftime("%m-%d-%Y|%H:%M:%S")
@@ -100,14 +474,14 @@ class SaviorJob:
             self.successfully_connected = self.establish_connection_ssh()
 
             # self.check_backup_directory()
-            self.remove_backup_snapshot()
-
-            # start backup mode on server and add snapshot
-            self.execute_command_ssh(0)
-            self.add_backup_snapshot()
-
-            # stop backup mode and close connection
-            self.execute_command_ssh(1)
+            with profile_phase(self.profiler, "snapshot"):
+                self.remove_backup_snapshot()
+
+                # start backup mode on server, add snapshot and stop backup mode as soon as it is OK
+                if self.successfully_connected:
+                    self.frozen_snapshot()
+                else:
+                    self.add_backup_snapshot()
             self.close_connection_ssh()
 
         # mode backup -> to download disk
@@ -134,23 +508,53 @@ class SaviorJob:
             self.close_connection_ssh()
             """
 
+            if tiering_enabled(self.params):
+                rotate(self.params["working_directory"], self.vm_name)
             self.check_backup_directory()
-            self.download_disks()
-            self.save_vm_info()
+            with profile_phase(self.profiler, "download"):
+                self.download_disks()
+            with profile_phase(self.profiler, "save_vm_info"):
+                self.save_vm_info()
             ##self.remove_backup_snapshot()
 
         elif self.mode == "restore":
             main_logger.info("Working on restore mode for VM %s", self.vm_name)
-            self.new_vm_name = self.params["new_vm_name"]
-            main_logger.info("VM will be restored under the name %s", self.new_vm_name)
-            self.get_vm_settings()
-            self.check_for_restored_vm()
+            with open_restore_point(self.params, self.vm_name) as directory:
+                self.get_vm_settings(directory)
+                self.restore()
+
+        # mode instant -> export the backup chains over NBD until interrupted
+        elif self.mode == "instant":
+            main_logger.info("Working on instant restore mode for VM %s", self.vm_name)
+            if self.store:
+                raise ValueError("Instant restore needs the backups in working_directory")
+            if self.encryption:
+                raise ValueError("Instant restore cannot export encrypted backups")
+            with open_restore_point(self.params, self.vm_name) as directory:
+                self.get_vm_settings(directory)
+                self.instant_export()
+
+        # mode rollback -> write back into the disks of the existing VM the blocks that changed
+        elif self.mode == "rollback":
+            main_logger.info("Working on rollback mode for VM %s", self.vm_name)
+            with open_restore_point(self.params, self.vm_name) as directory:
+                self.get_vm_settings(directory)
+                self.get_backup_vm()
+                with profile_phase(self.profiler, "rollback"):
+                    self.rollback()
+
+    def restore(self):
+        self.new_vm_name = self.params["new_vm_name"]
+        main_logger.info("VM will be restored under the name %s", self.new_vm_name)
+        self.check_for_restored_vm()
+        with profile_phase(self.profiler, "copy_to_local"):
             self.copy_to_local()
-            self.vm_settings["name"] = self.new_vm_name
-            storage_domain = self.params["storage_domain"]
-            template = self.params["template"]
-            cluster_name = self.params["cluster_name"]
+        self.vm_settings["name"] = self.new_vm_name
+        storage_domain = self.params["storage_domain"]
+        template = self.params["template"]
+        cluster_name = self.params["cluster_name"]
 
+        with profile_phase(self.profiler, "upload"):
             self.oh.add_vm_from_settings(
                 self.vm_settings,
                 storage_domain=storage_domain,
@@ -158,8 +562,82 @@ class SaviorJob:
                 cluster_name=cluster_name,
                 directory=self.local_directory,
                 commit=True,
+                upload_workers=int(self.params.get("upload_workers", UPLOAD_WORKERS)),
+                disk_timeout=int(self.params.get("disk_timeout", DISK_TIMEOUT)),
             )
 
+    def job_size(self):
+        if self.mode == "restore" and hasattr(self, "vm_settings"):
+            sizes = [x["actual_size"] or 0 for x in self.vm_settings["disk_info"].values()]
+            return sum(sizes), self.params.get("storage_domain")
+        if hasattr(self, "vm"):
+            return job_size(self.vm.disk_sizes())
+        return None, None
+
+    def record_history(self, duration, success):
+        # every run feeds the duration predictions of the daemon scheduler and of plan
+        job = current_job()
+        try:
+            actual_size, storage_domain = self.job_size()
+            History(self.params.get("history_file", HISTORY_FILE)).record(
+                self.vm_name,
+                self.mode,
+                duration,
+                actual_size=actual_size,
+                storage_domain=storage_domain,
+                bytes=job.bytes if job else None,
+                success=success,
+            )
+        except Exception as exc:
+            main_logger.warning("Could not record the history of the job: %s" % exc)
+
+    def rollback(self):
+        if self.vm.status() != types.VmStatus.DOWN:
+            raise ValueError("VM %s must be down to be rolled back" % self.vm_name)
+        directory = self.working_directory
+        if self.store or self.encryption:
+            self.copy_to_local()
+            directory = self.local_directory
+
+        block_size = int(self.params.get("block_size", BLOCK_SIZE))
+        changed = 0
+        for base_image_id, chain in qemu_chains(directory).items():
+            disk = self.oh.get_disk(self.vm_settings["disk_info"][base_image_id]["id"])
+            image = open_image(os.path.join(directory, chain[-1]))
+            try:
+                changed += disk.delta_restore(image, block_size=block_size)
+            finally:
+                image.close()
+        main_logger.info("VM %s rolled back, %d bytes written" % (self.vm_name, changed))
+
+    def instant_export(self):
+        # overlays, sockets and qemu-nbd logs are kept apart from the backup files
+        run_directory = self.params.get("instant_directory", self.local_directory)
+        check_directory(run_directory, create=True)
+        port = self.params.get("instant_port")
+        export = InstantExport(
+            self.working_directory,
+            run_directory,
+            host=self.params.get("instant_host"),
+            port=int(port) if port else None,
+            copy_on_read=config_flag(self.params.get("instant_copy_on_read")),
+        )
+        export.start()
+        try:
+            for x in export.exports:
+                disk = self.vm_settings["disk_info"].get(x.image_id, {})
+                main_logger.info(
+                    "Disk %s (%s) exported at %s" % (disk.get("name"), x.image_id, x.url())
+                )
+            if config_flag(self.params.get("background_restore")):
+                main_logger.info("Restoring the VM while the exports are served")
+                self.restore()
+                main_logger.info("Restore finished, the exports are still served")
+            main_logger.info("Interrupt to stop the exports")
+            export.wait()
+        finally:
+            export.stop()
+
     def check_missing(self, required):
         missing = [x for x in required if x not in self.params]
         if len(missing) != 0:
@@ -171,6 +649,8 @@ class SaviorJob:
     def check_sections(self):
         if self.mode == "backup" or self.mode == "backuptemp":
             self.required_sections = REQUIRED_SECTIONS + BACKUP_SECTIONS
+        elif self.mode == "rollback":
+            self.required_sections = REQUIRED_SECTIONS
         else:
             self.required_sections = REQUIRED_SECTIONS + RESTORE_SECTIONS
 
@@ -182,10 +662,7 @@ class SaviorJob:
             raise ValueError(msg)
 
     def get_config_params(self):
-        self.params = {}
-        for section in self.config.sections():
-            for key, value in self.config[section].items():
-                self.params[key] = value
+        self.params = config_params(self.config)
 
     def check_params(self):
         self.check_missing(REQUIRED_PARAMS)
@@ -193,31 +670,46 @@ class SaviorJob:
             self.check_missing(BACKUP_PARAMS)
         elif self.mode == "restore":
             self.check_missing(RESTORE_PARAMS)
+        elif self.mode == "rollback" and (
+            self.params.get("s3_bucket") or encryption_cipher(self.params)
+        ):
+            self.check_missing(COPY_TO_LOCAL_PARAMS)
+        elif self.mode == "instant":
+            self.check_missing(COPY_TO_LOCAL_PARAMS)
+            if config_flag(self.params.get("background_restore")):
+                self.check_missing(RESTORE_PARAMS)
+        if self.params.get("output_format", OUTPUT_FORMAT) not in OUTPUT_FORMATS:
+            raise ValueError("output_format must be one of %s" % ", ".join(OUTPUT_FORMATS))
+        if self.params.get("transfer_path", TRANSFER_PATH) not in TRANSFER_PATHS:
+            raise ValueError("transfer_path must be one of %s" % ", ".join(TRANSFER_PATHS))
+        if encryption_cipher(self.params):
+            if self.params.get("output_format", OUTPUT_FORMAT) != "raw":
+                raise ValueError("encryption needs output_format raw")
+            if self.params.get("s3_bucket"):
+                raise ValueError("encryption is not supported with s3_bucket")
+        if tiering_enabled(self.params) and self.params.get("s3_bucket"):
+            raise ValueError("capacity_directory is not supported with s3_bucket")
 
     def connect_to_api(self):
-        main_logger.info("Connecting to Ovirt API...")
-        try:
-            self.oh = OvirtHandler(
-                url=self.params["ovirt_url"],
-                username=self.params["username"],
-                password=self.params["password"],
-                ca_file=self.params["ca_file"],
-                download_dir=self.working_directory,
-                chunk_size=self.params["chunk_size"],
-            )
-            self.oh.connection.authenticate()
-            main_logger.info("Successfully opened a session with the Ovirt API.")
+        self.oh = connect_handler(self.params, working_directory=self.working_directory)
 
-        except Exception as _:
-            msg = "An error occured contacting the Ovirt API"
-            raise ValueError(msg)
+    def close(self):
+        if self.store:
+            self.store.close()
+        if self.owns_handler:
+            self.oh.close()
 
     def check_directories(self):
         if self.mode == "backup":
             check_directory(self.working_directory, create=True)
+            for directory in self.replica_directories:
+                check_directory(directory, create=True)
         else:
-            check_directory(self.working_directory)
-            check_directory(self.local_directory, create=True)
+            # with an object store the backups are not in working_directory
+            if not self.params.get("s3_bucket"):
+                check_directory(self.working_directory)
+            if "local_directory" in self.params:
+                check_directory(self.local_directory, create=True)
 
     def establish_connection_ssh(self):
         ip = self.params["ssh_ip"]
@@ -245,10 +737,10 @@ class SaviorJob:
             )
             return False
 
-    def execute_command_ssh(self, number_of_command: int):
+    def execute_command_ssh(self, number_of_command: int, wait=True, timeout=None):
         if not self.successfully_connected:
             main_logger.warning("Cannot execute command, ssh connection not established properly")
-            self.close_connection_ssh()
+            return None
         if number_of_command == 0:
             command = self.params["ssh_command_0"]
         elif number_of_command == 1:
@@ -260,13 +752,20 @@ class SaviorJob:
             return
 
         main_logger.info(f"Executing command: {command}")
-        stdin, stdout, stderr = self.client.exec_command(command)
+        stdin, stdout, stderr = self.client.exec_command(command, timeout=timeout)
+        stdin.close()
+        # without wait the output is read later, e.g. once the guest has been thawed
+        if not wait:
+            return stdout, stderr
+        return self.command_output(stdout, stderr)
+
+    def command_output(self, stdout, stderr):
         main_logger.info(f'STDOUT: {stdout.read().decode("utf8")}')
         main_logger.info(f'STDERR: {stderr.read().decode("utf8")}')
-
-        stdin.close()
+        status = stdout.channel.recv_exit_status()
         stdout.close()
         stderr.close()
+        return status
 
     def close_connection_ssh(self):
         if self.client:
@@ -301,6 +800,47 @@ class SaviorJob:
             main_logger.info(f"Creating directory with appriopriate name: {directory}")
             os.mkdir(directory)
 
+    def frozen_snapshot(self):
+        # The guest is frozen by ssh_command_0 and thawed by ssh_command_1. Everything that can
+        # be done before (ssh connection, old snapshot removal) is done, the snapshot is polled
+        # tightly while frozen and the guest is thawed anyway after freeze_timeout seconds.
+        sd = self.snapshot_name
+        timeout = float(self.params.get("freeze_timeout", FREEZE_TIMEOUT))
+        gate = freeze_gate(
+            spacing=float(self.params.get("freeze_spacing", FREEZE_SPACING)),
+            lock_file=self.params.get("freeze_lock_file"),
+        )
+        with gate.slot():
+            status = self.execute_command_ssh(0, timeout=timeout)
+            if status:
+                main_logger.warning("Freeze command exited with status %d" % status)
+            frozen_at = time.monotonic()
+            try:
+                snapshot_service = self.vm.submit_snapshot(sd)
+                ready = self.vm.wait_for_snapshot(
+                    snapshot_service, poll_interval=FREEZE_POLL_INTERVAL, timeout=timeout
+                )
+            finally:
+                output = self.execute_command_ssh(1, wait=False, timeout=timeout)
+                freeze_duration = time.monotonic() - frozen_at
+
+        job = current_job()
+        if job:
+            job.freeze_duration = freeze_duration
+        main_logger.info(
+            "VM %s was frozen for %.2f s" % (self.vm_name, freeze_duration),
+            extra={"freeze_duration": freeze_duration},
+        )
+        if output:
+            self.command_output(*output)
+        if not ready:
+            main_logger.error(
+                "Snapshot %s of VM %s was not ready after %g s, the guest was thawed before it"
+                " completed" % (sd, self.vm_name, timeout)
+            )
+            self.vm.wait_for_snapshot(snapshot_service)
+        main_logger.info("Snapshot %s added on VM %s." % (sd, self.vm_name))
+
     def add_backup_snapshot(self):
         sd = self.snapshot_name
         vm_name = self.params["vm_name"]
@@ -312,6 +852,16 @@ class SaviorJob:
         vm_name = self.params["vm_name"]
         main_logger.info("Saving information for VM %s..." % vm_name)
         self.vm.save_settings(save_dir=self.working_directory)
+        if self.store:
+            filename = vm_name + ".pickle"
+            self.store.upload_file(
+                os.path.join(self.working_directory, filename), self.store.key(vm_name, filename)
+            )
+        for directory in self.replica_directories:
+            try:
+                self.vm.save_settings(save_dir=directory)
+            except OSError as exc:
+                main_logger.error("Could not save information in replica %s: %s" % (directory, exc))
 
         main_logger.info("Information saved for VM %s" % vm_name)
 
@@ -320,10 +870,21 @@ class SaviorJob:
         main_logger.info("Downloading disks of VM %s..." % vm_name)
         main_logger.info(f"Downloadind disk of VM for snapshot {self.snapshot_name}")
         self.vm.download_snapshot_disks(
-            snapshot_name=self.snapshot_name, download_dir=self.working_directory
+            snapshot_name=self.snapshot_name,
+            download_dir=self.working_directory,
+            replica_dirs=self.replica_directories,
+            replica_buffer=int(self.params.get("replica_buffer", REPLICA_BUFFER)),
+            sink_factory=self.object_sink if self.store else None,
+            output_format=self.params.get("output_format", OUTPUT_FORMAT),
+            compress=config_flag(self.params.get("compress")),
+            encryption=self.encryption,
         )
         main_logger.info("Disks downloaded successfully.")
 
+    def object_sink(self, image_id):
+        # disks stream straight into a multipart upload instead of working_directory
+        return self.store.multipart_sink(self.store.key(self.vm_name, image_id))
+
     def remove_backup_snapshot(self):
         sd = self.snapshot_name
         vm_name = self.params["vm_name"]
@@ -331,9 +892,23 @@ class SaviorJob:
         self.vm.remove_snapshot(sd)
         main_logger.info("Snapshot removed.")
 
-    def get_vm_settings(self):
+    def get_vm_settings(self, directory=None):
         vm_name = self.params["vm_name"]
-        self.working_directory = os.path.join(self.params["working_directory"], vm_name)
+        if self.store:
+            key = self.store.key(vm_name, vm_name + ".pickle")
+            main_logger.info("Reading VM information from s3://%s/%s" % (self.store.bucket, key))
+            self.store.run(
+                self.store.download_object(
+                    key, os.path.join(self.local_directory, vm_name + ".pickle")
+                )
+            )
+            self.vm_settings = self.oh.vm_settings_from_file(vm_name, save_dir=self.local_directory)
+            return
+
+        # with tiering the restore point may be an older one or on the capacity tier
+        self.working_directory = directory or os.path.join(
+            self.params["working_directory"], vm_name
+        )
 
         if not os.path.isdir(self.working_directory):
             raise ValueError("VM directory %s not found" % self.working_directory)
@@ -344,21 +919,28 @@ class SaviorJob:
         local_directory = self.local_directory
         working_directory = self.working_directory
 
+        if self.store:
+            prefix = self.store.key(self.vm_name)
+            main_logger.info(
+                "Downloading discs from s3://%s/%s to temp directory %s"
+                % (self.store.bucket, prefix, local_directory)
+            )
+            keys = self.store.download_prefix(prefix, local_directory)
+            main_logger.info("%d objects downloaded to local directory." % len(keys))
+            return
+
         main_logger.info(
             "Copying discs from working directory %s to temp directory %s"
             % (working_directory, local_directory)
         )
-        files = [
-            f
-            for f in os.listdir(working_directory)
-            if os.path.isfile(os.path.join(working_directory, f))
-        ]
-
-        for file in files:
-            source_file = os.path.join(working_directory, file)
-            dest_file = os.path.join(local_directory, file)
-            main_logger.info("Transfering %s to %s" % (source_file, dest_file))
-            copy_file(source_file, dest_file)
+        # encrypted images are decrypted on the way
+        copy_backup_files(
+            working_directory,
+            local_directory,
+            throttle=self.oh.throttle,
+            read_ahead=self.oh.read_ahead,
+            encryption=self.encryption,
+        )
 
         main_logger.info("Discs copied to local directory.")
 
@@ -372,6 +954,8 @@ class SaviorJob:
 
     def send_mail(self):
         main_logger.info("Sending email notification")
+        # the attached log must contain every record queued so far
+        flush_logs()
         server = self.params["smtp_server"]
         port = self.params["smtp_port"]
         password = self.params["smtp_password"]
@@ -389,19 +973,31 @@ class SaviorJob:
             server=server,
             port=port,
             body=MAIL_TEMPLATE,
-            attachmentFile=VM_LOGGER_FILE,
+            attachmentFile=self.log_file,
             replaceWith=replaceWith,
             to=to,
             subject=MAIL_SUBJECT,
             password=password,
+            appendix=self.profiler.summary() if self.profiler else None,
         )
 
 
 if __name__ == "__main__":
+    v = parse_arguments()
+    setup_logging(log_directory=v["log_directory"])
+    if v["mode"] in DAEMON_MODES:
+        try:
+            run_daemon_command(v)
+        except Exception as exc:
+            main_logger.error(exc, exc_info=exc)
+            sys.exit(1)
+        sys.exit(0)
+
+    c = None
     try:
-        v = parse_arguments()
-        c = SaviorJob(v["mode"], v["setup_file"])
+        c = SaviorJob(v["mode"], v["setup_file"], vm_name=v["vm_name"], profile=v["profile"])
         c.execute()
+        c.close()
         c.status = "SUCCESS!"
         c.send_mail()
     except Exception as exc:
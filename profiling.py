@@ -0,0 +1,185 @@
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+from savior_common import config_flag
+from savior_logging import main_logger
+
+PROFILE_TOP = 10
+SAMPLE_INTERVAL = 0.01
+TRACE_FRAMES = 1
+# where the threads of the pools, the event loop and the log listener wait for work
+IDLE_FUNCTIONS = [
+    ("thread.py", "_worker"),
+    ("threading.py", "wait"),
+    ("selectors.py", "select"),
+    ("queue.py", "get"),
+    ("handlers.py", "dequeue"),
+]
+
+tracing_lock = threading.Lock()
+tracing_users = [0]
+
+
+def start_tracing():
+    # tracemalloc is global, it runs while any profiled phase needs it. The peak is only reset
+    # when no other phase is traced, it would lose the peak of the jobs running at the same time.
+    with tracing_lock:
+        if tracing_users[0] == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACE_FRAMES)
+        if tracing_users[0] == 0:
+            tracemalloc.reset_peak()
+        tracing_users[0] += 1
+        return tracemalloc.take_snapshot()
+
+
+def stop_tracing():
+    with tracing_lock:
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracing_users[0] -= 1
+        if tracing_users[0] == 0:
+            tracemalloc.stop()
+        return snapshot, peak
+
+
+def function_name(code):
+    return "%s:%d(%s)" % (os.path.basename(code.co_filename), code.co_firstlineno, code.co_name)
+
+
+class Sampler(threading.Thread):
+    # samples the stacks of the other threads (I/O workers, event loop of the transfers...),
+    # the busy ones count for their innermost function
+
+    def __init__(self, skip, interval=SAMPLE_INTERVAL):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.skip = skip
+        self.interval = interval
+        self.samples = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id in (self.ident, self.skip):
+                    continue
+                code = frame.f_code
+                if (os.path.basename(code.co_filename), code.co_name) in IDLE_FUNCTIONS:
+                    continue
+                self.samples[function_name(code)] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class PhaseProfile:
+    def __init__(self, name):
+        self.name = name
+        self.duration = 0
+        self.stats = None
+        self.samples = Counter()
+        self.interval = SAMPLE_INTERVAL
+        self.memory = []
+        self.peak = None
+
+
+class JobProfiler:
+    # Profiles the phases of a job: cProfile of the job thread, samples of the other threads and,
+    # with memory, the allocations made during the phase. Each phase is saved as
+    # <log file>.<phase>.prof for pstats or snakeviz, the summary as <log file>.profile.txt.
+
+    def __init__(self, log_file, top=PROFILE_TOP, memory=True, interval=SAMPLE_INTERVAL):
+        self.prefix = os.path.splitext(log_file)[0]
+        self.top = top
+        self.memory = memory
+        self.interval = interval
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        profile = PhaseProfile(name)
+        profile.interval = self.interval
+        self.phases.append(profile)
+        sampler = Sampler(threading.get_ident(), interval=self.interval)
+        before = start_tracing() if self.memory else None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as exc:
+            # only one cProfile may run at a time on recent Python versions
+            main_logger.warning("Phase %s is not profiled with cProfile: %s" % (name, exc))
+            profiler = None
+        sampler.start()
+        t0 = time.monotonic()
+        try:
+            yield
+        finally:
+            profile.duration = time.monotonic() - t0
+            if profiler is not None:
+                profiler.disable()
+            sampler.stop()
+            profile.samples = sampler.samples
+            if before is not None:
+                after, profile.peak = stop_tracing()
+                profile.memory = after.compare_to(before, "lineno")[: self.top]
+            if profiler is not None:
+                profile.stats = pstats.Stats(profiler)
+                profile.stats.dump_stats("%s.%s.prof" % (self.prefix, name))
+            self.save()
+
+    def phase_summary(self, profile):
+        lines = ["Phase %s: %.2f s" % (profile.name, profile.duration)]
+        if profile.stats is not None:
+            out = io.StringIO()
+            profile.stats.stream = out
+            profile.stats.sort_stats("cumulative").print_stats(self.top)
+            text = out.getvalue()
+            start = text.find("ncalls")
+            lines.append("  job thread, by cumulative time:")
+            lines.extend(["    " + x for x in text[start:].strip().splitlines()])
+        if profile.samples:
+            lines.append("  other threads of the process, sampled every %g s:" % profile.interval)
+            for function, count in profile.samples.most_common(self.top):
+                lines.append("    %8.2f s  %s" % (count * profile.interval, function))
+        if profile.peak is not None:
+            lines.append(
+                "  memory of the process, peak %.1f MB traced:" % (profile.peak / 1024 / 1024)
+            )
+            for stat in profile.memory:
+                lines.append("    %+10.1f KB  %s" % (stat.size_diff / 1024, stat.traceback))
+        return "\n".join(lines)
+
+    def summary(self):
+        # the job thread is the only one that belongs to this job for sure
+        note = (
+            "The sampled threads and the traced memory cover the whole process, including the"
+            " other jobs running at the same time."
+        )
+        return "\n\n".join([note] + [self.phase_summary(x) for x in self.phases])
+
+    def save(self):
+        with open(self.prefix + ".profile.txt", "w") as f:
+            f.write(self.summary() + "\n")
+
+
+def profile_phase(profiler, name):
+    return profiler.phase(name) if profiler else nullcontext()
+
+
+def profiler_from_params(params, log_file):
+    if not config_flag(params.get("profile", "no")):
+        return None
+    return JobProfiler(
+        log_file,
+        top=int(params.get("profile_top", PROFILE_TOP)),
+        memory=config_flag(params.get("profile_memory", "yes")),
+        interval=float(params.get("profile_interval", SAMPLE_INTERVAL)),
+    )
@@ -0,0 +1,410 @@
+import os
+import struct
+import threading
+import time
+import zlib
+from array import array
+
+CLUSTER_BITS = 16
+CLUSTER_SIZE = 1 << CLUSTER_BITS
+L2_ENTRIES = CLUSTER_SIZE // 8
+REFCOUNT_ORDER = 4
+REFCOUNTS_PER_BLOCK = CLUSTER_SIZE * 8 // (1 << REFCOUNT_ORDER)
+HEADER_LENGTH = 104
+HEADER = struct.Struct(">4sIQIIQIIQQIIQQQQII")
+QCOW2_MAGIC = b"QFI\xfb"
+OFLAG_COPIED = 1 << 63
+OFLAG_COMPRESSED = 1 << 62
+CSIZE_SHIFT = 62 - (CLUSTER_BITS - 8)
+EXT_BACKING_FORMAT = 0xE2792ACA
+EXT_END = 0
+ZERO_CLUSTER = bytes(CLUSTER_SIZE)
+
+
+def clusters(size):
+    return (size + CLUSTER_SIZE - 1) // CLUSTER_SIZE
+
+
+def compress_cluster(data):
+    # qemu expects raw deflate streams with a 4KB window for compressed clusters
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -12)
+    return compressor.compress(data) + compressor.flush()
+
+
+class Qcow2Writer:
+    # Download sink converting a raw stream into a qcow2 image on the fly. Clusters that are
+    # all zeros are never stored, the others are appended (optionally compressed) as they
+    # complete, in whatever order the ranges arrive. Metadata is written on close.
+
+    def __init__(self, file_name, compress=False, backing_file=None, backing_format=None):
+        self.file_name = file_name
+        self.tmp_file_name = file_name + ".tmp"
+        self.compress = compress
+        self.backing_file = backing_file
+        self.backing_format = backing_format
+        self.fd = None
+        self.total = None
+        self.partial = {}
+        # one preallocated array per L2 table and per refcount block instead of an entry per cluster
+        self.tables = {}
+        self.refcounts = {}
+        self.end = CLUSTER_SIZE
+        self.buffer_lock = threading.Lock()
+        self.file_lock = threading.Lock()
+        self.bytes = 0
+        self.extent = 0
+        self.zero_clusters = 0
+        self.compressed_clusters = 0
+        self.t0 = None
+        self.error = None
+
+    def open(self):
+        self.t0 = time.monotonic()
+        self.fd = os.open(self.tmp_file_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+
+    def truncate(self, size):
+        self.total = size
+
+    def write(self, data, offset):
+        view = memoryview(data)
+        while view:
+            index = offset // CLUSTER_SIZE
+            position = offset % CLUSTER_SIZE
+            length = min(len(view), CLUSTER_SIZE - position)
+            if position == 0 and length == CLUSTER_SIZE:
+                self.store(index, view[:length])
+            else:
+                with self.buffer_lock:
+                    if index not in self.partial:
+                        self.partial[index] = [bytearray(CLUSTER_SIZE), 0]
+                    cluster = self.partial[index]
+                    cluster[0][position : position + length] = view[:length]
+                    cluster[1] += length
+                    complete = cluster[1] >= self.cluster_length(index)
+                    if complete:
+                        del self.partial[index]
+                if complete:
+                    self.store(index, cluster[0])
+            view = view[length:]
+            offset += length
+        with self.buffer_lock:
+            self.bytes += len(data)
+            self.extent = max(self.extent, offset)
+
+    def cluster_length(self, index):
+        if self.total is None:
+            return CLUSTER_SIZE
+        return min(CLUSTER_SIZE, self.total - index * CLUSTER_SIZE)
+
+    def store(self, index, data):
+        if data == ZERO_CLUSTER[: len(data)]:
+            with self.buffer_lock:
+                self.zero_clusters += 1
+            return
+
+        if len(data) < CLUSTER_SIZE:
+            data = bytes(data) + ZERO_CLUSTER[len(data) :]
+        compressed = compress_cluster(data) if self.compress else None
+        # compression only pays when the result leaves room in the cluster
+        if compressed is not None and len(compressed) < CLUSTER_SIZE - 512:
+            with self.file_lock:
+                offset = self.end
+                self.end += len(compressed)
+                os.pwrite(self.fd, compressed, offset)
+                for host in range(offset // CLUSTER_SIZE, (self.end - 1) // CLUSTER_SIZE + 1):
+                    self.add_refcount(host)
+                sectors = ((offset + len(compressed) - 1) >> 9) - (offset >> 9)
+                self.set_entry(index, OFLAG_COMPRESSED | (sectors << CSIZE_SHIFT) | offset)
+                self.compressed_clusters += 1
+        else:
+            with self.file_lock:
+                offset = clusters(self.end) * CLUSTER_SIZE
+                self.end = offset + CLUSTER_SIZE
+                os.pwrite(self.fd, data, offset)
+                self.add_refcount(offset // CLUSTER_SIZE)
+                self.set_entry(index, OFLAG_COPIED | offset)
+
+    def set_entry(self, index, entry):
+        table = self.tables.get(index // L2_ENTRIES)
+        if table is None:
+            table = self.tables[index // L2_ENTRIES] = array("Q", bytes(CLUSTER_SIZE))
+        table[index % L2_ENTRIES] = entry
+
+    def add_refcount(self, host):
+        block = self.refcounts.get(host // REFCOUNTS_PER_BLOCK)
+        if block is None:
+            block = self.refcounts[host // REFCOUNTS_PER_BLOCK] = array("H", bytes(CLUSTER_SIZE))
+        block[host % REFCOUNTS_PER_BLOCK] += 1
+
+    def flush_partial(self):
+        # a stream of unknown length ends with a partial cluster
+        for index in sorted(self.partial):
+            data, filled = self.partial.pop(index)
+            self.store(index, data)
+
+    def header_cluster(self, l1_size, l1_offset, refcount_table_offset, refcount_table_clusters):
+        extensions = b""
+        if self.backing_format:
+            name = self.backing_format.encode("utf8")
+            padding = b"\0" * (-len(name) % 8)
+            extensions += struct.pack(">II", EXT_BACKING_FORMAT, len(name)) + name + padding
+        extensions += struct.pack(">II", EXT_END, 0)
+
+        backing = self.backing_file.encode("utf8") if self.backing_file else b""
+        backing_offset = HEADER_LENGTH + len(extensions) if backing else 0
+        header = HEADER.pack(
+            QCOW2_MAGIC,
+            3,
+            backing_offset,
+            len(backing),
+            CLUSTER_BITS,
+            self.total,
+            0,
+            l1_size,
+            l1_offset,
+            refcount_table_offset,
+            refcount_table_clusters,
+            0,
+            0,
+            0,
+            0,
+            0,
+            REFCOUNT_ORDER,
+            HEADER_LENGTH,
+        )
+        return header + extensions + backing
+
+    def write_metadata(self):
+        if self.total is None:
+            self.total = self.extent
+        l1_size = (clusters(self.total) + L2_ENTRIES - 1) // L2_ENTRIES
+        offset = clusters(self.end) * CLUSTER_SIZE
+
+        l1 = [0] * l1_size
+        for l1_index in sorted(self.tables):
+            l2 = self.tables.pop(l1_index)
+            os.pwrite(self.fd, struct.pack(">%dQ" % L2_ENTRIES, *l2), offset)
+            self.add_refcount(offset // CLUSTER_SIZE)
+            l1[l1_index] = OFLAG_COPIED | offset
+            offset += CLUSTER_SIZE
+
+        l1_offset = offset
+        l1_clusters = max(1, clusters(l1_size * 8))
+        os.pwrite(self.fd, struct.pack(">%dQ" % l1_size, *l1), l1_offset)
+        for i in range(l1_clusters):
+            self.add_refcount(l1_offset // CLUSTER_SIZE + i)
+        offset += l1_clusters * CLUSTER_SIZE
+
+        # the refcount structures have to count themselves as well
+        first = offset // CLUSTER_SIZE
+        table_clusters, blocks = 1, 1
+        while True:
+            total = first + table_clusters + blocks
+            needed_blocks = (total + REFCOUNTS_PER_BLOCK - 1) // REFCOUNTS_PER_BLOCK
+            needed_table = clusters(needed_blocks * 8)
+            if needed_blocks <= blocks and needed_table <= table_clusters:
+                break
+            blocks = max(blocks, needed_blocks)
+            table_clusters = max(table_clusters, needed_table)
+
+        self.add_refcount(0)
+        for i in range(first, first + table_clusters + blocks):
+            self.add_refcount(i)
+
+        table = []
+        for block in range(blocks):
+            block_offset = (first + table_clusters + block) * CLUSTER_SIZE
+            table.append(block_offset)
+            counts = self.refcounts.get(block, array("H", bytes(CLUSTER_SIZE)))
+            os.pwrite(self.fd, struct.pack(">%dH" % REFCOUNTS_PER_BLOCK, *counts), block_offset)
+        os.pwrite(self.fd, struct.pack(">%dQ" % len(table), *table), first * CLUSTER_SIZE)
+
+        header = self.header_cluster(l1_size, l1_offset, first * CLUSTER_SIZE, table_clusters)
+        os.pwrite(self.fd, header, 0)
+        self.end = (first + table_clusters + blocks) * CLUSTER_SIZE
+        os.ftruncate(self.fd, self.end)
+
+    def close(self, success=True):
+        if self.fd is None:
+            return
+        success = success and self.error is None
+        try:
+            if success:
+                self.flush_partial()
+                self.write_metadata()
+        finally:
+            os.close(self.fd)
+            self.fd = None
+        if success:
+            if os.path.isfile(self.file_name):
+                os.remove(self.file_name)
+            os.rename(self.tmp_file_name, self.file_name)
+
+    def results(self):
+        return [self.result()]
+
+    def result(self):
+        duration = time.monotonic() - self.t0 if self.t0 else 0
+        return {
+            "path": self.file_name,
+            "completed": self.error is None,
+            "bytes": self.bytes,
+            "throughput": self.bytes / duration if duration else 0,
+            "max_lag": 0,
+            "error": self.error,
+            "stored_bytes": self.end,
+            "zero_clusters": self.zero_clusters,
+            "compressed_clusters": self.compressed_clusters,
+        }
+
+
+INCOMPATIBLE_CORRUPT = 1 << 1
+INCOMPATIBLE_DATA_FILE = 1 << 2
+INCOMPATIBLE_COMPRESSION = 1 << 3
+INCOMPATIBLE_EXTENDED_L2 = 1 << 4
+OFFSET_MASK = 0x00FFFFFFFFFFFE00
+L2_CACHE_TABLES = 64
+
+
+class RawImage:
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = os.open(filename, os.O_RDONLY)
+        self.size = os.fstat(self.fd).st_size
+
+    def read(self, offset, length):
+        data = os.pread(self.fd, length, offset)
+        if len(data) < length:
+            data += bytes(length - len(data))
+        return data
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Qcow2Image:
+    # reads the guest view of a qcow2 image, unallocated clusters come from the backing chain
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = os.open(filename, os.O_RDONLY)
+        self.backing = None
+        self.l2_cache = {}
+        self.lock = threading.Lock()
+        try:
+            self.read_header()
+        except Exception:
+            self.close()
+            raise
+
+    def read_header(self):
+        header = os.pread(self.fd, HEADER.size, 0)
+        fields = HEADER.unpack_from(header.ljust(HEADER.size, b"\0"))
+        magic, self.version, backing_offset, backing_size, self.cluster_bits, self.size = fields[:6]
+        crypt_method, l1_size, l1_offset = fields[6:9]
+        if magic != QCOW2_MAGIC:
+            raise ValueError("%s is not a qcow2 image" % self.filename)
+        if crypt_method:
+            raise ValueError("Encrypted image %s is not supported" % self.filename)
+        incompatible = fields[13] if self.version >= 3 else 0
+        unsupported = (
+            INCOMPATIBLE_CORRUPT
+            | INCOMPATIBLE_DATA_FILE
+            | INCOMPATIBLE_COMPRESSION
+            | INCOMPATIBLE_EXTENDED_L2
+        )
+        if incompatible & unsupported:
+            raise ValueError("Unsupported features %x in %s" % (incompatible, self.filename))
+
+        self.cluster_size = 1 << self.cluster_bits
+        self.l2_entries = self.cluster_size // 8
+        self.csize_shift = 62 - (self.cluster_bits - 8)
+        self.csize_mask = (1 << (self.cluster_bits - 8)) - 1
+        self.l1 = struct.unpack(">%dQ" % l1_size, os.pread(self.fd, l1_size * 8, l1_offset))
+
+        if backing_offset:
+            name = os.pread(self.fd, backing_size, backing_offset).decode("utf8")
+            if not os.path.isabs(name):
+                name = os.path.join(os.path.dirname(self.filename), name)
+            self.backing = open_image(name, self.backing_format(fields))
+
+    def backing_format(self, fields):
+        if self.version < 3:
+            offset = 72
+        else:
+            offset = fields[17]
+        while offset + 8 <= self.cluster_size:
+            kind, length = struct.unpack(">II", os.pread(self.fd, 8, offset))
+            if kind == EXT_END:
+                return None
+            if kind == EXT_BACKING_FORMAT:
+                return os.pread(self.fd, length, offset + 8).decode("utf8")
+            offset += 8 + length + (-length % 8)
+        return None
+
+    def l2_table(self, l2_offset):
+        with self.lock:
+            table = self.l2_cache.get(l2_offset)
+        if table is None:
+            data = os.pread(self.fd, self.cluster_size, l2_offset)
+            table = struct.unpack(">%dQ" % self.l2_entries, data)
+            with self.lock:
+                if len(self.l2_cache) >= L2_CACHE_TABLES:
+                    self.l2_cache.pop(next(iter(self.l2_cache)))
+                self.l2_cache[l2_offset] = table
+        return table
+
+    def cluster(self, index):
+        # returns the data of one guest cluster, None when it has to be read from the backing
+        l1_index = index // self.l2_entries
+        if l1_index >= len(self.l1) or not self.l1[l1_index] & OFFSET_MASK:
+            return None
+        entry = self.l2_table(self.l1[l1_index] & OFFSET_MASK)[index % self.l2_entries]
+        if entry & OFLAG_COMPRESSED:
+            offset = entry & ((1 << self.csize_shift) - 1)
+            sectors = ((entry >> self.csize_shift) & self.csize_mask) + 1
+            data = os.pread(self.fd, sectors * 512 - (offset & 511), offset)
+            data = zlib.decompressobj(-12).decompress(data, self.cluster_size)
+            return data.ljust(self.cluster_size, b"\0")
+        if self.version >= 3 and entry & 1:
+            return bytes(self.cluster_size)
+        if not entry & OFFSET_MASK:
+            return None
+        return os.pread(self.fd, self.cluster_size, entry & OFFSET_MASK).ljust(
+            self.cluster_size, b"\0"
+        )
+
+    def read(self, offset, length):
+        length = max(0, min(length, self.size - offset))
+        parts = []
+        end = offset + length
+        while offset < end:
+            index = offset // self.cluster_size
+            position = offset % self.cluster_size
+            n = min(end - offset, self.cluster_size - position)
+            data = self.cluster(index)
+            if data is not None:
+                parts.append(data[position : position + n])
+            elif self.backing is not None:
+                parts.append(self.backing.read(offset, n).ljust(n, b"\0"))
+            else:
+                parts.append(bytes(n))
+            offset += n
+        return b"".join(parts)
+
+    def close(self):
+        if self.backing is not None:
+            self.backing.close()
+        os.close(self.fd)
+
+
+def open_image(filename, format=None):
+    # guest view of a backup image and of its whole backing chain
+    if format is None:
+        with open(filename, "rb") as f:
+            format = "qcow2" if f.read(4) == QCOW2_MAGIC else "raw"
+    if format == "qcow2":
+        return Qcow2Image(filename)
+    if format == "raw":
+        return RawImage(filename)
+    raise ValueError("Unsupported image format %s of %s" % (format, filename))
@@ -0,0 +1,131 @@
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+READ_AHEAD = 1024 * 1024 * 64
+READ_AHEAD_WORKERS = 4
+NFS_READS = 64
+NFS_RSIZE = 1024 * 1024
+MOUNTS_FILE = "/proc/self/mounts"
+
+
+def advise(fd, offset, length, advice):
+    # posix_fadvise is missing on some platforms and only a hint anyway
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, offset, length, advice)
+        except OSError:
+            pass
+
+
+def mount_of(path):
+    # file system type and options of the mount holding path, from the longest mount point
+    path = os.path.realpath(path)
+    found = ("", "", "")
+    try:
+        with open(MOUNTS_FILE) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 4:
+                    continue
+                mount_point = fields[1].replace("\\040", " ")
+                prefix = mount_point.rstrip("/") + "/"
+                if path == mount_point or path.startswith(prefix):
+                    if len(mount_point) >= len(found[0]):
+                        found = (mount_point, fields[2], fields[3])
+    except OSError:
+        pass
+    return found[1], found[2]
+
+
+def read_ahead_size(path, value="auto"):
+    # "auto": enough reads of the rsize of an NFS mount in flight to cover the round trips,
+    # READ_AHEAD elsewhere
+    if str(value).strip().lower() != "auto":
+        return int(value)
+    fstype, options = mount_of(path)
+    if not fstype.startswith("nfs"):
+        return READ_AHEAD
+    rsize = NFS_RSIZE
+    for option in options.split(","):
+        if option.startswith("rsize="):
+            rsize = int(option.split("=", 1)[1])
+    return max(READ_AHEAD, rsize * NFS_READS)
+
+
+class ReadAhead:
+    # Sequential reader of a file: while a block is consumed the next ones are already read by
+    # a few threads, and the kernel is asked to prefetch the window behind them. At most window
+    # bytes are held, consumed pages are dropped from the page cache. transform(offset, data),
+    # e.g. a decryption, runs in the reading threads.
+
+    def __init__(
+        self,
+        filename,
+        block_size,
+        window=READ_AHEAD,
+        workers=READ_AHEAD_WORKERS,
+        start=0,
+        transform=None,
+    ):
+        self.fd = os.open(filename, os.O_RDONLY)
+        self.size = os.fstat(self.fd).st_size
+        self.block_size = block_size
+        self.window = window
+        self.depth = max(1, window // block_size)
+        self.executor = ThreadPoolExecutor(max_workers=min(workers, self.depth))
+        self.pending = deque()
+        self.next_offset = start
+        self.transform = transform
+        self.lock = threading.Lock()
+        advise(self.fd, 0, 0, getattr(os, "POSIX_FADV_SEQUENTIAL", 0))
+        self.fill()
+
+    def fill(self):
+        while len(self.pending) < self.depth and self.next_offset < self.size:
+            offset = self.next_offset
+            future = self.executor.submit(self.read_block, offset)
+            self.pending.append((offset, future))
+            self.next_offset += self.block_size
+        if self.next_offset < self.size:
+            advise(self.fd, self.next_offset, self.window, getattr(os, "POSIX_FADV_WILLNEED", 0))
+
+    def read_block(self, offset):
+        data = os.pread(self.fd, self.block_size, offset)
+        if self.transform is not None:
+            data = self.transform(offset, data)
+        return data
+
+    def read(self):
+        # (offset, data) of the next block, data is empty at the end of the file. Safe to call
+        # from several threads, the blocks are handed out in order.
+        with self.lock:
+            if not self.pending:
+                return self.size, b""
+            offset, future = self.pending.popleft()
+            self.fill()
+        data = future.result()
+        advise(self.fd, offset, self.block_size, getattr(os, "POSIX_FADV_DONTNEED", 0))
+        return offset, data
+
+    def __iter__(self):
+        while True:
+            _, data = self.read()
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        with self.lock:
+            for _, future in self.pending:
+                future.cancel()
+            self.pending.clear()
+        self.executor.shutdown(wait=True)
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
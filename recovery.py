@@ -0,0 +1,334 @@
+import fnmatch
+import heapq
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import scheduler
+from backup_lib import (
+    commit_chains,
+    copy_backup_files,
+    in_job_context,
+    qemu_chains,
+    size_str,
+    UPLOAD_WORKERS,
+)
+from catalog import catalog_vms
+from encryption import encryption_from_params
+from history import History, HISTORY_FILE
+from savior_logging import main_logger, start_log_context
+from scheduler import Job, RUNNING, SUCCESS, FAILED
+
+DEFAULT_TIER = 3
+RESTORE_JOBS = 8
+PREPARE_WORKERS = 2
+REQUIRED_PARAMS = [
+    "working_directory",
+    "local_directory",
+    "storage_domain",
+    "cluster_name",
+    "template",
+]
+
+
+class PriorityGate:
+    # a semaphore giving its free slots to the waiter with the lowest priority first, so that
+    # the VMs of the first tiers go through every stage before the others
+
+    def __init__(self, slots):
+        self.free = slots
+        self.waiting = []
+        self.sequence = 0
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def slot(self, priority):
+        with self.condition:
+            self.sequence += 1
+            entry = (priority, self.sequence)
+            heapq.heappush(self.waiting, entry)
+            while self.free == 0 or self.waiting[0] != entry:
+                self.condition.wait()
+            heapq.heappop(self.waiting)
+            self.free -= 1
+            # the next waiter may take another free slot
+            self.condition.notify_all()
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.free += 1
+                self.condition.notify_all()
+
+
+class RecoveryVm:
+    def __init__(self, name, tier=DEFAULT_TIER, new_name=None):
+        self.name = name
+        self.tier = tier
+        self.new_name = new_name or name
+        self.size = 0
+        self.estimate = 0
+        self.job = Job("restore", None, vm_name=name)
+        self.times = {}
+        self.ready = None
+
+    def priority(self):
+        return (self.tier, -self.estimate)
+
+    def information(self):
+        return {
+            "vm": self.name,
+            "new_vm": self.new_name,
+            "tier": self.tier,
+            "state": self.job.state,
+            "error": self.job.error,
+            "size": self.size,
+            "bytes": self.job.bytes,
+            "times": self.times,
+            "time_to_ready": self.ready,
+        }
+
+
+def read_restore_list(filename):
+    # one VM per line: "<vm_name> [tier] [new_vm_name]", lower tiers are restored first
+    vms = []
+    with open(filename) as f:
+        for line in f:
+            fields = line.split("#")[0].split()
+            if not fields:
+                continue
+            tier = int(fields[1]) if len(fields) > 1 else DEFAULT_TIER
+            vms.append(RecoveryVm(fields[0], tier, fields[2] if len(fields) > 2 else None))
+    return vms
+
+
+def parse_tiers(text):
+    # one "<pattern> <tier>" per line, the first matching pattern gives the tier of a VM
+    tiers = []
+    for line in (text or "").splitlines():
+        if line.strip():
+            pattern, tier = line.split()
+            tiers.append((pattern, int(tier)))
+    return tiers
+
+
+class BulkRestore:
+    # Restores many VMs at once. Each VM goes through the stages of a restore: the VM is created
+    # and its disks requested, its images are copied to local_directory and committed while the
+    # engine provisions the disks, and every disk is uploaded as soon as it is ready. restore_jobs
+    # VMs are in the pipeline at the same time, the disk bound stage and the uploads have global
+    # slots taken in tier order, and the throttle budgets are shared by all of them.
+
+    def __init__(self, params, oh):
+        missing = [x for x in REQUIRED_PARAMS if x not in params]
+        if missing:
+            raise ValueError(
+                "Did not find any values for parameter(s) %s in the config file"
+                % ", ".join(missing)
+            )
+        if params.get("s3_bucket"):
+            raise ValueError("Bulk restore reads the backups from working_directory, not S3")
+        self.params = params
+        self.oh = oh
+        self.history = History(params.get("history_file", HISTORY_FILE))
+        self.encryption = encryption_from_params(params)
+        self.restore_jobs = int(params.get("restore_jobs", RESTORE_JOBS))
+        self.prepare_gate = PriorityGate(int(params.get("prepare_workers", PREPARE_WORKERS)))
+        self.upload_gate = PriorityGate(int(params.get("upload_workers", UPLOAD_WORKERS)))
+        self.vms = []
+        self.started = None
+
+    def targets(self):
+        vms = []
+        if self.params.get("restore_list"):
+            vms = read_restore_list(self.params["restore_list"])
+        if self.params.get("restore_query"):
+            listed = [x.name for x in vms]
+            tiers = parse_tiers(self.params.get("restore_tiers"))
+            for name in self.query(self.params["restore_query"]):
+                if name in listed:
+                    continue
+                tier = [x[1] for x in tiers if fnmatch.fnmatch(name, x[0])]
+                vms.append(RecoveryVm(name, tier[0] if tier else DEFAULT_TIER))
+        if not vms:
+            raise ValueError("Nothing to restore, set restore_list or restore_query")
+
+        suffix = self.params.get("new_vm_suffix", "")
+        for vm in vms:
+            if vm.new_name == vm.name:
+                vm.new_name += suffix
+            directory = os.path.join(self.params["working_directory"], vm.name)
+            if os.path.isdir(directory):
+                vm.size = sum(
+                    [os.path.getsize(os.path.join(directory, x)) for x in os.listdir(directory)]
+                )
+            vm.estimate = self.history.predict(vm.name, "restore", vm.size or None)
+        return vms
+
+    def query(self, query):
+        # "name=web-*, storage_domain=data1": VMs of the catalog matching every term, the
+        # storage domain is the one holding most of the VM at its last backup
+        terms = [x.strip().split("=", 1) for x in query.split(",") if x.strip()]
+        domains = {}
+        if "storage_domain" in [x[0] for x in terms]:
+            domains = {x.name: x.id for x in self.oh.storage_domains_service.list()}
+        names = []
+        for name in catalog_vms(self.params["working_directory"]):
+            matched = True
+            for key, value in terms:
+                if key == "name":
+                    matched = matched and fnmatch.fnmatch(name, value)
+                elif key == "storage_domain":
+                    backups = self.history.entries(vm=name, mode="backup")
+                    domain = backups[-1]["storage_domain"] if backups else None
+                    matched = matched and domain in (value, domains.get(value))
+                else:
+                    raise ValueError("Unknown restore_query term %s" % key)
+            if matched:
+                names.append(name)
+        return names
+
+    def run(self):
+        # the VMs enter the pipeline by tier, the longest first inside a tier
+        self.vms = sorted(self.targets(), key=lambda x: x.priority())
+        main_logger.info(
+            "Bulk restore of %d VM(s), %s, %d at a time"
+            % (len(self.vms), size_str(sum([x.size for x in self.vms])), self.restore_jobs)
+        )
+        self.started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.restore_jobs) as executor:
+            for vm in self.vms:
+                executor.submit(self.restore_vm, vm)
+        return self.report()
+
+    def restore_vm(self, vm):
+        start_log_context(vm=vm.name)
+        scheduler.current.job = vm.job
+        vm.job.state = RUNNING
+        vm.job.started = time.time()
+        try:
+            self.pipeline(vm)
+            vm.job.state = SUCCESS
+            vm.ready = time.monotonic() - self.started
+            main_logger.info("VM %s ready %.1f s after the start" % (vm.new_name, vm.ready))
+        except Exception as exc:
+            vm.job.state = FAILED
+            vm.job.error = str(exc)
+            main_logger.error("Restore of %s failed: %s" % (vm.name, exc), exc_info=exc)
+        finally:
+            vm.job.finished = time.time()
+            try:
+                self.history.record(
+                    vm.name,
+                    "restore",
+                    vm.job.duration(),
+                    actual_size=vm.size,
+                    storage_domain=self.params["storage_domain"],
+                    bytes=vm.job.bytes,
+                    success=vm.job.state == SUCCESS,
+                )
+            except Exception as exc:
+                main_logger.warning("Could not record the history of the job: %s" % exc)
+            start_log_context()
+            scheduler.current.job = None
+
+    def pipeline(self, vm):
+        source = os.path.join(self.params["working_directory"], vm.name)
+        local = os.path.join(self.params["local_directory"], vm.name)
+        if not os.path.isdir(source):
+            raise ValueError("VM directory %s not found" % source)
+        if self.oh.get_vm_by_name(vm.new_name):
+            raise ValueError("A VM with name %s already exists in the cluster" % vm.new_name)
+        settings = self.oh.vm_settings_from_file(vm.name, save_dir=source)
+        settings["name"] = vm.new_name
+        chains = qemu_chains(source, encryption=self.encryption)
+
+        # the engine provisions the disks while the images are copied and committed
+        t0 = time.monotonic()
+        new_vm = self.oh.create_vm(
+            settings, template=self.params["template"], cluster_name=self.params["cluster_name"]
+        )
+        pending = {}
+        for base_image_id in chains:
+            disk_service = new_vm.submit_base_disk(
+                settings["disk_info"][base_image_id], storage_domain=self.params["storage_domain"]
+            )
+            pending[disk_service] = os.path.join(local, base_image_id)
+        vm.times["create"] = time.monotonic() - t0
+
+        with self.prepare_gate.slot(vm.priority()):
+            t0 = time.monotonic()
+            os.makedirs(local, exist_ok=True)
+            copy_backup_files(
+                source,
+                local,
+                throttle=self.oh.throttle,
+                read_ahead=self.oh.read_ahead,
+                encryption=self.encryption,
+            )
+            commit_chains(directory=local)
+            vm.times["prepare"] = time.monotonic() - t0
+
+        t0 = time.monotonic()
+        uploads = []
+        with ThreadPoolExecutor(max_workers=max(len(pending), 1)) as executor:
+            for disk in new_vm.wait_for_disks(pending.keys()):
+                filename = pending[disk.disk_service]
+                uploads.append(executor.submit(in_job_context(self.upload), vm, disk, filename))
+            vm.times["provisioning"] = max(new_vm.provisioning_times.values() or [0])
+            for upload in uploads:
+                upload.result()
+        vm.times["upload"] = time.monotonic() - t0
+
+    def upload(self, vm, disk, filename):
+        with self.upload_gate.slot(vm.priority()):
+            main_logger.info("Uploading %s" % filename)
+            disk.upload_image(filename)
+
+    def report(self):
+        ready = [x.ready for x in self.vms if x.ready is not None]
+        return {
+            "vms": [x.information() for x in sorted(self.vms, key=lambda x: x.ready or 1e30)],
+            "restored": len(ready),
+            "failed": len(self.vms) - len(ready),
+            "bytes": sum([x.job.bytes for x in self.vms]),
+            "time_to_full_recovery": max(ready) if len(ready) == len(self.vms) else None,
+            "duration": time.monotonic() - self.started,
+        }
+
+
+def print_recovery_report(report):
+    print(
+        "%-5s %-24s %-8s %10s %8s %8s %8s %8s %8s"
+        % ("tier", "vm", "state", "size", "create", "prepare", "provis.", "upload", "ready")
+    )
+    for vm in report["vms"]:
+        times = vm["times"]
+        print(
+            "%-5d %-24s %-8s %10s %7.1fs %7.1fs %7.1fs %7.1fs %8s"
+            % (
+                vm["tier"],
+                vm["new_vm"],
+                vm["state"],
+                size_str(vm["size"]),
+                times.get("create", 0),
+                times.get("prepare", 0),
+                times.get("provisioning", 0),
+                times.get("upload", 0),
+                "%.1fs" % vm["time_to_ready"] if vm["time_to_ready"] is not None else "-",
+            )
+        )
+        if vm["error"]:
+            print("      %s" % vm["error"])
+    if report["time_to_full_recovery"] is not None:
+        print(
+            "%d VM(s) restored, full recovery in %.1f s"
+            % (report["restored"], report["time_to_full_recovery"])
+        )
+    else:
+        print(
+            "%d VM(s) restored, %d failed, %.1f s"
+            % (report["restored"], report["failed"], report["duration"])
+        )
@@ -0,0 +1,382 @@
+import asyncio
+import hashlib
+import hmac
+import os
+import threading
+import xml.etree.ElementTree as ET
+from datetime import datetime, timezone
+from urllib.parse import quote, urlsplit
+
+from tee import FileSink
+from throttle import NETWORK
+from transfer import TransferClient
+
+PART_SIZE = 1024 * 1024 * 64
+MIN_PART_SIZE = 1024 * 1024 * 5
+MAX_PARTS = 10000
+PARALLEL_PARTS = 4
+REGION = "us-east-1"
+UNSIGNED_PAYLOAD = "UNSIGNED-PAYLOAD"
+
+
+def xml_values(body, tag):
+    # S3 replies are namespaced, tags are matched on their local name
+    root = ET.fromstring(body)
+    return [x.text for x in root.iter() if x.tag.split("}")[-1] == tag]
+
+
+def hmac_sha256(key, message):
+    return hmac.new(key, message.encode("utf8"), hashlib.sha256).digest()
+
+
+class S3Store:
+    def __init__(
+        self,
+        endpoint,
+        bucket,
+        access_key,
+        secret_key,
+        region=REGION,
+        prefix="",
+        part_size=PART_SIZE,
+        parallel_parts=PARALLEL_PARTS,
+        ca_file=None,
+        throttle=None,
+    ):
+        if part_size < MIN_PART_SIZE:
+            raise ValueError("S3 part size must be at least %d bytes" % MIN_PART_SIZE)
+        self.endpoint = endpoint.rstrip("/")
+        self.host = urlsplit(self.endpoint).netloc
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.prefix = prefix.strip("/")
+        self.part_size = part_size
+        self.parallel_parts = parallel_parts
+        self.throttle = throttle
+        self.client = TransferClient(
+            ca_file=ca_file, pool_size=parallel_parts * 2, parallel_requests=parallel_parts
+        )
+
+    def key(self, *names):
+        return "/".join([x for x in [self.prefix] + list(names) if x])
+
+    def close(self):
+        self.client.close()
+
+    # AWS signature version 4, path style addressing so that any S3 compatible server works
+
+    def sign(self, method, path, query, headers):
+        now = datetime.now(timezone.utc)
+        amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+        date = now.strftime("%Y%m%d")
+        headers["x-amz-date"] = amz_date
+        headers["x-amz-content-sha256"] = UNSIGNED_PAYLOAD
+
+        canonical_query = "&".join(
+            [
+                "%s=%s" % (quote(k, safe="-_.~"), quote(v, safe="-_.~"))
+                for k, v in sorted(query.items())
+            ]
+        )
+        signed = dict([(k.lower(), str(v).strip()) for k, v in headers.items()])
+        signed["host"] = self.host
+        signed_headers = ";".join(sorted(signed))
+        canonical_headers = "".join(["%s:%s\n" % (k, signed[k]) for k in sorted(signed)])
+        canonical_request = "\n".join(
+            [
+                method,
+                quote(path, safe="-_.~/"),
+                canonical_query,
+                canonical_headers,
+                signed_headers,
+                UNSIGNED_PAYLOAD,
+            ]
+        )
+        scope = "%s/%s/s3/aws4_request" % (date, self.region)
+        string_to_sign = "\n".join(
+            [
+                "AWS4-HMAC-SHA256",
+                amz_date,
+                scope,
+                hashlib.sha256(canonical_request.encode("utf8")).hexdigest(),
+            ]
+        )
+        key = ("AWS4" + self.secret_key).encode("utf8")
+        for part in [date, self.region, "s3", "aws4_request"]:
+            key = hmac_sha256(key, part)
+        signature = hmac.new(key, string_to_sign.encode("utf8"), hashlib.sha256).hexdigest()
+        headers["Authorization"] = (
+            "AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=%s, Signature=%s"
+            % (self.access_key, scope, signed_headers, signature)
+        )
+        return canonical_query
+
+    async def request(self, method, key, query=None, headers=None, body=None, expected=(200,)):
+        query = query or {}
+        headers = dict(headers or {})
+        path = "/%s/%s" % (self.bucket, key) if key else "/%s" % self.bucket
+        canonical_query = self.sign(method, path, query, headers)
+        url = self.endpoint + quote(path, safe="-_.~/")
+        if canonical_query:
+            url += "?" + canonical_query
+        if body is not None and self.throttle is not None:
+            await self.throttle.acquire(NETWORK, len(body))
+        response = await self.client.request(method, url, headers=headers, body=body)
+        if response.status not in expected:
+            content = await response.read()
+            await response.release()
+            raise ValueError(
+                "S3 %s of %s failed with status %d: %s"
+                % (method, key, response.status, content[:500].decode("utf8", "replace"))
+            )
+        return response
+
+    async def put_object(self, key, body):
+        response = await self.request("PUT", key, body=body)
+        await response.release()
+
+    async def get_object(self, key):
+        response = await self.request("GET", key)
+        content = await response.read()
+        await response.release()
+        return content
+
+    async def object_size(self, key):
+        response = await self.request("HEAD", key)
+        await response.release()
+        return response.content_length()
+
+    async def list_objects(self, prefix):
+        keys = []
+        token = None
+        while True:
+            query = {"list-type": "2", "prefix": prefix}
+            if token:
+                query["continuation-token"] = token
+            response = await self.request("GET", "", query=query)
+            content = await response.read()
+            await response.release()
+            keys += xml_values(content, "Key")
+            tokens = xml_values(content, "NextContinuationToken")
+            if not tokens:
+                return keys
+            token = tokens[0]
+
+    async def create_multipart_upload(self, key):
+        response = await self.request("POST", key, query={"uploads": ""})
+        content = await response.read()
+        await response.release()
+        return xml_values(content, "UploadId")[0]
+
+    async def upload_part(self, key, upload_id, part_number, body):
+        query = {"partNumber": str(part_number), "uploadId": upload_id}
+        response = await self.request("PUT", key, query=query, body=body)
+        await response.release()
+        return response.headers["etag"]
+
+    async def complete_multipart_upload(self, key, upload_id, etags):
+        parts = "".join(
+            [
+                "<Part><PartNumber>%d</PartNumber><ETag>%s</ETag></Part>" % (n, etags[n])
+                for n in sorted(etags)
+            ]
+        )
+        body = ("<CompleteMultipartUpload>%s</CompleteMultipartUpload>" % parts).encode("utf8")
+        response = await self.request("POST", key, query={"uploadId": upload_id}, body=body)
+        content = await response.read()
+        await response.release()
+        # S3 may answer 200 and still report an error in the body
+        if b"<Error>" in content:
+            raise ValueError("S3 multipart upload of %s failed: %s" % (key, content[:500]))
+
+    async def abort_multipart_upload(self, key, upload_id):
+        response = await self.request(
+            "DELETE", key, query={"uploadId": upload_id}, expected=(200, 204)
+        )
+        await response.release()
+
+    async def _download_part(self, key, sink, start, end):
+        headers = {"Range": "bytes=%d-%d" % (start, end)}
+        response = await self.request("GET", key, headers=headers, expected=(206,))
+        offset = start
+        try:
+            async for chunk in response.iter_chunks():
+                if self.throttle is not None:
+                    await self.throttle.acquire(NETWORK, len(chunk))
+                await self.client.io(sink.write, chunk, offset)
+                offset += len(chunk)
+        finally:
+            await response.release()
+
+    async def download_object(self, key, file_name):
+        # ranged GETs of part_size in parallel, written in place into the local file
+        size = await self.object_size(key)
+        sink = FileSink(file_name)
+        await self.client.io(sink.open)
+        success = False
+        try:
+            await self.client.io(sink.truncate, size)
+            work = (
+                lambda s=start: self._download_part(key, sink, s, min(s + self.part_size, size) - 1)
+                for start in range(0, size, self.part_size)
+            )
+            await self.client.run_parallel(work, self.parallel_parts)
+            success = True
+        finally:
+            await self.client.io(sink.close, success)
+        return size
+
+    # synchronous helpers
+
+    def run(self, coroutine):
+        return self.client.run(coroutine)
+
+    def multipart_sink(self, key):
+        return MultipartSink(self, key)
+
+    def upload_file(self, filename, key):
+        with open(filename, "rb") as f:
+            self.run(self.put_object(key, f.read()))
+
+    def download_prefix(self, prefix, directory):
+        # restores every object under prefix into directory, keeping the object names
+        keys = self.run(self.list_objects(prefix.rstrip("/") + "/"))
+        for key in keys:
+            file_name = os.path.join(directory, key.rsplit("/", 1)[-1])
+            self.run(self.download_object(key, file_name))
+        return keys
+
+
+class MultipartSink:
+    # download sink streaming into an S3 multipart upload. Ranges may arrive out of order,
+    # each part is buffered until complete and then uploaded while the next ones fill up.
+
+    def __init__(self, store, key):
+        self.store = store
+        self.key = key
+        self.part_size = store.part_size
+        self.total = None
+        self.upload_id = None
+        self.parts = {}
+        self.filled = {}
+        self.futures = []
+        self.etags = {}
+        self.lock = threading.Lock()
+        self.in_flight = threading.Semaphore(store.parallel_parts)
+        self.bytes = 0
+        self.t0 = None
+        self.error = None
+
+    def open(self):
+        self.t0 = datetime.now()
+        self.upload_id = self.store.run(self.store.create_multipart_upload(self.key))
+
+    def truncate(self, size):
+        # S3 takes at most MAX_PARTS parts, larger images get larger parts
+        self.total = size
+        needed = -(-size // MAX_PARTS)
+        if needed > self.part_size:
+            if self.parts or self.futures:
+                raise ValueError("Part size of %s can not change during the upload" % self.key)
+            self.part_size = -(-needed // MIN_PART_SIZE) * MIN_PART_SIZE
+
+    def part_length(self, number):
+        if self.total is None:
+            return self.part_size
+        return min(self.part_size, self.total - (number - 1) * self.part_size)
+
+    def write(self, data, offset):
+        view = memoryview(data)
+        while view:
+            number = offset // self.part_size + 1
+            if number > MAX_PARTS:
+                raise ValueError(
+                    "Upload of %s needs more than %d parts of %d bytes"
+                    % (self.key, MAX_PARTS, self.part_size)
+                )
+            position = offset % self.part_size
+            length = min(len(view), self.part_size - position)
+            with self.lock:
+                if number not in self.parts:
+                    self.parts[number] = bytearray(self.part_length(number))
+                    self.filled[number] = 0
+                self.parts[number][position : position + length] = view[:length]
+                self.filled[number] += length
+                complete = self.filled[number] >= self.part_length(number)
+                body = self.parts.pop(number) if complete else None
+            if complete:
+                self.send(number, bytes(body))
+            view = view[length:]
+            offset += length
+        with self.lock:
+            self.bytes += len(data)
+
+    def send(self, number, body):
+        # at most parallel_parts parts are in flight, the writer waits for a free slot
+        self.in_flight.acquire()
+        future = asyncio.run_coroutine_threadsafe(
+            self.store.upload_part(self.key, self.upload_id, number, body),
+            self.store.client.start(),
+        )
+
+        def done(future, number=number):
+            self.in_flight.release()
+            if future.exception() is None:
+                self.etags[number] = future.result()
+
+        future.add_done_callback(done)
+        self.futures.append(future)
+
+    def close(self, success=True):
+        try:
+            if success:
+                # parts still buffered are the tail of a stream of unknown length
+                for number in sorted(self.parts):
+                    self.send(number, bytes(self.parts.pop(number)[: self.filled[number]]))
+                # S3 does not complete an upload without parts, an empty image is one empty part
+                if not self.futures:
+                    self.send(1, b"")
+            for future in self.futures:
+                future.result()
+            if not success:
+                raise ValueError("Download into %s was interrupted" % self.key)
+            self.store.run(
+                self.store.complete_multipart_upload(self.key, self.upload_id, self.etags)
+            )
+        except Exception as exc:
+            self.error = str(exc)
+            self.store.run(self.store.abort_multipart_upload(self.key, self.upload_id))
+            if success:
+                raise
+
+    def results(self):
+        duration = (datetime.now() - self.t0).total_seconds() if self.t0 else 0
+        return [
+            {
+                "path": "s3://%s/%s" % (self.store.bucket, self.key),
+                "completed": self.error is None,
+                "bytes": self.bytes,
+                "throughput": self.bytes / duration if duration else 0,
+                "max_lag": 0,
+                "error": self.error,
+            }
+        ]
+
+
+def store_from_params(params, throttle=None):
+    if not params.get("s3_bucket"):
+        return None
+    return S3Store(
+        params["s3_endpoint"],
+        params["s3_bucket"],
+        params["s3_access_key"],
+        params["s3_secret_key"],
+        region=params.get("s3_region", REGION),
+        prefix=params.get("s3_prefix", ""),
+        part_size=int(params.get("s3_part_size", PART_SIZE)),
+        parallel_parts=int(params.get("s3_parallel_parts", PARALLEL_PARTS)),
+        ca_file=params.get("s3_ca_file"),
+        throttle=throttle,
+    )
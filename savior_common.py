@@ -0,0 +1,36 @@
+import time
+
+# small helpers shared by the modules, without any import of the SDK or of cryptography
+
+ENCRYPTED_SUFFIX = ".enc"
+
+
+def config_flag(value):
+    return str(value or "").strip().lower() in ["yes", "true", "on", "1"]
+
+
+def rate_str(rate):
+    # rate in bits per second
+    if rate < 1e3:
+        return "%3.1f b/s" % rate
+    elif rate < 1e6:
+        return "%3.1f Kb/s" % (rate / 1e3)
+    elif rate < 1e9:
+        return "%3.1f Mb/s" % (rate / 1e6)
+    else:
+        return "%3.2f Gb/s" % (rate / 1e9)
+
+
+def size_str(s):
+    if s < 1e3:
+        return "%3.0fB" % s
+    elif s < 1e6:
+        return "%3.1fKB" % (s / 1e3)
+    elif s < 1e9:
+        return "%3.1fMB" % (s / 1e6)
+    else:
+        return "%3.1fGB" % (s / 1e9)
+
+
+def time_str(timestamp):
+    return time.strftime("%Y-%m-%d %H:%M", time.localtime(timestamp)) if timestamp else "-"
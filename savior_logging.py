@@ -0,0 +1,227 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+
+VM_LOGGER_FILE = "savior.log"
+GLOBAL_LOGGER_FILE = "global_savior.log"
+JSON_LOGGER_FILE = "global_savior.jsonl"
+LOG_DIRECTORY = "."
+PROGRESS_RATE = 5
+FLUSH_TIMEOUT = 10
+CONTEXT_FIELDS = ["job", "vm", "disk"]
+
+main_logger = logging.getLogger("savior")
+main_logger.setLevel(logging.DEBUG)
+
+context = threading.local()
+pipeline = {}
+
+
+def current_context():
+    return dict(getattr(context, "values", {}))
+
+
+def start_log_context(**values):
+    # replaces the whole context of the calling thread, used when a thread starts a new job
+    context.values = values
+
+
+def set_log_context(**values):
+    context.values = dict(current_context(), **values)
+
+
+@contextmanager
+def log_context(**values):
+    previous = current_context()
+    context.values = dict(previous, **values)
+    try:
+        yield
+    finally:
+        context.values = previous
+
+
+class ContextFilter(logging.Filter):
+    # runs in the thread emitting the record, so the thread local context is still available
+
+    def filter(self, record):
+        values = current_context()
+        for key in CONTEXT_FIELDS + ["log_file"]:
+            if not hasattr(record, key):
+                setattr(record, key, values.get(key))
+        return True
+
+
+class ProgressFilter(logging.Filter):
+    # token bucket shared by all transfers: progress records above the rate are dropped
+    # before they reach the queue, every other record always passes
+
+    def __init__(self, rate=PROGRESS_RATE):
+        super().__init__()
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if not getattr(record, "progress", False):
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        document = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "message": record.getMessage(),
+            "thread": record.threadName,
+        }
+        for key in CONTEXT_FIELDS:
+            if getattr(record, key, None) is not None:
+                document[key] = getattr(record, key)
+        for key in [
+            "progress",
+            "bytes",
+            "total",
+            "rate",
+            "freeze_duration",
+            "transfer_path",
+            "api_calls",
+        ]:
+            if hasattr(record, key):
+                document[key] = getattr(record, key)
+        return json.dumps(document)
+
+
+class JobFileHandler(logging.Handler):
+    # one log file per job, opened on the first record of the job
+
+    def __init__(self):
+        super().__init__()
+        self.files = {}
+
+    def emit(self, record):
+        log_file = getattr(record, "log_file", None)
+        if not log_file:
+            return
+        if log_file not in self.files:
+            handler = logging.FileHandler(log_file, mode="w")
+            handler.setFormatter(self.formatter)
+            self.files[log_file] = handler
+        self.files[log_file].emit(record)
+
+    def close_file(self, log_file):
+        handler = self.files.pop(log_file, None)
+        if handler:
+            handler.close()
+
+    def close(self):
+        for handler in self.files.values():
+            handler.close()
+        self.files = {}
+        super().close()
+
+
+class SaviorListener(QueueListener):
+    def handle(self, record):
+        # actions are executed in order with the records queued before them
+        action = getattr(record, "savior_action", None)
+        if action is not None:
+            action()
+            return
+        super().handle(record)
+
+
+def setup_logging(log_directory=LOG_DIRECTORY, json_log=True):
+    if pipeline:
+        return main_logger
+
+    formatter_file = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    formatter_stdout = logging.Formatter("%(message)s")
+
+    stdout_handler = logging.StreamHandler(sys.stdout)
+    stdout_handler.setFormatter(formatter_stdout)
+    global_file_handler = logging.FileHandler(os.path.join(log_directory, GLOBAL_LOGGER_FILE))
+    global_file_handler.setFormatter(formatter_file)
+    job_file_handler = JobFileHandler()
+    job_file_handler.setFormatter(formatter_file)
+    handlers = [stdout_handler, global_file_handler, job_file_handler]
+    if json_log:
+        json_handler = logging.FileHandler(os.path.join(log_directory, JSON_LOGGER_FILE))
+        json_handler.setFormatter(JsonFormatter())
+        handlers.append(json_handler)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    queue_handler.addFilter(ProgressFilter())
+    main_logger.addHandler(queue_handler)
+
+    listener = SaviorListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    pipeline.update(
+        {
+            "queue": log_queue,
+            "listener": listener,
+            "job_files": job_file_handler,
+            "log_directory": log_directory,
+        }
+    )
+    atexit.register(stop_logging)
+    return main_logger
+
+
+def run_in_listener(action, wait=True):
+    if not pipeline:
+        action()
+        return
+    done = threading.Event()
+
+    def run():
+        try:
+            action()
+        finally:
+            done.set()
+
+    pipeline["queue"].put(logging.makeLogRecord({"savior_action": run}))
+    if wait:
+        done.wait(FLUSH_TIMEOUT)
+
+
+def flush_logs():
+    run_in_listener(lambda: None)
+
+
+def job_log_file(job_id=None):
+    # a single job run from the command line keeps the historical savior.log
+    log_directory = pipeline.get("log_directory", LOG_DIRECTORY)
+    if job_id is None:
+        return os.path.join(log_directory, VM_LOGGER_FILE)
+    return os.path.join(log_directory, "savior_%s.log" % job_id)
+
+
+def close_job_log(log_file):
+    if pipeline:
+        run_in_listener(lambda: pipeline["job_files"].close_file(log_file))
+
+
+def stop_logging():
+    if pipeline:
+        pipeline["listener"].stop()
+        for handler in pipeline["listener"].handlers:
+            handler.close()
+        pipeline.clear()
@@ -0,0 +1,209 @@
+import heapq
+import threading
+import time
+import uuid
+from collections import deque
+
+MAX_JOBS = 2
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCESS = "success"
+FAILED = "failed"
+
+current = threading.local()
+
+
+def current_job():
+    return getattr(current, "job", None)
+
+
+def check_cancelled():
+    job = current_job()
+    if job is not None:
+        job.check_cancelled()
+
+
+def job_priority(job, now):
+    # jobs with a deadline go first, the one with the least slack before the others, then the
+    # longest predicted jobs so that the short ones fill the gaps at the end of the window
+    estimate = job.estimate or 0
+    slack = job.deadline - now - estimate if job.deadline else float("inf")
+    return (slack, -estimate)
+
+
+class Job:
+    def __init__(self, mode, setup_file, vm_name=None, estimate=None, deadline=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.mode = mode
+        self.setup_file = setup_file
+        self.vm_name = vm_name
+        self.state = QUEUED
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.bytes = 0
+        # zeroes neither stored nor sent, e.g. zero clusters of qcow2 backups
+        self.zero_bytes = 0
+        self.freeze_duration = None
+        self.estimate = estimate
+        self.deadline = deadline
+        self.cancelled = None
+        self.lock = threading.Lock()
+
+    def add_bytes(self, n):
+        with self.lock:
+            self.bytes += n
+
+    def add_zero_bytes(self, n):
+        with self.lock:
+            self.zero_bytes += n
+
+    def cancel(self, reason):
+        self.cancelled = reason
+
+    def check_cancelled(self):
+        # called where a running job can stop: every transferred chunk and every status poll
+        if self.cancelled is not None:
+            raise ValueError("Job %s cancelled: %s" % (self.id, self.cancelled))
+
+    def duration(self):
+        if self.started is None:
+            return 0
+        return (self.finished or time.time()) - self.started
+
+    def throughput(self):
+        duration = self.duration()
+        if duration == 0:
+            return 0
+        return self.bytes / duration
+
+    def information(self):
+        return {
+            "id": self.id,
+            "mode": self.mode,
+            "setup_file": self.setup_file,
+            "vm_name": self.vm_name,
+            "state": self.state,
+            "error": self.error,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+            "duration": self.duration(),
+            "bytes": self.bytes,
+            "throughput": self.throughput(),
+            "zero_bytes": self.zero_bytes,
+            "freeze_duration": self.freeze_duration,
+            "estimate": self.estimate,
+            "deadline": self.deadline,
+        }
+
+
+class Scheduler:
+    def __init__(self, run_job, max_jobs=MAX_JOBS, logger=None):
+        self.run_job = run_job
+        self.max_jobs = max_jobs
+        self.logger = logger
+        self.queue = deque()
+        self.jobs = {}
+        self.active_vms = set()
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.workers = []
+
+    def start(self):
+        for i in range(self.max_jobs):
+            worker = threading.Thread(target=self.work, name="savior-job-%d" % i, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, job):
+        with self.condition:
+            if self.stopping:
+                raise ValueError("The scheduler is shutting down, job not accepted")
+            self.jobs[job.id] = job
+            self.queue.append(job)
+            self.condition.notify()
+        if self.logger:
+            self.logger.info(
+                "Queued %s job %s for %s" % (job.mode, job.id, job.vm_name or job.setup_file)
+            )
+        return job
+
+    def next_job(self):
+        # jobs on the same VM never run at the same time, among the others the job with the
+        # best priority is picked, queue order breaks ties
+        now = time.time()
+        candidates = [
+            x for x in self.queue if x.vm_name is None or x.vm_name not in self.active_vms
+        ]
+        if not candidates:
+            return None
+        job = min(candidates, key=lambda x: job_priority(x, now))
+        self.queue.remove(job)
+        return job
+
+    def work(self):
+        while True:
+            with self.condition:
+                while True:
+                    if self.stopping:
+                        return
+                    job = self.next_job()
+                    if job is not None:
+                        break
+                    self.condition.wait()
+                if job.vm_name:
+                    self.active_vms.add(job.vm_name)
+                job.state = RUNNING
+                job.started = time.time()
+
+            current.job = job
+            try:
+                self.run_job(job)
+                job.state = SUCCESS
+            except Exception as exc:
+                job.state = FAILED
+                job.error = str(exc)
+                if self.logger:
+                    self.logger.error("Job %s failed: %s" % (job.id, exc), exc_info=exc)
+            finally:
+                current.job = None
+                job.finished = time.time()
+                with self.condition:
+                    self.active_vms.discard(job.vm_name)
+                    self.condition.notify_all()
+
+    def status(self):
+        with self.condition:
+            return [x.information() for x in self.jobs.values()]
+
+    def idle(self):
+        with self.condition:
+            return not self.queue and not [x for x in self.jobs.values() if x.state == RUNNING]
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def stop(self, wait=True):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        if wait:
+            for worker in self.workers:
+                worker.join()
+
+
+def plan(jobs, max_jobs=MAX_JOBS, start=None):
+    # predicted (job, start, end) of every job when run by a scheduler with max_jobs workers
+    now = time.time() if start is None else start
+    queue = sorted(jobs, key=lambda x: job_priority(x, now))
+    slots = [now] * max_jobs
+    planned = []
+    for job in queue:
+        begin = heapq.heappop(slots)
+        end = begin + (job.estimate or 0)
+        heapq.heappush(slots, end)
+        planned.append((job, begin, end))
+    return planned
@@ -0,0 +1,764 @@
+import json
+import random
+import re
+import socket
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+
+import ovirtsdk4 as sdk
+from ovirtsdk4 import types
+
+SIM_VMS = 10
+SIM_DISKS = (1, 3)
+SIM_DISK_SIZE = (64 * 1024 * 1024, 1024 * 1024 * 1024)
+SIM_SPARSITY = 0.5
+SIM_BLOCK_SIZE = 1024 * 1024
+SIM_STORAGE_DOMAINS = 2
+SIM_HOSTS = 2
+SIM_SEED = 0
+API_LATENCY = 0.005
+SNAPSHOT_DELAY = 2
+SNAPSHOT_REMOVE_DELAY = 2
+TRANSFER_DELAY = 1
+DISK_DELAY = 3
+PROXY_DELAY = 0.001
+
+
+def jitter(rng, delay):
+    # phases of a real engine never take exactly the same time
+    return delay * rng.uniform(0.5, 1.5)
+
+
+class SimDisk:
+    def __init__(self, name, size, sparsity, storage_domain, rng):
+        self.id = str(uuid.uuid4())
+        self.image_id = str(uuid.uuid4())
+        self.name = name
+        self.size = size
+        self.format = types.DiskFormat.RAW
+        self.storage_domain = storage_domain
+        self.ready_at = 0
+        self.written = 0
+        # one allocation flag per block, the data of allocated blocks is derived from the
+        # pattern so that nothing but the flags is kept in memory
+        blocks = -(-size // SIM_BLOCK_SIZE)
+        self.allocated = bytes([rng.random() >= sparsity for _ in range(blocks)])
+        self.shift = rng.randrange(SIM_BLOCK_SIZE // 512) * 512
+
+    def actual_size(self):
+        return sum(self.allocated) * SIM_BLOCK_SIZE
+
+    def status(self, now):
+        return types.DiskStatus.OK if now >= self.ready_at else types.DiskStatus.LOCKED
+
+    def info(self, now, image_id=None, format=None):
+        return types.Disk(
+            id=self.id,
+            image_id=image_id or self.image_id,
+            name=self.name,
+            description="Simulated disk %s" % self.name,
+            status=self.status(now),
+            format=format or self.format,
+            sparse=True,
+            provisioned_size=self.size,
+            actual_size=self.actual_size(),
+            initial_size=None,
+            total_size=self.actual_size(),
+            interface=types.DiskInterface.VIRTIO_SCSI,
+            storage_domains=[types.StorageDomain(id=self.storage_domain)],
+        )
+
+    def chunks(self, pattern, start, end):
+        # content of the bytes start..end (inclusive) as a sequence of slices
+        offset = start
+        while offset <= end:
+            index = offset // SIM_BLOCK_SIZE
+            position = offset % SIM_BLOCK_SIZE
+            length = min(SIM_BLOCK_SIZE - position, end - offset + 1)
+            if self.allocated[index]:
+                shift = (self.shift + index * 512) % SIM_BLOCK_SIZE + position
+                yield pattern[shift : shift + length]
+            else:
+                yield bytes(length)
+            offset += length
+
+
+class SimSnapshot:
+    def __init__(self, description, disks, ready_at, snapshot_type=types.SnapshotType.REGULAR):
+        self.id = str(uuid.uuid4())
+        self.description = description
+        self.date = datetime.now()
+        self.snapshot_type = snapshot_type
+        self.ready_at = ready_at
+        self.removed_at = None
+        # (disk, image id, format) of every disk layer of the snapshot
+        self.images = [(x, x.image_id, x.format) for x in disks]
+
+    def info(self, now):
+        status = types.SnapshotStatus.OK if now >= self.ready_at else types.SnapshotStatus.LOCKED
+        return types.Snapshot(
+            id=self.id,
+            description=self.description,
+            date=self.date,
+            snapshot_type=self.snapshot_type,
+            snapshot_status=status,
+        )
+
+
+class SimVm:
+    def __init__(self, name, memory, disks=None):
+        self.id = str(uuid.uuid4())
+        self.name = name
+        self.memory = memory
+        self.disks = disks or []
+        self.status = types.VmStatus.UP
+        self.snapshots = [SimSnapshot("Active VM", [], 0, types.SnapshotType.ACTIVE)]
+
+    def info(self):
+        return types.Vm(
+            id=self.id,
+            name=self.name,
+            memory=self.memory,
+            status=self.status,
+            cpu=types.Cpu(architecture=types.Architecture.X86_64),
+        )
+
+
+class SimTransfer:
+    def __init__(self, disk, image_id, direction, host, ready_at, failing):
+        self.id = str(uuid.uuid4())
+        self.disk = disk
+        self.image_id = image_id
+        self.direction = direction
+        self.host = host
+        self.ready_at = ready_at
+        self.failing = failing
+        self.phase = None
+
+    def current_phase(self, now):
+        if self.phase is not None:
+            return self.phase
+        if now < self.ready_at:
+            return types.ImageTransferPhase.INITIALIZING
+        return types.ImageTransferPhase.TRANSFERRING
+
+
+class Engine:
+    # state of the simulated engine, shared by the API services and the imageio endpoints.
+    # Phases (snapshot creation, disk provisioning, transfer initialization) end at a given
+    # time and are only evaluated when polled, so no background thread is needed.
+
+    def __init__(
+        self,
+        vms=SIM_VMS,
+        disks=SIM_DISKS,
+        disk_size=SIM_DISK_SIZE,
+        sparsity=SIM_SPARSITY,
+        storage_domains=SIM_STORAGE_DOMAINS,
+        hosts=SIM_HOSTS,
+        seed=SIM_SEED,
+        api_latency=API_LATENCY,
+        snapshot_delay=SNAPSHOT_DELAY,
+        snapshot_remove_delay=SNAPSHOT_REMOVE_DELAY,
+        transfer_delay=TRANSFER_DELAY,
+        disk_delay=DISK_DELAY,
+        proxy_delay=PROXY_DELAY,
+        api_failures=0,
+        snapshot_failures=0,
+        transfer_failures=0,
+        request_failures=0,
+    ):
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.api_latency = api_latency
+        self.snapshot_delay = snapshot_delay
+        self.snapshot_remove_delay = snapshot_remove_delay
+        self.transfer_delay = transfer_delay
+        self.disk_delay = disk_delay
+        self.proxy_delay = proxy_delay
+        self.api_failures = api_failures
+        self.snapshot_failures = snapshot_failures
+        self.transfer_failures = transfer_failures
+        self.request_failures = request_failures
+        self.pattern = self.rng.randbytes(SIM_BLOCK_SIZE * 2)
+        self.storage_domains = [
+            types.StorageDomain(id=str(uuid.uuid4()), name="sim-sd-%d" % i)
+            for i in range(storage_domains)
+        ]
+        self.hosts = [
+            types.Host(id=str(uuid.uuid4()), name="sim-host-%d" % i) for i in range(hosts)
+        ]
+        self.vms = {}
+        self.disks = {}
+        self.transfers = {}
+        self.base_url = None
+
+        for i in range(vms):
+            vm_disks = []
+            for j in range(self.rng.randint(*disks)):
+                size = self.rng.randint(*disk_size) // SIM_BLOCK_SIZE * SIM_BLOCK_SIZE
+                disk_sparsity = min(1.0, max(0.0, self.rng.gauss(sparsity, 0.15)))
+                domain = self.rng.choice(self.storage_domains).id
+                vm_disks.append(
+                    SimDisk(
+                        "sim-vm-%04d_Disk%d" % (i, j + 1),
+                        max(size, SIM_BLOCK_SIZE),
+                        disk_sparsity,
+                        domain,
+                        self.rng,
+                    )
+                )
+            self.add_vm(SimVm("sim-vm-%04d" % i, self.rng.choice([2, 4, 8]) * 1024**3, vm_disks))
+
+    def add_vm(self, vm):
+        self.vms[vm.id] = vm
+        for disk in vm.disks:
+            self.disks[disk.id] = disk
+        return vm
+
+    def call(self, name):
+        # every API request costs a round trip and may fail
+        self.calls[name] += 1
+        if self.api_latency:
+            time.sleep(self.api_latency)
+        if self.api_failures and self.rng.random() < self.api_failures:
+            raise sdk.Error("Simulated engine failure in %s" % name)
+
+    def fleet_size(self):
+        return {
+            "vms": len(self.vms),
+            "disks": len(self.disks),
+            "provisioned_size": sum([x.size for x in self.disks.values()]),
+            "actual_size": sum([x.actual_size() for x in self.disks.values()]),
+        }
+
+    def get_vm(self, vm_id):
+        if vm_id not in self.vms:
+            raise sdk.NotFoundError("VM %s not found" % vm_id)
+        return self.vms[vm_id]
+
+    def get_disk(self, disk_id):
+        if disk_id not in self.disks:
+            raise sdk.NotFoundError("Disk %s not found" % disk_id)
+        return self.disks[disk_id]
+
+    def find_image(self, image_id):
+        # the disk and format of a snapshot layer
+        for vm in self.vms.values():
+            for snapshot in vm.snapshots:
+                for disk, snapshot_image, format in snapshot.images:
+                    if snapshot_image == image_id:
+                        return disk, format
+        raise sdk.NotFoundError("Disk snapshot %s not found" % image_id)
+
+    def get_snapshot(self, vm_id, snapshot_id, now):
+        vm = self.get_vm(vm_id)
+        for snapshot in self.live_snapshots(vm, now):
+            if snapshot.id == snapshot_id:
+                return vm, snapshot
+        raise sdk.NotFoundError("Snapshot %s not found" % snapshot_id)
+
+    def live_snapshots(self, vm, now):
+        # removed and failed snapshots disappear once their removal is over
+        vm.snapshots = [x for x in vm.snapshots if x.removed_at is None or now < x.removed_at]
+        return vm.snapshots
+
+    def add_snapshot(self, vm, description):
+        now = time.monotonic()
+        snapshot = SimSnapshot(description, vm.disks, now + jitter(self.rng, self.snapshot_delay))
+        if self.snapshot_failures and self.rng.random() < self.snapshot_failures:
+            # the engine rolls a failed snapshot back, it is gone when the creation ends
+            snapshot.removed_at = snapshot.ready_at
+        else:
+            for disk in vm.disks:
+                disk.image_id = str(uuid.uuid4())
+                disk.format = types.DiskFormat.COW
+                disk.ready_at = snapshot.ready_at
+        vm.snapshots.append(snapshot)
+        return snapshot
+
+    def remove_snapshot(self, vm, snapshot):
+        now = time.monotonic()
+        snapshot.removed_at = now + jitter(self.rng, self.snapshot_remove_delay)
+        # merging the layer back gives the disks their previous image, as long as the removed
+        # snapshot was the last one
+        for disk, image_id, format in snapshot.images:
+            disk.image_id = image_id
+            disk.format = format
+            disk.ready_at = snapshot.removed_at
+
+    def add_disk(self, vm, disk_info):
+        domain = self.storage_domains[0].id
+        for storage_domain in disk_info.storage_domains or []:
+            for candidate in self.storage_domains:
+                if candidate.id == storage_domain.id or candidate.name == storage_domain.name:
+                    domain = candidate.id
+        # restored disks are empty until something is uploaded
+        disk = SimDisk(disk_info.name, disk_info.provisioned_size, 1.0, domain, self.rng)
+        disk.format = disk_info.format or types.DiskFormat.RAW
+        disk.ready_at = time.monotonic() + jitter(self.rng, self.disk_delay)
+        vm.disks.append(disk)
+        self.disks[disk.id] = disk
+        return disk
+
+    def add_transfer(self, image_transfer):
+        if image_transfer.snapshot is not None:
+            disk, format = self.find_image(image_transfer.snapshot.id)
+            image_id = image_transfer.snapshot.id
+        else:
+            disk = self.get_disk(image_transfer.disk.id)
+            image_id = disk.image_id
+        if image_transfer.host is not None:
+            host = image_transfer.host.id
+        else:
+            host = self.hosts[len(self.transfers) % len(self.hosts)].id
+        failing = bool(self.transfer_failures and self.rng.random() < self.transfer_failures)
+        transfer = SimTransfer(
+            disk,
+            image_id,
+            image_transfer.direction or types.ImageTransferDirection.DOWNLOAD,
+            host,
+            time.monotonic() + jitter(self.rng, self.transfer_delay),
+            failing,
+        )
+        self.transfers[transfer.id] = transfer
+        return transfer
+
+    def transfer_info(self, transfer):
+        phase = transfer.current_phase(time.monotonic())
+        info = types.ImageTransfer(
+            id=transfer.id,
+            phase=phase,
+            direction=transfer.direction,
+            host=types.Host(id=transfer.host),
+        )
+        if phase == types.ImageTransferPhase.TRANSFERRING:
+            info.transfer_url = "%s/images/%s" % (self.base_url, transfer.id)
+            info.proxy_url = "%s/proxy/images/%s" % (self.base_url, transfer.id)
+        return info
+
+    def ticket(self, ticket_id):
+        transfer = self.transfers.get(ticket_id)
+        if transfer is None:
+            return None
+        if transfer.current_phase(time.monotonic()) != types.ImageTransferPhase.TRANSFERRING:
+            return None
+        return transfer
+
+
+def search_name(search):
+    # only the "name=<value>" searches of the tool are understood, * matches anything
+    if not search:
+        return None
+    match = re.match(r"name=(\S+)", search)
+    if match is None:
+        raise sdk.Error("Unsupported search %s" % search)
+    return re.compile(re.escape(match.group(1)).replace(r"\*", ".*") + "$")
+
+
+class SimService:
+    def __init__(self, engine):
+        self.engine = engine
+
+
+class SimVmsService(SimService):
+    def list(self, search=None, all_content=False, **kwargs):
+        self.engine.call("vms.list")
+        pattern = search_name(search)
+        with self.engine.lock:
+            vms = list(self.engine.vms.values())
+        return [x.info() for x in vms if pattern is None or pattern.match(x.name)]
+
+    def add(self, vm, **kwargs):
+        self.engine.call("vms.add")
+        with self.engine.lock:
+            if any([x.name == vm.name for x in self.engine.vms.values()]):
+                raise sdk.Error("VM name %s is already in use" % vm.name)
+            sim_vm = self.engine.add_vm(SimVm(vm.name, vm.memory or 1024**3))
+            sim_vm.status = types.VmStatus.DOWN
+        return sim_vm.info()
+
+    def vm_service(self, id):
+        return SimVmService(self.engine, id)
+
+
+class SimVmService(SimService):
+    def __init__(self, engine, vm_id):
+        super().__init__(engine)
+        self.vm_id = vm_id
+
+    def get(self, **kwargs):
+        self.engine.call("vm.get")
+        with self.engine.lock:
+            return self.engine.get_vm(self.vm_id).info()
+
+    def snapshots_service(self):
+        return SimSnapshotsService(self.engine, self.vm_id)
+
+    def disk_attachments_service(self):
+        return SimDiskAttachmentsService(self.engine, self.vm_id)
+
+
+class SimSnapshotsService(SimService):
+    def __init__(self, engine, vm_id):
+        super().__init__(engine)
+        self.vm_id = vm_id
+
+    def list(self, all_content=False, **kwargs):
+        self.engine.call("snapshots.list")
+        now = time.monotonic()
+        with self.engine.lock:
+            vm = self.engine.get_vm(self.vm_id)
+            return [x.info(now) for x in self.engine.live_snapshots(vm, now)]
+
+    def add(self, snapshot, **kwargs):
+        self.engine.call("snapshots.add")
+        with self.engine.lock:
+            vm = self.engine.get_vm(self.vm_id)
+            now = time.monotonic()
+            busy = [x for x in self.engine.live_snapshots(vm, now) if now < x.ready_at]
+            if busy or any([x.status(now) != types.DiskStatus.OK for x in vm.disks]):
+                raise sdk.Error("Cannot create snapshot, the disks of VM %s are locked" % vm.name)
+            return self.engine.add_snapshot(vm, snapshot.description).info(now)
+
+    def snapshot_service(self, id):
+        return SimSnapshotService(self.engine, self.vm_id, id)
+
+
+class SimSnapshotService(SimService):
+    def __init__(self, engine, vm_id, snapshot_id):
+        super().__init__(engine)
+        self.vm_id = vm_id
+        self.snapshot_id = snapshot_id
+
+    def get(self, **kwargs):
+        self.engine.call("snapshot.get")
+        now = time.monotonic()
+        with self.engine.lock:
+            return self.engine.get_snapshot(self.vm_id, self.snapshot_id, now)[1].info(now)
+
+    def remove(self, **kwargs):
+        self.engine.call("snapshot.remove")
+        now = time.monotonic()
+        with self.engine.lock:
+            vm, snapshot = self.engine.get_snapshot(self.vm_id, self.snapshot_id, now)
+            if now < snapshot.ready_at or snapshot.removed_at is not None:
+                raise sdk.Error("Cannot remove snapshot %s, it is locked" % snapshot.id)
+            self.engine.remove_snapshot(vm, snapshot)
+
+    def disks_service(self):
+        return SimSnapshotDisksService(self.engine, self.vm_id, self.snapshot_id)
+
+
+class SimSnapshotDisksService(SimService):
+    def __init__(self, engine, vm_id, snapshot_id):
+        super().__init__(engine)
+        self.vm_id = vm_id
+        self.snapshot_id = snapshot_id
+
+    def list(self, **kwargs):
+        self.engine.call("snapshot_disks.list")
+        now = time.monotonic()
+        with self.engine.lock:
+            snapshot = self.engine.get_snapshot(self.vm_id, self.snapshot_id, now)[1]
+            return [x.info(now, image_id, format) for x, image_id, format in snapshot.images]
+
+    def disk_service(self, id):
+        return SimDiskService(self.engine, id)
+
+
+class SimDiskAttachmentsService(SimService):
+    def __init__(self, engine, vm_id):
+        super().__init__(engine)
+        self.vm_id = vm_id
+
+    def list(self, **kwargs):
+        self.engine.call("disk_attachments.list")
+        with self.engine.lock:
+            vm = self.engine.get_vm(self.vm_id)
+            return [types.DiskAttachment(id=x.id, disk=types.Disk(id=x.id)) for x in vm.disks]
+
+    def add(self, attachment, **kwargs):
+        self.engine.call("disk_attachments.add")
+        with self.engine.lock:
+            vm = self.engine.get_vm(self.vm_id)
+            disk = self.engine.add_disk(vm, attachment.disk)
+        return types.DiskAttachment(id=disk.id, disk=types.Disk(id=disk.id))
+
+
+class SimDisksService(SimService):
+    def list(self, search=None, **kwargs):
+        self.engine.call("disks.list")
+        now = time.monotonic()
+        pattern = search_name(search)
+        with self.engine.lock:
+            disks = list(self.engine.disks.values())
+            return [x.info(now) for x in disks if pattern is None or pattern.match(x.name)]
+
+    def disk_service(self, id):
+        return SimDiskService(self.engine, id)
+
+
+class SimDiskService(SimService):
+    def __init__(self, engine, disk_id):
+        super().__init__(engine)
+        self.disk_id = disk_id
+
+    def get(self, **kwargs):
+        self.engine.call("disk.get")
+        with self.engine.lock:
+            return self.engine.get_disk(self.disk_id).info(time.monotonic())
+
+
+class SimImageTransfersService(SimService):
+    def list(self, **kwargs):
+        self.engine.call("image_transfers.list")
+        with self.engine.lock:
+            return [self.engine.transfer_info(x) for x in self.engine.transfers.values()]
+
+    def add(self, image_transfer, **kwargs):
+        self.engine.call("image_transfers.add")
+        with self.engine.lock:
+            return self.engine.transfer_info(self.engine.add_transfer(image_transfer))
+
+    def image_transfer_service(self, id):
+        return SimImageTransferService(self.engine, id)
+
+
+class SimImageTransferService(SimService):
+    def __init__(self, engine, transfer_id):
+        super().__init__(engine)
+        self.transfer_id = transfer_id
+
+    def transfer(self):
+        if self.transfer_id not in self.engine.transfers:
+            raise sdk.NotFoundError("Image transfer %s not found" % self.transfer_id)
+        return self.engine.transfers[self.transfer_id]
+
+    def get(self, **kwargs):
+        self.engine.call("image_transfer.get")
+        with self.engine.lock:
+            return self.engine.transfer_info(self.transfer())
+
+    def finalize(self, **kwargs):
+        self.engine.call("image_transfer.finalize")
+        with self.engine.lock:
+            self.transfer().phase = types.ImageTransferPhase.FINISHED_SUCCESS
+
+    def cancel(self, **kwargs):
+        self.engine.call("image_transfer.cancel")
+        with self.engine.lock:
+            self.transfer().phase = types.ImageTransferPhase.FINISHED_FAILURE
+
+
+class SimListService(SimService):
+    def __init__(self, engine, name, items):
+        super().__init__(engine)
+        self.name = name
+        self.items = items
+
+    def list(self, search=None, **kwargs):
+        self.engine.call("%s.list" % self.name)
+        pattern = search_name(search)
+        return [x for x in self.items if pattern is None or pattern.match(x.name)]
+
+
+class SimSystemService(SimService):
+    def vms_service(self):
+        return SimVmsService(self.engine)
+
+    def disks_service(self):
+        return SimDisksService(self.engine)
+
+    def image_transfers_service(self):
+        return SimImageTransfersService(self.engine)
+
+    def storage_domains_service(self):
+        return SimListService(self.engine, "storage_domains", self.engine.storage_domains)
+
+    def hosts_service(self):
+        return SimListService(self.engine, "hosts", self.engine.hosts)
+
+
+class SimConnection:
+    # stands for ovirtsdk4.Connection, pass it as connection to OvirtHandler
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def authenticate(self):
+        self.engine.call("authenticate")
+
+    def system_service(self):
+        return SimSystemService(self.engine)
+
+    def close(self):
+        pass
+
+
+class ImageioHandler(BaseHTTPRequestHandler):
+    # the part of the imageio protocol used by the transfer client: OPTIONS, ranged GET,
+    # PUT with Content-Range and PATCH zero/flush. Uploaded data is counted, not stored.
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, code, content=b"", headers=None):
+        self.send_response(code)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        left = length
+        while left:
+            data = self.rfile.read(min(left, SIM_BLOCK_SIZE))
+            if not data:
+                break
+            left -= len(data)
+        return length
+
+    def ticket(self, write=False, any_direction=False):
+        server = self.server
+        server.count("requests")
+        path = urlsplit(self.path).path
+        if path.startswith("/proxy/"):
+            time.sleep(server.engine.proxy_delay)
+            path = path[len("/proxy") :]
+        transfer = server.engine.ticket(path.rsplit("/", 1)[-1])
+        if transfer is None:
+            self.reply(404, b"No such ticket")
+            return None
+        upload = transfer.direction == types.ImageTransferDirection.UPLOAD
+        if not any_direction and write != upload:
+            self.reply(403, b"Operation not allowed by the ticket")
+            return None
+        if server.engine.request_failures and server.random() < server.engine.request_failures:
+            # a network failure in the middle of a transfer
+            self.drop()
+            return None
+        return transfer
+
+    def failing(self, transfer, end):
+        # a failing transfer breaks down once half of the disk went through
+        return transfer.failing and end >= transfer.disk.size // 2
+
+    def drop(self):
+        self.server.count("failed_requests")
+        self.close_connection = True
+        self.connection.shutdown(socket.SHUT_RDWR)
+
+    def do_OPTIONS(self):
+        if self.ticket(any_direction=True) is None:
+            return
+        options = {"features": ["zero", "flush"], "max_readers": 8, "max_writers": 8}
+        self.reply(200, json.dumps(options).encode("utf8"), {"Allow": "OPTIONS,GET,PUT,PATCH"})
+
+    def do_GET(self):
+        transfer = self.ticket()
+        if transfer is None:
+            return
+        disk = transfer.disk
+        start, end = 0, disk.size - 1
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or end), disk.size - 1)
+        self.send_response(206 if match else 200)
+        if match:
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, disk.size))
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        offset = start
+        for chunk in disk.chunks(self.server.engine.pattern, start, end):
+            if self.failing(transfer, offset):
+                self.drop()
+                return
+            self.wfile.write(chunk)
+            offset += len(chunk)
+            self.server.count("bytes_read", len(chunk))
+
+    def do_PUT(self):
+        transfer = self.ticket(write=True)
+        if transfer is None:
+            self.close_connection = True
+            return
+        match = re.match(r"bytes \d+-(\d+)", self.headers.get("Content-Range", ""))
+        if match and self.failing(transfer, int(match.group(1))):
+            self.drop()
+            return
+        length = self.read_body()
+        self.server.count("bytes_written", length)
+        with self.server.counters_lock:
+            transfer.disk.written += length
+        self.reply(200)
+
+    def do_PATCH(self):
+        length = int(self.headers.get("Content-Length", 0))
+        operation = json.loads(self.rfile.read(length) or b"{}")
+        transfer = self.ticket(write=True)
+        if transfer is None:
+            return
+        if operation.get("op") == "zero":
+            self.server.count("bytes_zeroed", operation.get("size", 0))
+        self.reply(200)
+
+
+class ImageioServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, engine, address):
+        super().__init__(address, ImageioHandler)
+        self.engine = engine
+        self.counters = Counter()
+        self.counters_lock = threading.Lock()
+        self.rng = random.Random(SIM_SEED)
+
+    def count(self, name, n=1):
+        with self.counters_lock:
+            self.counters[name] += n
+
+    def random(self):
+        with self.counters_lock:
+            return self.rng.random()
+
+
+class Simulator:
+    # a simulated engine with its imageio endpoint on a local port
+
+    def __init__(self, host="127.0.0.1", port=0, **engine_options):
+        self.engine = Engine(**engine_options)
+        self.server = ImageioServer(self.engine, (host, port))
+        self.engine.base_url = "http://%s:%d" % (host, self.server.server_port)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, name="imageio-simulator", daemon=True
+        )
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def connection(self):
+        return SimConnection(self.engine)
+
+    def statistics(self):
+        return {
+            "api_calls": dict(self.engine.calls),
+            "imageio": dict(self.server.counters),
+        }
@@ -0,0 +1,166 @@
+import os
+import threading
+import time
+from collections import deque
+
+REPLICA_BUFFER = 1024 * 1024 * 256
+
+
+class FileSink:
+    # a single destination, written directly by the calling I/O thread
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.tmp_file_name = file_name + ".tmp"
+        self.fd = None
+        self.bytes = 0
+        self.t0 = None
+        self.error = None
+
+    def open(self):
+        self.t0 = time.monotonic()
+        self.fd = os.open(self.tmp_file_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+
+    def truncate(self, size):
+        os.ftruncate(self.fd, size)
+
+    def write(self, data, offset):
+        os.pwrite(self.fd, data, offset)
+        self.bytes += len(data)
+
+    def close(self, success=True):
+        if self.fd is None:
+            return
+        os.close(self.fd)
+        self.fd = None
+        if success and self.error is None:
+            if os.path.isfile(self.file_name):
+                os.remove(self.file_name)
+            os.rename(self.tmp_file_name, self.file_name)
+
+    def results(self):
+        return [self.result()]
+
+    def result(self):
+        duration = time.monotonic() - self.t0 if self.t0 else 0
+        return {
+            "path": self.file_name,
+            "completed": self.error is None,
+            "bytes": self.bytes,
+            "throughput": self.bytes / duration if duration else 0,
+            "max_lag": 0,
+            "error": self.error,
+        }
+
+
+class ReplicaWriter(threading.Thread):
+    # writes one destination from its own bounded queue, a full queue blocks the producer
+
+    def __init__(self, sink, buffer_size=REPLICA_BUFFER):
+        super().__init__(name="tee-%s" % os.path.basename(sink.file_name), daemon=True)
+        self.sink = sink
+        self.buffer_size = buffer_size
+        self.queue = deque()
+        self.buffered = 0
+        self.condition = threading.Condition()
+        self.closing = False
+        self.finished = None
+        self.max_lag = 0
+
+    def put(self, data, offset):
+        with self.condition:
+            if self.sink.error is not None:
+                return
+            while self.buffered + len(data) > self.buffer_size and self.buffered > 0:
+                self.condition.wait()
+            self.queue.append((data, offset))
+            self.buffered += len(data)
+            self.max_lag = max(self.max_lag, self.buffered)
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closing:
+                    self.condition.wait()
+                if not self.queue:
+                    break
+                data, offset = self.queue[0]
+            try:
+                if self.sink.error is None:
+                    self.sink.write(data, offset)
+            except OSError as exc:
+                # a failed replica is dropped, the other destinations keep going
+                self.sink.error = str(exc)
+            with self.condition:
+                self.queue.popleft()
+                self.buffered -= len(data)
+                self.condition.notify_all()
+        self.finished = time.monotonic()
+
+    def close(self):
+        with self.condition:
+            self.closing = True
+            self.condition.notify_all()
+        self.join()
+
+
+class TeeSink:
+    # fans one incoming stream out to several destinations read only once
+
+    def __init__(self, sinks, buffer_size=REPLICA_BUFFER):
+        self.writers = [ReplicaWriter(x, buffer_size=buffer_size) for x in sinks]
+        self.t0 = None
+
+    def open(self):
+        self.t0 = time.monotonic()
+        for i, writer in enumerate(self.writers):
+            try:
+                writer.sink.open()
+            except OSError as exc:
+                # only the first destination is mandatory
+                if i == 0:
+                    raise
+                writer.sink.error = str(exc)
+            writer.start()
+
+    def truncate(self, size):
+        for writer in self.writers:
+            if writer.sink.error is None:
+                try:
+                    writer.sink.truncate(size)
+                except OSError as exc:
+                    # dropped like a replica failing a write
+                    writer.sink.error = str(exc)
+        if all([x.sink.error is not None for x in self.writers]):
+            raise OSError("All destinations failed: %s" % self.writers[0].sink.error)
+
+    def write(self, data, offset):
+        for writer in self.writers:
+            writer.put(data, offset)
+        if all([x.sink.error is not None for x in self.writers]):
+            raise OSError("All destinations failed: %s" % self.writers[0].sink.error)
+
+    def close(self, success=True):
+        for writer in self.writers:
+            writer.close()
+            writer.sink.close(success=success)
+
+    def results(self):
+        results = []
+        for writer in self.writers:
+            result = writer.sink.result()
+            end = writer.finished or time.monotonic()
+            duration = end - self.t0 if self.t0 else 0
+            result["throughput"] = result["bytes"] / duration if duration else 0
+            result["max_lag"] = writer.max_lag
+            results.append(result)
+        return results
+
+
+def open_sink(file_name, replicas=None, buffer_size=REPLICA_BUFFER, sink_class=FileSink):
+    # sink_class builds the writer of each destination, e.g. a qcow2 converter
+    if not replicas:
+        return sink_class(file_name)
+    sinks = [sink_class(x) for x in [file_name] + list(replicas)]
+    return TeeSink(sinks, buffer_size=buffer_size)
@@ -0,0 +1,158 @@
+import fcntl
+import json
+import os
+import re
+import threading
+import time
+from datetime import datetime
+
+NETWORK = "network"
+DISK = "disk"
+API = "api"
+MOVER = "mover"
+BUDGETS = [NETWORK, DISK, API, MOVER]
+UNITS = {"": 1, "K": 1e3, "M": 1e6, "G": 1e9}
+
+
+def parse_rate(value):
+    # bytes per second with an optional K/M/G suffix, "0" or "" means unlimited
+    value = str(value or "").strip().upper()
+    if not value:
+        return 0
+    match = re.match(r"^([0-9.]+)\s*([KMG]?)B?(/S)?$", value)
+    if not match:
+        raise ValueError("Can not parse rate %s" % value)
+    return float(match.group(1)) * UNITS[match.group(2)]
+
+
+def parse_minutes(value):
+    hours, minutes = value.split(":")
+    return int(hours) * 60 + int(minutes)
+
+
+def parse_profiles(text):
+    # one profile per line: "08:00-18:00 network=50M disk=100M"
+    profiles = []
+    for line in (text or "").splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        period, *limits = line.split()
+        start, end = period.split("-")
+        rates = {}
+        for limit in limits:
+            name, rate = limit.split("=")
+            if name not in BUDGETS:
+                raise ValueError("Unknown throttle budget %s in profile %s" % (name, line))
+            rates[name] = parse_rate(rate)
+        profiles.append((parse_minutes(start), parse_minutes(end), rates))
+    return profiles
+
+
+class Throttle:
+    def __init__(self, rates=None, profiles=None, state_file=None):
+        self.rates = rates or {}
+        self.profiles = profiles or []
+        self.state_file = state_file
+        self.next_free = {}
+        self.lock = threading.Lock()
+        self.waited = dict([(x, 0.0) for x in BUDGETS])
+
+    def rate(self, name, now=None, overrides=None):
+        if overrides and name in overrides:
+            return overrides[name]
+        now = now or datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rates in self.profiles:
+            # a period may wrap around midnight, e.g. 22:00-06:00
+            inside = start <= minute < end if start <= end else minute >= start or minute < end
+            if inside and name in rates:
+                return rates[name]
+        return self.rates.get(name, 0)
+
+    def schedule(self, state, name, n, now, rate):
+        # virtual scheduling: every reservation moves the next free slot of the budget
+        start = max(state.get(name, now), now)
+        state[name] = start + n / rate
+        return start - now
+
+    def reserve(self, name, n):
+        if self.state_file is None:
+            rate = self.rate(name)
+            if not rate:
+                return 0
+            with self.lock:
+                delay = self.schedule(self.next_free, name, n, time.time(), rate)
+        else:
+            delay = self.reserve_shared(name, n)
+        self.waited[name] += delay
+        return delay
+
+    def reserve_shared(self, name, n):
+        # the budget is shared with other processes through a small locked state file
+        with self.lock:
+            fd = os.open(self.state_file, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                data = os.read(fd, 65536)
+                state = json.loads(data) if data else {}
+                rate = self.rate(name, overrides=state.get("rates"))
+                if not rate:
+                    return 0
+                next_free = state.setdefault("next_free", {})
+                delay = self.schedule(next_free, name, n, time.time(), rate)
+                data = json.dumps(state).encode("utf8")
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                os.write(fd, data)
+                return delay
+            finally:
+                os.close(fd)
+
+    def wait(self, name, n):
+        delay = self.reserve(name, n)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire(self, name, n):
+        # asyncio is imported here, the offline commands of catalog reach this module through
+        # history and must start fast
+        import asyncio
+
+        if self.state_file is None:
+            delay = self.reserve(name, n)
+        else:
+            # the state file is locked by other processes too, the event loop never waits on it
+            loop = asyncio.get_running_loop()
+            delay = await loop.run_in_executor(None, self.reserve, name, n)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def set_shared_rates(state_file, rates):
+    # changes the rates of every process using the state file, an empty dict restores
+    # the configured rates and profiles
+    fd = os.open(state_file, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        data = os.read(fd, 65536)
+        state = json.loads(data) if data else {}
+        state["rates"] = rates
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.ftruncate(fd, 0)
+        os.write(fd, json.dumps(state).encode("utf8"))
+    finally:
+        os.close(fd)
+
+
+def throttle_from_params(params):
+    return Throttle(
+        rates={
+            NETWORK: parse_rate(params.get("network_rate", 0)),
+            DISK: parse_rate(params.get("disk_rate", 0)),
+            API: parse_rate(params.get("api_rate", 0)),
+            MOVER: parse_rate(params.get("mover_rate", 0)),
+        },
+        profiles=parse_profiles(params.get("throttle_profiles")),
+        state_file=params.get("throttle_file"),
+    )
@@ -0,0 +1,246 @@
+import fcntl
+import hashlib
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+from readahead import advise
+from savior_logging import main_logger
+from throttle import Throttle, MOVER
+
+POINT_SEPARATOR = "@"
+POINT_FORMAT = "%Y%m%dT%H%M%S"
+FAST_RESTORE_POINTS = 2
+MOVER_INTERVAL = 300
+MOVER_CHUNK = 1024 * 1024 * 4
+BUSY_POLL = 5
+MOVING_SUFFIX = ".moving"
+
+
+def restore_points(directory, vm_name):
+    # (name, path, time) of the complete restore points of a VM in a tier, newest first. The
+    # current backup is <vm_name>, the older ones <vm_name>@<time of their backup>.
+    points = []
+    if not os.path.isdir(directory):
+        return points
+    for name in os.listdir(directory):
+        if name != vm_name and not name.startswith(vm_name + POINT_SEPARATOR):
+            continue
+        settings_file = os.path.join(directory, name, vm_name + ".pickle")
+        if name.endswith(MOVING_SUFFIX) or not os.path.isfile(settings_file):
+            continue
+        points.append((name, os.path.join(directory, name), os.path.getmtime(settings_file)))
+    return sorted(points, key=lambda x: (x[0] == vm_name, x[2]), reverse=True)
+
+
+def rotate(working_directory, vm_name):
+    # keeps the current backup as an older restore point before a new backup overwrites it
+    directory = os.path.join(working_directory, vm_name)
+    settings_file = os.path.join(directory, vm_name + ".pickle")
+    if not os.path.isfile(settings_file):
+        return None
+    stamp = time.strftime(POINT_FORMAT, time.localtime(os.path.getmtime(settings_file)))
+    point = "%s%s%s" % (directory, POINT_SEPARATOR, stamp)
+    os.rename(directory, point)
+    main_logger.info("Previous backup of %s kept as restore point %s" % (vm_name, point))
+    return point
+
+
+def find_restore_point(params, vm_name, point=None):
+    # the fast tier first, then the capacity tier. point is the time of an older restore point
+    # or a prefix of it (e.g. 20240131), the current backup by default.
+    tiers = [params["working_directory"]]
+    if params.get("capacity_directory"):
+        tiers.append(params["capacity_directory"])
+    for tier in tiers:
+        for name, path, _ in restore_points(tier, vm_name):
+            if not point and name == vm_name:
+                return path
+            if point and name.startswith(vm_name + POINT_SEPARATOR + point):
+                return path
+    raise ValueError("No restore point %s of VM %s found" % (point or "(current)", vm_name))
+
+
+@contextmanager
+def open_restore_point(params, vm_name):
+    # the directory of the restore point to read, the mover does not remove it meanwhile
+    if not params.get("capacity_directory") and not params.get("restore_point"):
+        yield os.path.join(params["working_directory"], vm_name)
+        return
+    while True:
+        path = find_restore_point(params, vm_name, params.get("restore_point"))
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            continue
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        # moved to the capacity tier while waiting for the lock
+        if os.path.isdir(path):
+            break
+        os.close(fd)
+    try:
+        main_logger.info("Reading restore point %s" % path)
+        yield path
+    finally:
+        os.close(fd)
+
+
+class Mover:
+    # Moves the restore points older than the keep newest of every VM from the fast tier to the
+    # capacity tier. Every file is copied with the mover budget of the throttle, read back from
+    # the capacity tier and compared with the digest of the original before the restore point
+    # appears there, and only then removed from the fast tier. The copy pauses while busy()
+    # is true (jobs running), a restore point being read by a restore is left for later.
+
+    def __init__(
+        self,
+        fast,
+        capacity,
+        keep=FAST_RESTORE_POINTS,
+        throttle=None,
+        busy=None,
+        interval=MOVER_INTERVAL,
+    ):
+        if keep < 1:
+            raise ValueError("fast_restore_points must be at least 1")
+        self.fast = fast
+        self.capacity = capacity
+        self.keep = keep
+        self.throttle = throttle or Throttle()
+        self.busy = busy
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+        self.moved = 0
+        self.bytes = 0
+        self.failed = {}
+
+    def candidates(self):
+        vm_names = set()
+        for name in os.listdir(self.fast):
+            vm_name = name.split(POINT_SEPARATOR)[0]
+            if os.path.isfile(os.path.join(self.fast, name, vm_name + ".pickle")):
+                vm_names.add(vm_name)
+        points = []
+        for vm_name in sorted(vm_names):
+            points.extend(
+                [(vm_name, x[0]) for x in restore_points(self.fast, vm_name)[self.keep :]]
+            )
+        return points
+
+    def run_once(self):
+        for vm_name, name in self.candidates():
+            if self.stopped.is_set():
+                break
+            try:
+                self.move(vm_name, name)
+            except Exception as exc:
+                if self.stopped.is_set():
+                    break
+                main_logger.error("Could not move restore point %s: %s" % (name, exc), exc_info=exc)
+                self.failed[name] = str(exc)
+        return {"moved": self.moved, "bytes": self.bytes, "failed": self.failed}
+
+    def move(self, vm_name, name):
+        source = os.path.join(self.fast, name)
+        target = os.path.join(self.capacity, name)
+        staging = target + MOVING_SUFFIX
+        main_logger.info("Moving restore point %s to %s" % (source, self.capacity))
+        if not os.path.isdir(target):
+            if os.path.isdir(staging):
+                shutil.rmtree(staging)
+            os.makedirs(staging)
+            for filename in sorted(os.listdir(source)):
+                if os.path.isfile(os.path.join(source, filename)):
+                    self.copy_verified(
+                        os.path.join(source, filename), os.path.join(staging, filename)
+                    )
+            os.rename(staging, target)
+
+        # a restore reading the restore point holds a shared lock on its directory
+        fd = os.open(source, os.O_RDONLY)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                main_logger.info("Restore point %s is being read, removed later" % source)
+                return
+            shutil.rmtree(source)
+        finally:
+            os.close(fd)
+        self.moved += 1
+        main_logger.info("Restore point %s moved to %s" % (name, target))
+
+    def pause(self):
+        while self.busy and self.busy() and not self.stopped.is_set():
+            self.stopped.wait(BUSY_POLL)
+        if self.stopped.is_set():
+            raise ValueError("Mover stopped")
+
+    def copy_verified(self, source, target):
+        digest = hashlib.blake2b()
+        with open(source, "rb") as src, open(target, "wb") as dst:
+            while True:
+                self.pause()
+                data = src.read(MOVER_CHUNK)
+                if not data:
+                    break
+                self.throttle.wait(MOVER, len(data))
+                digest.update(data)
+                dst.write(data)
+                self.bytes += len(data)
+            advise(src.fileno(), 0, 0, getattr(os, "POSIX_FADV_DONTNEED", 0))
+            dst.flush()
+            os.fsync(dst.fileno())
+            shutil.copystat(source, target)
+            # the copy is read back from the storage, not from the page cache
+            advise(dst.fileno(), 0, 0, getattr(os, "POSIX_FADV_DONTNEED", 0))
+
+        check = hashlib.blake2b()
+        with open(target, "rb") as f:
+            while True:
+                self.pause()
+                data = f.read(MOVER_CHUNK)
+                if not data:
+                    break
+                self.throttle.wait(MOVER, len(data))
+                check.update(data)
+            advise(f.fileno(), 0, 0, getattr(os, "POSIX_FADV_DONTNEED", 0))
+        if check.digest() != digest.digest():
+            raise ValueError("Copy %s of %s does not match the original" % (target, source))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve, name="mover", daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        main_logger.info("Mover of %s to %s started" % (self.fast, self.capacity))
+        while not self.stopped.is_set():
+            self.run_once()
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+
+def tiering_enabled(params):
+    return bool(params.get("capacity_directory"))
+
+
+def mover_from_params(params, throttle=None, busy=None):
+    if not tiering_enabled(params):
+        return None
+    if params.get("s3_bucket"):
+        raise ValueError("capacity_directory is not supported with s3_bucket")
+    return Mover(
+        params["working_directory"],
+        params["capacity_directory"],
+        keep=int(params.get("fast_restore_points", FAST_RESTORE_POINTS)),
+        throttle=throttle,
+        busy=busy,
+        interval=float(params.get("mover_interval", MOVER_INTERVAL)),
+    )
@@ -0,0 +1,590 @@
+import asyncio
+import json
+import os
+import ssl
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from readahead import ReadAhead, read_ahead_size
+from tee import open_sink, REPLICA_BUFFER
+from throttle import NETWORK, DISK
+
+CHUNK_SIZE = 1024 * 1024 * 10
+RANGE_SIZE = 1024 * 1024 * 64
+PARALLEL_REQUESTS = 4
+POOL_SIZE = 8
+IO_WORKERS = 4
+STREAM_LIMIT = 1024 * 1024
+PROBE_SIZE = 1024 * 1024 * 4
+PROBE_TIMEOUT = 10
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    # asyncio creates its SSL objects through wrap_bio without a session argument, the
+    # context remembers the last session per server and offers it on new connections
+
+    def __new__(cls, *args, **kwargs):
+        context = super().__new__(cls, ssl.PROTOCOL_TLS_CLIENT)
+        context.sessions = {}
+        return context
+
+    def __init__(self, ca_file=None):
+        if ca_file:
+            self.load_verify_locations(cafile=ca_file)
+        else:
+            self.load_default_certs()
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self.sessions.get(server_hostname)
+        return super().wrap_bio(
+            incoming,
+            outgoing,
+            server_side=server_side,
+            server_hostname=server_hostname,
+            session=session,
+        )
+
+    def remember(self, server_hostname, ssl_object):
+        session = ssl_object.session
+        if session is not None:
+            self.sessions[server_hostname] = session
+
+
+class TransferStatusError(ValueError):
+    # the server answered a request with an error status
+    pass
+
+
+class Response:
+    def __init__(self, connection, status, headers):
+        self.connection = connection
+        self.status = status
+        self.headers = headers
+        self.started = False
+        self.done = False
+        self.reusable = headers.get("connection", "").lower() != "close"
+
+    def content_length(self):
+        if "content-length" in self.headers:
+            return int(self.headers["content-length"])
+        return None
+
+    def content_range_total(self):
+        # Content-Range: bytes 0-1023/4096
+        value = self.headers.get("content-range", "")
+        if "/" not in value:
+            return None
+        total = value.rsplit("/", 1)[1]
+        if total == "*":
+            return None
+        return int(total)
+
+    async def iter_chunks(self, chunk_size=CHUNK_SIZE):
+        self.started = True
+        reader = self.connection.reader
+        if self.headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                line = await reader.readline()
+                size = int(line.split(b";")[0].strip(), 16)
+                if size == 0:
+                    # trailer section ends with an empty line
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                left = size
+                while left:
+                    data = await reader.readexactly(min(left, chunk_size))
+                    left -= len(data)
+                    yield data
+                await reader.readline()
+        else:
+            left = self.content_length()
+            if left is None:
+                # no length, the body ends when the server closes the connection
+                self.reusable = False
+                while True:
+                    data = await reader.read(chunk_size)
+                    if not data:
+                        break
+                    yield data
+            else:
+                while left:
+                    data = await reader.readexactly(min(left, chunk_size))
+                    left -= len(data)
+                    yield data
+        self.done = True
+
+    async def read(self):
+        return b"".join([x async for x in self.iter_chunks()])
+
+    async def release(self):
+        if not self.done:
+            # drain small unread bodies (error replies) so the connection can be reused
+            if not self.started and self.reusable and self.content_length() is not None:
+                async for _ in self.iter_chunks():
+                    pass
+            else:
+                self.reusable = False
+        self.connection.pool.release(self.connection, self.reusable and self.done)
+
+
+class Connection:
+    def __init__(self, pool, reader, writer):
+        self.pool = pool
+        self.reader = reader
+        self.writer = writer
+        self.requests = 0
+
+    def closed(self):
+        return self.reader.at_eof() or self.writer.is_closing()
+
+    def close(self):
+        self.writer.close()
+
+    async def request(self, method, target, headers, body=None):
+        lines = ["%s %s HTTP/1.1" % (method, target), "Host: %s" % self.pool.host_header]
+        for key, value in headers.items():
+            lines.append("%s: %s" % (key, value))
+        if body is not None:
+            lines.append("Content-Length: %d" % len(body))
+        head = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+        self.requests += 1
+        self.writer.write(head)
+        if body:
+            self.writer.write(body)
+        await self.writer.drain()
+
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionResetError("Connection closed by %s" % self.pool.host_header)
+        status = int(line.decode("latin-1").split(" ", 2)[1])
+        response_headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, value = line.decode("latin-1").split(":", 1)
+            response_headers[key.strip().lower()] = value.strip()
+
+        response = Response(self, status, response_headers)
+        if method == "HEAD" or status in (204, 304):
+            response.done = True
+        return response
+
+
+class ConnectionPool:
+    def __init__(self, scheme, host, port, ssl_context, size=POOL_SIZE):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        default_port = 443 if scheme == "https" else 80
+        self.host_header = host if port == default_port else "%s:%d" % (host, port)
+        self.ssl_context = ssl_context if scheme == "https" else None
+        self.idle = []
+        self.slots = asyncio.Semaphore(size)
+        self.opened = 0
+        self.resumed = 0
+
+    async def acquire(self):
+        await self.slots.acquire()
+        while self.idle:
+            connection = self.idle.pop()
+            if not connection.closed():
+                return connection
+            connection.close()
+
+        try:
+            reader, writer = await asyncio.open_connection(
+                self.host,
+                self.port,
+                ssl=self.ssl_context,
+                server_hostname=self.host if self.ssl_context else None,
+                limit=STREAM_LIMIT,
+            )
+        except BaseException:
+            self.slots.release()
+            raise
+        self.opened += 1
+        ssl_object = writer.get_extra_info("ssl_object")
+        if ssl_object is not None and ssl_object.session_reused:
+            self.resumed += 1
+        return Connection(self, reader, writer)
+
+    def release(self, connection, reusable):
+        ssl_object = connection.writer.get_extra_info("ssl_object")
+        if ssl_object is not None:
+            # TLS 1.3 tickets arrive after the handshake, so the session is saved
+            # once a response has been read on the connection
+            self.ssl_context.remember(self.host, ssl_object)
+        if reusable and not connection.closed():
+            self.idle.append(connection)
+        else:
+            connection.close()
+        self.slots.release()
+
+    def close(self):
+        for connection in self.idle:
+            connection.close()
+        self.idle = []
+
+
+class TransferClient:
+    def __init__(
+        self,
+        ca_file=None,
+        pool_size=POOL_SIZE,
+        io_workers=IO_WORKERS,
+        parallel_requests=PARALLEL_REQUESTS,
+        range_size=RANGE_SIZE,
+        throttle=None,
+        read_ahead="auto",
+    ):
+        self.throttle = throttle
+        self.read_ahead = read_ahead
+        self.ssl_context = ResumingSSLContext(ca_file)
+        self.pool_size = pool_size
+        self.parallel_requests = parallel_requests
+        self.range_size = range_size
+        self.pools = {}
+        self.executor = ThreadPoolExecutor(max_workers=io_workers)
+        self.loop = None
+        self.thread = None
+        self.lock = threading.Lock()
+        # bytes moved through each url, updated from the event loop only
+        self.transferred = {}
+
+    # event loop running in a background thread, shared by every synchronous caller
+
+    def start(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(
+                    target=self.loop.run_forever, name="transfer-loop", daemon=True
+                )
+                self.thread.start()
+        return self.loop
+
+    def run(self, coroutine):
+        loop = self.start()
+        return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+    def close(self):
+        if self.loop is None:
+            return
+        self.run(self._close_pools())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.loop = None
+        self.executor.shutdown()
+
+    def statistics(self):
+        return {
+            "hosts": len(self.pools),
+            "connections": sum([x.opened for x in self.pools.values()]),
+            "tls_resumed": sum([x.resumed for x in self.pools.values()]),
+        }
+
+    def counter(self, url, total, bar_factory=None):
+        return Counter(total, bar_factory, totals=self.transferred, key=url)
+
+    async def _close_pools(self):
+        for pool in self.pools.values():
+            pool.close()
+        self.pools = {}
+
+    async def throttled(self, n, *budgets):
+        # consulted for every chunk, so rate changes apply to running transfers
+        if self.throttle is not None:
+            for name in budgets:
+                await self.throttle.acquire(name, n)
+
+    async def io(self, func, *args):
+        # a cancelled caller still waits for the call to return, the file it works on may be
+        # closed right after
+        future = asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            await asyncio.wait([future])
+            raise
+
+    def pool(self, scheme, host, port):
+        key = (scheme, host, port)
+        if key not in self.pools:
+            self.pools[key] = ConnectionPool(
+                scheme, host, port, self.ssl_context, size=self.pool_size
+            )
+        return self.pools[key]
+
+    async def request(self, method, url, headers=None, body=None):
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        pool = self.pool(parts.scheme, parts.hostname, port)
+        target = parts.path or "/"
+        if parts.query:
+            target += "?" + parts.query
+
+        # A pooled keep-alive connection may have been closed by the server in the meantime,
+        # in that case the request is retried once on a fresh connection.
+        for attempt in range(2):
+            connection = await pool.acquire()
+            reused = connection.requests > 0
+            try:
+                return await connection.request(method, target, headers or {}, body=body)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                pool.release(connection, False)
+                if not reused or attempt == 1:
+                    raise
+            except BaseException:
+                pool.release(connection, False)
+                raise
+
+    async def _write_body(self, response, sink, offset, chunk_size, progress):
+        try:
+            async for chunk in response.iter_chunks(chunk_size):
+                await self.throttled(len(chunk), NETWORK, DISK)
+                await self.io(sink.write, chunk, offset)
+                offset += len(chunk)
+                progress(len(chunk))
+        finally:
+            await response.release()
+        return offset
+
+    async def _download_range(self, url, sink, start, end, chunk_size, progress):
+        headers = {"Range": "bytes=%d-%d" % (start, end)}
+        response = await self.request("GET", url, headers=headers)
+        if response.status != 206:
+            await response.release()
+            raise TransferStatusError(
+                "Unexpected status %d for range %d-%d of %s" % (response.status, start, end, url)
+            )
+        await self._write_body(response, sink, start, chunk_size, progress)
+
+    async def run_parallel(self, work, parallel):
+        # a few workers pulling from a shared iterator keep the number of pending
+        # coroutines constant, no matter how big the image is
+        work = iter(work)
+
+        async def worker():
+            for job in work:
+                await job()
+
+        # when one worker fails the others are cancelled and awaited, none of them sends a
+        # request or writes to the sink once the caller has closed it
+        tasks = [asyncio.ensure_future(worker()) for _ in range(parallel)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def download(
+        self,
+        url,
+        file_name,
+        chunk_size=CHUNK_SIZE,
+        bar_factory=None,
+        replicas=None,
+        replica_buffer=REPLICA_BUFFER,
+        sink=None,
+    ):
+        # every replica gets the same bytes from the single incoming stream, a sink given
+        # by the caller (e.g. an object store upload) replaces the local file
+        range_size = self.range_size
+        if sink is None:
+            sink = open_sink(file_name, replicas=replicas, buffer_size=replica_buffer)
+        await self.io(sink.open)
+        success = False
+        try:
+            headers = {"Range": "bytes=0-%d" % (range_size - 1)}
+            response = await self.request("GET", url, headers=headers)
+            if response.status == 206:
+                total = response.content_range_total()
+            elif response.status == 200:
+                total = response.content_length()
+            else:
+                await response.release()
+                raise TransferStatusError(
+                    "Unexpected status %d downloading %s" % (response.status, url)
+                )
+
+            counter = self.counter(url, total, bar_factory)
+            if total is not None:
+                await self.io(sink.truncate, total)
+            await self._write_body(response, sink, 0, chunk_size, counter.add)
+
+            if response.status == 206 and total is not None and total > range_size:
+                ranges = [
+                    (start, min(start + range_size, total) - 1)
+                    for start in range(range_size, total, range_size)
+                ]
+                work = (
+                    lambda s=start, e=end: self._download_range(
+                        url, sink, s, e, chunk_size, counter.add
+                    )
+                    for start, end in ranges
+                )
+                await self.run_parallel(work, self.parallel_requests)
+            counter.final()
+            success = True
+        finally:
+            await self.io(sink.close, success)
+
+        results = sink.results()
+        if not results[0]["completed"]:
+            raise ValueError("Writing %s failed: %s" % (file_name, results[0]["error"]))
+        return results
+
+    async def _upload_chunk(self, url, reader, content_size, progress):
+        # the chunks come in order from the read ahead, which already reads the next ones
+        offset, chunk = await self.io(reader.read)
+        await self.throttled(len(chunk), DISK, NETWORK)
+        headers = {
+            "Content-Type": "application/octet-stream",
+            "Content-Range": "bytes %d-%d/%d" % (offset, offset + len(chunk) - 1, content_size),
+        }
+        response = await self.request("PUT", url + "?flush=n", headers=headers, body=chunk)
+        await response.release()
+        if response.status not in (200, 201, 204):
+            raise TransferStatusError(
+                "Unexpected status %d uploading range at %d of %s" % (response.status, offset, url)
+            )
+        progress(len(chunk))
+
+    async def upload(self, url, filename, chunk_size=CHUNK_SIZE, bar_factory=None):
+        content_size = os.stat(filename).st_size
+        counter = self.counter(url, content_size, bar_factory)
+        window = read_ahead_size(filename, self.read_ahead)
+        reader = await self.io(ReadAhead, filename, chunk_size, window)
+        try:
+            work = (
+                lambda: self._upload_chunk(url, reader, content_size, counter.add)
+                for _ in range(0, content_size, chunk_size)
+            )
+            await self.run_parallel(work, self.parallel_requests)
+        finally:
+            await self.io(reader.close)
+
+        await self._patch(url, {"op": "flush"})
+        counter.final()
+        return counter.value
+
+    async def _patch(self, url, operation):
+        response = await self.request(
+            "PATCH",
+            url,
+            headers={"Content-Type": "application/json"},
+            body=json.dumps(operation).encode("utf8"),
+        )
+        await response.release()
+        if response.status not in (200, 204):
+            raise TransferStatusError(
+                "Unexpected status %d for %s of %s" % (response.status, operation["op"], url)
+            )
+
+    async def _write_block(self, url, read, offset, length, size, progress, zeroed=None):
+        await self.throttled(length, DISK, NETWORK)
+        data = await self.io(read, offset, length)
+        if data == bytes(len(data)):
+            # zeroed ranges are sent as a zero request instead of their content
+            await self._patch(
+                url, {"op": "zero", "offset": offset, "size": len(data), "flush": False}
+            )
+            if zeroed:
+                zeroed(len(data))
+        else:
+            headers = {
+                "Content-Type": "application/octet-stream",
+                "Content-Range": "bytes %d-%d/%d" % (offset, offset + len(data) - 1, size),
+            }
+            response = await self.request("PUT", url + "?flush=n", headers=headers, body=data)
+            await response.release()
+            if response.status not in (200, 201, 204):
+                raise TransferStatusError(
+                    "Unexpected status %d writing range at %d of %s"
+                    % (response.status, offset, url)
+                )
+        progress(len(data))
+
+    async def _probe(self, url, probe_size):
+        t0 = time.monotonic()
+        response = await self.request("OPTIONS", url)
+        await response.release()
+        latency = time.monotonic() - t0
+        if response.status not in (200, 204):
+            raise TransferStatusError("Unexpected status %d probing %s" % (response.status, url))
+        throughput = None
+        if probe_size:
+            headers = {"Range": "bytes=0-%d" % (probe_size - 1)}
+            t0 = time.monotonic()
+            response = await self.request("GET", url, headers=headers)
+            try:
+                if response.status == 206:
+                    data = await response.read()
+                    throughput = len(data) / max(time.monotonic() - t0, 1e-6)
+            finally:
+                await response.release()
+        return {"url": url, "latency": latency, "throughput": throughput}
+
+    async def probe(self, url, probe_size=0):
+        # None when the url cannot be reached, the throughput is only measured on readable urls
+        try:
+            return await asyncio.wait_for(self._probe(url, probe_size), PROBE_TIMEOUT)
+        except (OSError, ValueError, EOFError, asyncio.TimeoutError):
+            return None
+
+    async def rank(self, urls, probe_size=0):
+        # reachable urls first by measured throughput, then by latency
+        probes = await asyncio.gather(*[self.probe(x, probe_size) for x in urls])
+        probes = [x for x in probes if x is not None]
+        return sorted(probes, key=lambda x: (-(x["throughput"] or 0), x["latency"]))
+
+    async def write_blocks(self, url, read, ranges, size, bar_factory=None, zeroed=None):
+        # writes only the given (offset, length) ranges, read(offset, length) supplies the data,
+        # zeroed(n) counts the bytes sent as zero requests
+        counter = self.counter(url, sum([x[1] for x in ranges]), bar_factory)
+        work = (
+            lambda o=offset, n=length: self._write_block(url, read, o, n, size, counter.add, zeroed)
+            for offset, length in ranges
+        )
+        await self.run_parallel(work, self.parallel_requests)
+        await self._patch(url, {"op": "flush"})
+        counter.final()
+        return counter.value
+
+
+class Counter:
+    def __init__(self, total, bar_factory=None, totals=None, key=None):
+        self.value = 0
+        self.bar = bar_factory(total) if bar_factory and total else None
+        self.totals = totals
+        self.key = key
+
+    def add(self, n):
+        self.value += n
+        if self.totals is not None:
+            self.totals[self.key] = self.totals.get(self.key, 0) + n
+        if self.bar:
+            self.bar.show_progress(self.value)
+
+    def final(self):
+        if self.bar:
+            self.bar.show_final_progress(self.value)
+
+
+clients = {}
+clients_lock = threading.Lock()
+
+
+def get_client(ca_file=None):
+    with clients_lock:
+        if ca_file not in clients:
+            clients[ca_file] = TransferClient(ca_file=ca_file)
+        return clients[ca_file]
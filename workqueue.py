@@ -0,0 +1,414 @@
+import os
+import signal
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+
+from digest import digest_from_params
+from tiering import mover_from_params
+from savior_logging import main_logger, close_job_log
+from scheduler import Job, Scheduler, job_priority, MAX_JOBS, QUEUED, RUNNING, SUCCESS, FAILED
+
+QUEUE_FILE = "savior_queue.sqlite"
+LEASE_TIME = 60
+LEASE_GRACE = 60
+CLAIM_INTERVAL = 5
+MAX_ATTEMPTS = 3
+QUEUE_TIMEOUT = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    mode TEXT NOT NULL,
+    setup_file TEXT NOT NULL,
+    vm_name TEXT,
+    storage_domain TEXT,
+    size INTEGER,
+    estimate REAL,
+    deadline REAL,
+    state TEXT NOT NULL,
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    bytes INTEGER,
+    submitted REAL NOT NULL,
+    started REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+CREATE TABLE IF NOT EXISTS workers (
+    name TEXT PRIMARY KEY,
+    heartbeat REAL NOT NULL,
+    running INTEGER NOT NULL,
+    max_jobs INTEGER NOT NULL,
+    bytes INTEGER NOT NULL
+);
+"""
+
+
+class JobQueue:
+    # jobs shared by the worker nodes through a SQLite file on shared storage. A worker holds a
+    # lease on each job it runs and renews it with its heartbeat, the job of a worker that
+    # stops renewing goes back to the queue lease_grace seconds after the lease has expired,
+    # the time its worker has to notice the lost lease and cancel the job.
+
+    def __init__(
+        self,
+        filename=QUEUE_FILE,
+        lease_time=LEASE_TIME,
+        max_attempts=MAX_ATTEMPTS,
+        lease_grace=LEASE_GRACE,
+    ):
+        self.filename = filename
+        self.lease_time = lease_time
+        self.lease_grace = lease_grace
+        self.max_attempts = max_attempts
+        db = sqlite3.connect(self.filename, timeout=QUEUE_TIMEOUT)
+        try:
+            db.executescript(SCHEMA)
+        finally:
+            db.close()
+
+    @contextmanager
+    def transaction(self):
+        # a new connection every time, so that any thread may use the queue. The rollback
+        # journal is kept (no WAL), WAL does not work on network file systems.
+        db = sqlite3.connect(self.filename, timeout=QUEUE_TIMEOUT, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            yield db
+            db.execute("COMMIT")
+        except BaseException:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+
+    def submit(
+        self,
+        mode,
+        setup_file,
+        vm_name=None,
+        storage_domain=None,
+        size=None,
+        estimate=None,
+        deadline=None,
+    ):
+        # the same job queued twice is kept once
+        with self.transaction() as db:
+            row = db.execute(
+                "SELECT id FROM jobs WHERE state = ? AND mode = ? AND setup_file = ?"
+                " AND vm_name IS ?",
+                (QUEUED, mode, setup_file, vm_name),
+            ).fetchone()
+            if row:
+                return row["id"]
+            job_id = uuid.uuid4().hex[:12]
+            db.execute(
+                "INSERT INTO jobs (id, mode, setup_file, vm_name, storage_domain, size, estimate,"
+                " deadline, state, submitted) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    job_id,
+                    mode,
+                    setup_file,
+                    vm_name,
+                    storage_domain,
+                    size,
+                    estimate,
+                    deadline,
+                    QUEUED,
+                    time.time(),
+                ),
+            )
+            return job_id
+
+    def expire(self, db, now):
+        # jobs of vanished workers are run again, up to max_attempts times
+        expired = now - self.lease_grace
+        db.execute(
+            "UPDATE jobs SET state = ?, worker = NULL, lease_until = NULL"
+            " WHERE state = ? AND lease_until < ? AND attempts < ?",
+            (QUEUED, RUNNING, expired, self.max_attempts),
+        )
+        db.execute(
+            "UPDATE jobs SET state = ?, error = ?, finished = ?"
+            " WHERE state = ? AND lease_until < ?",
+            (FAILED, "Lease expired %d times" % self.max_attempts, now, RUNNING, expired),
+        )
+
+    def claim(self, worker, count=1, domains=()):
+        # Among the queued jobs of VMs not running anywhere, the jobs on the storage domains of
+        # the worker come first, then the jobs on the least busy storage domains, then the
+        # usual priority of the scheduler.
+        now = time.time()
+        claimed = []
+        with self.transaction() as db:
+            self.expire(db, now)
+            running = db.execute(
+                "SELECT vm_name, storage_domain FROM jobs WHERE state = ?", (RUNNING,)
+            ).fetchall()
+            busy_vms = set([x["vm_name"] for x in running if x["vm_name"]])
+            domain_load = Counter([x["storage_domain"] for x in running])
+            candidates = []
+            for row in db.execute("SELECT * FROM jobs WHERE state = ?", (QUEUED,)).fetchall():
+                if row["vm_name"] not in busy_vms:
+                    candidates.append(queue_job(row))
+
+            while candidates and len(claimed) < count:
+                job = min(
+                    candidates,
+                    key=lambda x: (
+                        x.storage_domain not in domains,
+                        domain_load[x.storage_domain],
+                        job_priority(x, now),
+                        x.submitted,
+                    ),
+                )
+                db.execute(
+                    "UPDATE jobs SET state = ?, worker = ?, lease_until = ?,"
+                    " attempts = attempts + 1, started = ? WHERE id = ?",
+                    (RUNNING, worker, now + self.lease_time, now, job.id),
+                )
+                claimed.append(job)
+                domain_load[job.storage_domain] += 1
+                candidates = [x for x in candidates if x is not job]
+                if job.vm_name:
+                    candidates = [x for x in candidates if x.vm_name != job.vm_name]
+        return claimed
+
+    def heartbeat(self, worker, job_ids, max_jobs, bytes=0):
+        # renews the leases of the running jobs, returns the ones still held by the worker
+        now = time.time()
+        with self.transaction() as db:
+            held = []
+            for job_id in job_ids:
+                cursor = db.execute(
+                    "UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND state = ?",
+                    (now + self.lease_time, job_id, worker, RUNNING),
+                )
+                if cursor.rowcount:
+                    held.append(job_id)
+            db.execute(
+                "INSERT OR REPLACE INTO workers (name, heartbeat, running, max_jobs, bytes)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (worker, now, len(held), max_jobs, bytes),
+            )
+        return held
+
+    def finish(self, job_id, worker, state, error=None, bytes=0):
+        # False when the lease was lost and the job already belongs to another worker
+        with self.transaction() as db:
+            cursor = db.execute(
+                "UPDATE jobs SET state = ?, error = ?, bytes = ?, finished = ?, lease_until = NULL"
+                " WHERE id = ? AND worker = ? AND state = ?",
+                (state, error, bytes, time.time(), job_id, worker, RUNNING),
+            )
+            return cursor.rowcount == 1
+
+    def release(self, job_id, worker):
+        # a claimed job that was never started goes back to the queue as it was
+        with self.transaction() as db:
+            db.execute(
+                "UPDATE jobs SET state = ?, worker = NULL, lease_until = NULL, started = NULL,"
+                " attempts = attempts - 1 WHERE id = ? AND worker = ? AND state = ?",
+                (QUEUED, job_id, worker, RUNNING),
+            )
+
+    def jobs(self):
+        with self.transaction() as db:
+            return [dict(x) for x in db.execute("SELECT * FROM jobs ORDER BY submitted")]
+
+    def workers(self):
+        with self.transaction() as db:
+            return [dict(x) for x in db.execute("SELECT * FROM workers ORDER BY name")]
+
+
+def queue_job(row):
+    job = Job(
+        row["mode"],
+        row["setup_file"],
+        vm_name=row["vm_name"],
+        estimate=row["estimate"],
+        deadline=row["deadline"],
+    )
+    job.id = row["id"]
+    job.submitted = row["submitted"]
+    job.storage_domain = row["storage_domain"]
+    return job
+
+
+class Worker:
+    # one node of a distributed run: claims jobs from the shared queue while it has free job
+    # slots and runs them with its own API session, like the daemon does
+
+    def __init__(self, params, connect, job_factory, domains=None, name=None):
+        self.params = params
+        self.connect = connect
+        self.job_factory = job_factory
+        self.name = name or params.get("worker_name") or default_worker_name()
+        self.queue = JobQueue(
+            params.get("queue_file", QUEUE_FILE),
+            lease_time=int(params.get("lease_time", LEASE_TIME)),
+            max_attempts=int(params.get("max_attempts", MAX_ATTEMPTS)),
+            lease_grace=int(params.get("lease_grace", LEASE_GRACE)),
+        )
+        self.max_jobs = int(params.get("max_jobs", MAX_JOBS))
+        self.claim_interval = float(params.get("claim_interval", CLAIM_INTERVAL))
+        self.domains = domains or []
+        self.scheduler = Scheduler(self.run_job, max_jobs=self.max_jobs, logger=main_logger)
+        self.running = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.bytes = 0
+        self.renewed = time.monotonic()
+        self.oh = None
+        self.mover = None
+        self.digest = digest_from_params(params)
+
+    def run_job(self, job):
+        savior_job = None
+        error = None
+        try:
+            savior_job = self.job_factory(job.mode, job.setup_file, oh=self.oh, vm_name=job.vm_name)
+            savior_job.execute()
+            savior_job.status = "SUCCESS!"
+            self.finish(job, SUCCESS)
+        except Exception as exc:
+            if savior_job:
+                savior_job.status = "ERROR!"
+            error = str(exc)
+            self.finish(job, FAILED, error)
+            raise
+        finally:
+            # the S3 store of the job has its own transfer loop and connections
+            if savior_job:
+                try:
+                    savior_job.close()
+                except Exception as exc:
+                    main_logger.warning("Could not close job %s: %s" % (job.id, exc))
+            if self.digest:
+                log_file = savior_job.log_file if savior_job else None
+                profile = (
+                    savior_job.profiler.summary() if savior_job and savior_job.profiler else None
+                )
+                self.digest.add(job, log_file, error, profile)
+            elif savior_job:
+                savior_job.send_mail()
+            if savior_job:
+                close_job_log(savior_job.log_file)
+
+    def finish(self, job, state, error=None):
+        with self.lock:
+            self.running.pop(job.id, None)
+            self.bytes += job.bytes
+        if not self.queue.finish(job.id, self.name, state, error=error, bytes=job.bytes):
+            main_logger.warning("Job %s was taken over by another worker" % job.id)
+
+    def resolve_domains(self):
+        # storage domains may be given by name, the queue holds their ids
+        names = {x.name: x.id for x in self.oh.storage_domains_service.list()}
+        return [names.get(x, x) for x in self.domains]
+
+    def beat(self):
+        with self.lock:
+            running = list(self.running)
+            bytes = self.bytes + sum([x.bytes for x in self.running.values()])
+        held = self.queue.heartbeat(self.name, running, self.max_jobs, bytes)
+        self.renewed = time.monotonic()
+        # the job may already run on another node, it must not go on here
+        for job_id in set(running) - set(held):
+            main_logger.warning("Lease of job %s lost, cancelling it on %s" % (job_id, self.name))
+            self.cancel(job_id, "lease lost")
+
+    def cancel(self, job_id, reason):
+        with self.lock:
+            job = self.running.get(job_id)
+        if job is not None:
+            job.cancel(reason)
+
+    def fence(self):
+        # without a heartbeat for lease_time the leases have expired, the jobs are cancelled
+        # before the grace period ends and other nodes claim them
+        if time.monotonic() - self.renewed < self.queue.lease_time:
+            return
+        with self.lock:
+            running = list(self.running)
+        for job_id in running:
+            self.cancel(job_id, "leases not renewed for %d s" % self.queue.lease_time)
+
+    def claim(self, domains):
+        with self.lock:
+            free = self.max_jobs - len(self.running)
+        if free <= 0:
+            return
+        for job in self.queue.claim(self.name, count=free, domains=domains):
+            main_logger.info(
+                "Worker %s claimed %s job %s for %s" % (self.name, job.mode, job.id, job.vm_name)
+            )
+            with self.lock:
+                self.running[job.id] = job
+            self.scheduler.submit(job)
+
+    def serve(self):
+        main_logger.info("...Savior worker %s starting..." % self.name)
+        self.oh = self.connect(self.params)
+        domains = self.resolve_domains()
+        self.scheduler.start()
+        # older restore points move to the capacity tier while no job runs
+        self.mover = mover_from_params(
+            self.params, throttle=self.oh.throttle, busy=lambda: bool(self.scheduler.active_vms)
+        )
+        if self.mover:
+            self.mover.start()
+
+        signal.signal(signal.SIGTERM, lambda *_: self.stopped.set())
+        signal.signal(signal.SIGINT, lambda *_: self.stopped.set())
+
+        # the heartbeat must come well within the lease time, the claims may be less frequent
+        interval = min(self.claim_interval, self.queue.lease_time / 3)
+        while not self.stopped.is_set():
+            try:
+                self.beat()
+                self.claim(domains)
+            except sqlite3.Error as exc:
+                main_logger.error("Job queue %s unavailable: %s" % (self.queue.filename, exc))
+                self.fence()
+            # one mail for the jobs this worker ran, once they are all done
+            if self.digest and self.scheduler.idle():
+                self.digest.flush()
+            self.stopped.wait(interval)
+
+        self.shutdown()
+
+    def shutdown(self):
+        # running jobs are finished, their leases are renewed meanwhile
+        main_logger.info("Savior worker %s stopping, waiting for running jobs..." % self.name)
+        stopping = threading.Thread(target=self.scheduler.stop, kwargs={"wait": True})
+        stopping.start()
+        while stopping.is_alive():
+            self.beat()
+            stopping.join(self.queue.lease_time / 3)
+        # jobs claimed but not started by the local scheduler are left to the other workers
+        with self.lock:
+            unstarted = list(self.running)
+            self.running = {}
+        for job_id in unstarted:
+            self.queue.release(job_id, self.name)
+        self.beat()
+        if self.mover:
+            self.mover.stop()
+        if self.digest:
+            self.digest.close()
+        self.oh.close()
+        main_logger.info("Savior worker %s stopped." % self.name)
+
+
+def default_worker_name():
+    return "%s-%d" % (socket.gethostname(), os.getpid())